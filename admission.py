@@ -0,0 +1,153 @@
+import os
+import time
+import logging
+from dataclasses import dataclass
+from typing import Dict, Hashable, Optional
+
+import metrics
+import state
+from coalescer import MessageCoalescer
+
+logger = logging.getLogger(__name__)
+
+# Liga o controle de admissão no webhook
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") == "1"
+# Lotes aguardando execução por classe; acima disso a mensagem é adiada (ou descartada)
+ADMISSION_BACKLOG_INTERACTIVE = int(os.environ.get("ADMISSION_BACKLOG_INTERACTIVE", "100"))
+ADMISSION_BACKLOG_CONVERSATION = int(os.environ.get("ADMISSION_BACKLOG_CONVERSATION", "100"))
+ADMISSION_BACKLOG_NEW = int(os.environ.get("ADMISSION_BACKLOG_NEW", "50"))
+ADMISSION_BACKLOG_DEFERRED = int(os.environ.get("ADMISSION_BACKLOG_DEFERRED", "200"))
+# Contato com turno concluído há menos que isso está numa conversa em andamento
+ADMISSION_ACTIVE_S = float(os.environ.get("ADMISSION_ACTIVE_S", "1800"))
+# Intervalo mínimo entre dois avisos de espera para o mesmo contato
+ADMISSION_ACK_INTERVAL_S = float(os.environ.get("ADMISSION_ACK_INTERVAL_S", "300"))
+
+# Classes em ordem de prioridade (é também a prioridade do lote no coalescer)
+INTERACTIVE, CONVERSATION, NEW, DEFERRED = range(4)
+CLASS_NAMES = ("interactive", "conversation", "new", "deferred")
+
+
+@dataclass
+class Admission:
+    """Resultado da admissão de uma mensagem."""
+
+    # Classe da mensagem (interactive, conversation, new)
+    priority_class: str
+    # Prioridade do lote no coalescer (DEFERRED quando adiada)
+    priority: int
+    # admitted, deferred (executada depois das demais, com aviso) ou shed (descartada, com aviso)
+    outcome: str
+    # Tipo da mensagem de aviso a enviar ao contato (aguarde, ocupado) ou None
+    ack: Optional[str] = None
+
+
+class AdmissionController:
+    """
+    Admissão das mensagens no webhook, antes do coalescer. Respostas de botões e
+    listas vêm antes de conversas em andamento, que vêm antes de textos novos.
+    Cada classe tem um limite de lotes aguardando execução; com a classe cheia,
+    o lote vai para a classe "deferred" (executada só quando as outras estão
+    vazias) e o contato recebe um aviso. Com ela também cheia, a mensagem é
+    descartada com um aviso para tentar mais tarde, de modo que a espera do que
+    foi admitido continua limitada durante um pico.
+
+    O último turno e o último aviso de cada contato ficam no estado compartilhado
+    (com ttl), para que todos os workers e nós classifiquem e avisem do mesmo jeito.
+    """
+
+    def __init__(self, coalescer: MessageCoalescer, limits: Optional[Dict[int, int]] = None,
+                 active_s: float = ADMISSION_ACTIVE_S, ack_interval_s: float = ADMISSION_ACK_INTERVAL_S):
+        """
+        Args:
+            coalescer: Coalescer que executa os turnos
+            limits: Limite de lotes aguardando por classe (padrão: variáveis de ambiente)
+            active_s: Janela de uma conversa em andamento em segundos
+            ack_interval_s: Intervalo mínimo entre avisos para o mesmo contato
+        """
+        self.coalescer = coalescer
+        self.limits = limits or {
+            INTERACTIVE: ADMISSION_BACKLOG_INTERACTIVE,
+            CONVERSATION: ADMISSION_BACKLOG_CONVERSATION,
+            NEW: ADMISSION_BACKLOG_NEW,
+            DEFERRED: ADMISSION_BACKLOG_DEFERRED,
+        }
+        self.active_s = active_s
+        self.ack_interval_s = ack_interval_s
+
+    def classify(self, contact: Hashable, message_type: str) -> int:
+        """
+        Classe de prioridade de uma mensagem.
+
+        Args:
+            contact: Chave do contato (clínica e número normalizado)
+            message_type: Tipo da mensagem no webhook
+
+        Returns:
+            INTERACTIVE, CONVERSATION ou NEW
+        """
+        if message_type == "interactive":
+            return INTERACTIVE
+        if self.coalescer.is_pending(contact):
+            return CONVERSATION
+        try:
+            last = state.get_state().get_many([_key("turn", contact)])[0]
+        except Exception as e:
+            # Sem o estado compartilhado, a mensagem conta como nova (a admissão continua funcionando)
+            metrics.record_error("state", e)
+            logger.warning(f"Último turno de {contact} não consultado: {str(e)}")
+            return NEW
+        return CONVERSATION if last is not None and time.time() - float(last) < self.active_s else NEW
+
+    def admit(self, contact: Hashable, message_type: str) -> Admission:
+        """
+        Decide se a mensagem entra, é adiada ou é descartada.
+
+        Args:
+            contact: Chave do contato (clínica e número normalizado)
+            message_type: Tipo da mensagem no webhook
+
+        Returns:
+            Admissão com a prioridade do lote e o aviso a enviar, se houver
+        """
+        priority = self.classify(contact, message_type)
+        name = CLASS_NAMES[priority]
+        if self.coalescer.is_collecting(contact) or self.coalescer.backlog(priority) < self.limits[priority]:
+            # Uma mensagem que entra num lote já aberto não aumenta a fila
+            admission = Admission(name, priority, "admitted")
+        elif self.coalescer.backlog(DEFERRED) < self.limits[DEFERRED]:
+            admission = Admission(name, DEFERRED, "deferred", self._ack(contact, "aguarde"))
+        else:
+            admission = Admission(name, priority, "shed", self._ack(contact, "ocupado"))
+        metrics.ADMISSION_DECISIONS.labels(priority_class=name, outcome=admission.outcome).inc()
+        if admission.outcome != "admitted":
+            logger.warning(f"Mensagem de {contact} {admission.outcome} "
+                           f"(classe {name} com {self.limits[priority]} lotes aguardando)")
+        return admission
+
+    def turn_finished(self, contact: Hashable) -> None:
+        """
+        Registra um turno concluído: as próximas mensagens do contato contam como conversa em andamento.
+        """
+        try:
+            state.get_state().set_many({_key("turn", contact): str(time.time())}, ttl=self.active_s)
+        except Exception as e:
+            metrics.record_error("state", e)
+            logger.warning(f"Turno de {contact} não registrado no estado: {str(e)}")
+
+    def _ack(self, contact: Hashable, ack: str) -> Optional[str]:
+        # Um aviso por contato por intervalo, mesmo que ele continue escrevendo (e em qualquer nó):
+        # só quem registra a chave primeiro envia
+        try:
+            first = state.get_state().add_new([_key("ack", contact)], self.ack_interval_s)[0]
+        except Exception as e:
+            # Sem o estado compartilhado, é melhor avisar de novo do que deixar o contato sem resposta
+            metrics.record_error("state", e)
+            logger.warning(f"Aviso para {contact} não registrado no estado: {str(e)}")
+            return ack
+        return ack if first else None
+
+
+def _key(kind: str, contact: Hashable) -> str:
+    # Contatos são tuplas (clínica, número normalizado)
+    parts = contact if isinstance(contact, tuple) else (contact,)
+    return f"admission:{kind}:" + ":".join(str(part) for part in parts)
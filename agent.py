@@ -1,16 +1,86 @@
-import vertexai
-from vertexai.generative_models import SafetySetting, Tool, FunctionDeclaration
-from whatsapp_client import WhatsAppClient, create_client_from_env
+from whatsapp_client import InboundImage
 import os
+import time
+import asyncio
+import inspect
+import logging
+import importlib
+import threading
+import contextvars
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, List
+import metrics
+import tracing
+import llm_backend
+import state
+import deadline
+import circuit_breaker
+import hedging
+import history
+import intent_router
+import event_log
+import usage
+import scheduling
+from tenants import Tenant, TenantRegistry
+
+if TYPE_CHECKING:
+    from google.adk.agents import Agent
+
+logger = logging.getLogger(__name__)
+
+# SDKs pesados, importados sob demanda (ou pré-carregados no master do Gunicorn)
+HEAVY_MODULES = [
+    "google.genai.types",
+    "google.adk.agents",
+    "google.adk.runners",
+    "google.adk.sessions",
+    "google.generativeai",
+]
 
-from google.adk.agents import Agent
-from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
-from google.genai import types  # Para criar conteúdos (Content e Part)
-
+_sdk = None
+_sdk_lock = threading.Lock()
+
+def _load_sdk():
+    """
+    Importa o ADK e o google.genai na primeira utilização.
+    """
+    global _sdk
+    if _sdk is None:
+        with _sdk_lock:
+            if _sdk is None:
+                from google.adk.agents import Agent
+                from google.adk.agents.run_config import RunConfig, StreamingMode
+                from google.adk.runners import Runner
+                from google.adk.sessions import InMemorySessionService
+                from google.genai import types  # Para criar conteúdos (Content e Part)
+                _sdk = SimpleNamespace(Agent=Agent, Runner=Runner, RunConfig=RunConfig, StreamingMode=StreamingMode,
+                                       InMemorySessionService=InMemorySessionService, types=types)
+    return _sdk
+
+def preload():
+    """
+    Importa os SDKs pesados e registra o tempo de cada um. Chamado no master do
+    Gunicorn para que os workers herdem os módulos já carregados via fork.
+    
+    Returns:
+        Dicionário {módulo: segundos}
+    """
+    timings = {}
+    for name in HEAVY_MODULES:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Não foi possível pré-carregar {name}: {str(e)}")
+            continue
+        timings[name] = time.perf_counter() - start
+        logger.info(f"Pré-carregado {name} em {timings[name]:.3f}s")
+    if llm_backend.get_backend().calls_model:
+        _load_sdk()
+    return timings
+
+# O telefone do contato é enviado junto com cada mensagem (o agente é compartilhado entre contatos)
 instrucoes = """
-TELEFONE DO CONTATO: {}
-
 ------------------------------------------------------------------------------------
 PAPEL:
 Você é uma atendente do WhatsApp, altamente especializada, que atua em nome da Clínica Essenza, prestando um serviço de excelência. Sua missão é atender aos pacientes de maneira ágil e eficiente, respondendo dúvidas sobre a clínica, os procedimento realizados e auxiliando os pacientes com agendamentos.
@@ -56,6 +126,10 @@ FLUXOS:
 7. Outros assunto
     - Reponsa com uma mensagem de texto utilizando a função 'send_message' com o parâmetro type= 'text', mensagem=texto gerado pelo gemini
 
+8. Imagens enviadas pelo paciente:
+    - A mensagem traz a linha [Imagem enviada pelo paciente #...] e a imagem em anexo
+    - Descreva com cuidado o que você observa e quais procedimentos da clínica costumam tratar esse caso, sem fazer diagnóstico, e convide para uma avaliação com a função 'send_message' com o parâmetro type= 'text'
+
 ------------------------------------------------------------------------------------
 INSTRUÇÕES GERAIS:
 
@@ -131,6 +205,16 @@ OBSERVAÇÕES FINAIS:
 ----------------------------------------------------------------------------------------
 """
 
+# Acrescentado às instruções quando a agenda própria está ligada (SCHEDULING_STORE)
+instrucoes_agenda = """
+AGENDA (substitui o fluxo 2; não envie o link da agenda):
+    - Pergunte o procedimento, se ainda não souber, e use a função 'consultar_horarios' (procedimento e, se a pessoa indicar, a_partir_de=AAAA-MM-DD)
+    - Ofereça os horários devolvidos com a função 'send_message' com o parâmetro type= 'text'
+    - Quando a pessoa escolher, use a função 'agendar_horario' com o procedimento e inicio= o valor 'inicio' do horário escolhido
+    - Confirme o agendamento (procedimento, dia e hora) com a função 'send_message' com o parâmetro type= 'text'
+    - Se o horário não estiver mais livre, ofereça as alternativas devolvidas pela função
+"""
+
 generation_config = {
     "max_output_tokens": 8192,
     "temperature": 0,
@@ -138,95 +222,570 @@ generation_config = {
     "seed": 0,
 }
 
-safety_settings = [
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
-    ),
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
-    ),
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
-    ),
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_LOW_AND_ABOVE
-    ),
+descricao = "Você é uma atendente do WhatsApp, altamente especializada, que atua em nome da Clínica Essenza, prestando um serviço de excelência. Sua missão é atender aos pacientes de maneira ágil e eficiente, respondendo dúvidas sobre a clínica, os procedimento realizados e auxiliando os pacientes com agendamentos."
+
+botoes_menu = [
+    {"id": "btn_endereco", "title": "Endereço"},
+    {"id": "btn_agendamento", "title": "Agendamentos"},
+    {"id": "btn_procedimentos", "title": "Procedimentos"}
 ]
 
-# tool para acionar function calling
-tools = Tool(
-	function_declarations=[
-		FunctionDeclaration(
-			name="send_message",
-			description="Envia mensagens para o cliente.",
-			parameters={
-				"type": "object",
-				"properties": {
-					"to": {
-						"type": "string",
-						"description": "Número do telefone do cliente"
-					},
-					"type": {
-						"type": "string",
-						"description": "Tipo da mensagem a ser enviada (text, image, welcome, fallback, procedimentos endereco, encerramento)"
-					},
-                    "message": {
-						"type": "string",
-						"description": "Mensagem (texto) a ser enviado ao cliente."
-					},
-                    "image_url": {
-						"type": "string",
-						"description": "URL da imagem a ser enviada ao cliente."
-					},
-                    "required": ["to", "type"]
-				}
-			}
-            
-		)
-	]
-)
-
-# Função auxiliar que envia uma mensagem para um agente via Runner e retorna a resposta final
-def call_agent(agent: Agent, message_text: str) -> str:
-    # Cria um serviço de sessão em memória
-    session_service = InMemorySessionService()
-    # Cria uma nova sessão (você pode personalizar os IDs conforme necessário)
-    session = session_service.create_session(app_name=agent.name, user_id="user1", session_id="session1")
-    # Cria um Runner para o agente
-    runner = Runner(agent=agent, app_name=agent.name, session_service=session_service)
-    # Cria o conteúdo da mensagem de entrada
-    content = types.Content(role="user", parts=[types.Part(text=message_text)])
+mensagens = {
+    "welcome": """Olá! 👋 Seja bem-vinda(o) à Clínica Essenza.
+    Sou a assistente virtual da Dra. Camila Ribeiro e estou aqui para te ajudar com agendamentos, informações sobre nossos procedimentos estéticos ou qualquer outra dúvida.
+    Como posso te ajudar hoje?""",
+    "fallback": """Hmm... não entendi muito bem o que você quis dizer 😕
+Você pode reformular a pergunta ou escolher uma das opções abaixo:""",
+    "calendario": """Para agendar, é só escolher o melhor horário na nossa agenda online 📅
+https://calendar.app.google/k43eFCyMvQts1ZSs9""",
+    "procedimentos": "Gostaria de mais informações sobre qual dos procedimentos:",
+    "procedimentos_botao": "Ver opções",
+    "aguarde": "Recebemos sua mensagem! Estamos com muitos atendimentos agora e já vamos te responder 💬",
+    "ocupado": """Estamos com muitos atendimentos neste momento 😕
+Por favor, envie sua mensagem novamente em alguns minutos.""",
+    "encerramento": """Foi um prazer te atender! 💖
+Se tiver mais alguma dúvida ou quiser reagendar seu atendimento, é só me chamar aqui.
+A Clínica Essenza agradece sua confiança. Até logo! ✨""",
+}
 
-    final_response = ""
-    # Itera assincronamente pelos eventos retornados durante a execução do agente
-    for event in runner.run(user_id="user1", session_id="session1", new_message=content):
-        if event.is_final_response():
-          for part in event.content.parts:
-            if part.text is not None:
-              final_response += part.text
-              final_response += "\n"
-    return final_response
+procedimentos = [
+    {
+        "id": "limpeza_pele",
+        "title": "Limpeza de Pele Profunda",
+        "description": "Procedimento que remove impurezas, cravos e células mortas, promovendo a renovação celular e melhorando a textura da pele.",
+        "price": "180,00",
+        "duration_min": 90,
+        "image": "https://www.daniellesales.com.br/wp-content/uploads/2023/07/limpeza-de-pele-profunda-voce-conhece-todos-os-seus-beneficios-danielle-sales.jpg"
+    },
+    {
+        "id": "peeling_diamante",
+        "title": "Peeling de Diamante",
+        "description": "Esfoliação mecânica para renovação celular e melhora da textura da pele.",
+        "price": "200,00",
+        "duration_min": 60,
+        "image": "https://24698e6a.delivery.rocketcdn.me/wp-content/uploads/2022/11/1-39-960x540.jpg"
+    },
+    {
+        "id": "microagulhamento_facial",
+        "title": "Microagulhamento Facial",
+        "description": "Estimula a produção de colágeno e trata cicatrizes de acne, rugas finas e manchas.",
+        "price": "350,00",
+        "duration_min": 60
+    },
+    {
+        "id": "aplicacao_enzimas",
+        "title": "Aplicação de Enzimas",
+        "description": "Injeções subcutâneas que auxiliam na quebra de gordura localizada.",
+        "price": "280,00",
+        "duration_min": 30
+    },
+    {
+        "id": "revitalizacao_facial",
+        "title": "Revitalização Facial",
+        "description": "Combinação de hidratação profunda e vitaminas para melhorar o viço e a elasticidade da pele.",
+        "price": "220,00",
+        "duration_min": 60
+    },
+    {
+        "id": "botox_glabela",
+        "title": "Botox (Área Glabelar)",
+        "description": "Aplicação de toxina botulínica na região entre as sobrancelhas para suavizar linhas de expressão.",
+        "price": "600,00",
+        "duration_min": 30
+    },
+    {
+        "id": "preenchimento_labial",
+        "title": "Preenchimento Labial",
+        "description": "Harmonização dos lábios com ácido hialurônico para volume e contorno.",
+        "price": "950,00",
+        "duration_min": 60
+    }
+]
 
-def process_user_input(message, phone_number):
+localizacao = {
+    "latitude": -27.6041405,
+    "longitude": -48.5621391,
+    "name": "Clínica Essenza",
+    "address": "Rua das Rosas, 123 – Centro, Florianópolis – SC"
+}
+
+# Expediente usado pela agenda própria (SCHEDULING_STORE)
+horarios = {
+    "seg": ["09:00-18:00"],
+    "ter": ["09:00-18:00"],
+    "qua": ["09:00-18:00"],
+    "qui": ["09:00-18:00"],
+    "sex": ["09:00-18:00"],
+    "sab": ["09:00-13:00"],
+}
 
-    buscador = Agent(
+# Clínicas atendidas pelo processo; a padrão usa o conteúdo acima
+tenant_registry = TenantRegistry({
+    "name": "Clínica Essenza",
+    "prompt": instrucoes,
+    "description": descricao,
+    "model": "gemini-2.0-flash",
+    "catalog": procedimentos,
+    "location": localizacao,
+    "buttons": botoes_menu,
+    "messages": mensagens,
+    "hours": horarios,
+})
+
+# Classificador que responde os fluxos fixos sem passar pelo agente
+# (com a agenda própria, pedidos de agendamento vão ao agente, que consulta os horários)
+router = intent_router.IntentRouter(local_intents=[
+    intent for intent in intent_router.FIXED_INTENTS if not (scheduling.SCHEDULING_STORE and intent == "CALENDARIO")
+])
+
+# Executa cada send_message assim que o evento da chamada chega, enquanto o modelo continua gerando
+AGENT_STREAMING = os.environ.get("AGENT_STREAMING", "1") == "1"
+# Limite de um turno do agente no Gemini (o prazo da mensagem, se menor, prevalece)
+GEMINI_TIMEOUT_S = float(os.environ.get("GEMINI_TIMEOUT_S", "30"))
+# Com menos prazo que isso, o turno vai direto ao fallback, sem chamar o Gemini nem contar no disjuntor
+GEMINI_MIN_TIMEOUT_S = float(os.environ.get("GEMINI_MIN_TIMEOUT_S", "5"))
+
+# Turno em andamento (para medir o tempo até a primeira resposta enviada)
+_current_turn = contextvars.ContextVar("agent_turn", default=None)
+
+def _agent_input(message_text: str, phone_number: str, conversation: "history.Conversation" = None) -> str:
+    text = f"TELEFONE DO CONTATO: {phone_number}\n\n"
+    if conversation:
+        # A sessão do ADK é descartável; a continuidade vem da conversa guardada no estado compartilhado
+        text += f"{history.format_context(conversation)}\n\nNOVA MENSAGEM:\n"
+    text += message_text
+    metrics.AGENT_INPUT_TOKENS.observe(len(text) / 4)
+    return text
+
+def _agent_content(sdk, text: str, images: List[InboundImage] = None):
+    # Imagens (já reduzidas) seguem como partes da mesma mensagem, depois do texto que as cita
+    parts = [sdk.types.Part(text=text)]
+    for image in images or []:
+        parts.append(sdk.types.Part(inline_data=sdk.types.Blob(mime_type=image.mime_type, data=image.data)))
+    return sdk.types.Content(role="user", parts=parts)
+
+def _record_attempt_usage(agent: "Agent", result: llm_backend.AgentResult, started: float, completed: bool) -> None:
+    """
+    Registra o consumo de uma tentativa ao modelo assim que ela termina: vencedora,
+    perdedora do hedging (cancelada) ou com falha. Os tokens já foram cobrados pelo
+    Gemini mesmo quando a resposta é descartada.
+
+    Args:
+        agent: Agente chamado
+        result: Resultado parcial ou completo da tentativa
+        started: Início da tentativa (perf_counter)
+        completed: True se a tentativa chegou ao fim
+    """
+    if not completed and not (result.input_tokens or result.output_tokens):
+        return
+    turn = _current_turn.get() or {}
+    if turn:
+        turn["usage_recorded"] = True
+    sent_types = [str(call["args"].get("type", "")) for call in result.function_calls
+                  if call["name"] == "send_message"]
+    try:
+        usage.record(usage.Usage("agent", agent.model, result.input_tokens, result.output_tokens,
+                                 time.perf_counter() - started, len(result.function_calls),
+                                 sent_types[0] if sent_types else turn.get("intent")),
+                     turn.get("tenant"), turn.get("contact"))
+    except Exception as e:
+        metrics.record_error("usage", e)
+        logger.error(f"Erro ao registrar consumo do agente: {str(e)}")
+
+async def _run_agent_streaming(agent: "Agent", message_text: str, phone_number: str,
+                               conversation: "history.Conversation" = None,
+                               images: List[InboundImage] = None) -> llm_backend.AgentResult:
+    sdk = _load_sdk()
+    send_tool = next(tool for tool in agent.tools if tool.__name__ == "send_message")
+    text = _agent_input(message_text, phone_number, conversation)
+
+    # Envios em ordem, numa tarefa separada, fora do loop de eventos
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def dispatcher():
+        while True:
+            call = await queue.get()
+            if call is None:
+                return
+            try:
+                await asyncio.to_thread(send_tool, **dict(call["args"], to=phone_number))
+            except Exception as e:
+                metrics.record_error("tool", e)
+                logger.error(f"Erro ao executar {call['name']} para {phone_number}: {str(e)}")
+
+    async def attempt(index: int, commit=lambda: True) -> llm_backend.AgentResult:
+        session_id = f"session{index}"
+        session_service = sdk.InMemorySessionService()
+        # A ferramenta chamada pelo runner não envia nada neste modo: o envio sai do fluxo de eventos
+        session = session_service.create_session(app_name=agent.name, user_id="user1", session_id=session_id,
+                                                 state={"phone": phone_number, "dispatch": "stream"})
+        if inspect.isawaitable(session):
+            await session
+        runner = sdk.Runner(agent=agent, app_name=agent.name, session_service=session_service)
+        content = _agent_content(sdk, text, images)
+        result = llm_backend.AgentResult(tools_executed=True)
+        run_config = sdk.RunConfig(streaming_mode=sdk.StreamingMode.SSE)
+        started, completed = time.perf_counter(), False
+        try:
+            async for event in runner.run_async(user_id="user1", session_id=session_id, new_message=content,
+                                                run_config=run_config):
+                # Pedaços parciais do texto; chamadas de função chegam completas no evento final da etapa
+                if event.partial:
+                    continue
+                result.add_usage(getattr(event, "usage_metadata", None))
+                calls = event.get_function_calls()
+                # Só a tentativa vencedora do hedging envia mensagens
+                if calls and not commit():
+                    completed = True
+                    return result
+                for call in calls:
+                    record = {"name": call.name, "args": dict(call.args or {})}
+                    result.function_calls.append(record)
+                    # As demais ferramentas (agenda) devolvem resultado ao modelo e rodam no runner
+                    if call.name == "send_message":
+                        queue.put_nowait(record)
+                if event.is_final_response() and event.content:
+                    for part in event.content.parts:
+                        if part.text is not None:
+                            result.text += part.text + "\n"
+            commit()
+            completed = True
+            return result
+        finally:
+            # Cada tentativa conta, inclusive a perdedora cancelada e a que falhou
+            _record_attempt_usage(agent, result, started, completed)
+
+    dispatch_task = asyncio.create_task(dispatcher())
+    try:
+        if hedging.HEDGE_ENABLED:
+            return await hedging.gemini.run(attempt)
+        return await attempt(0)
+    finally:
+        queue.put_nowait(None)
+        await dispatch_task
+
+async def _run_agent_live(agent: "Agent", message_text: str, phone_number: str,
+                          conversation: "history.Conversation" = None,
+                          images: List[InboundImage] = None) -> llm_backend.AgentResult:
+    sdk = _load_sdk()
+    # Cria um serviço de sessão em memória
+    session_service = sdk.InMemorySessionService()
+    # Cria uma nova sessão com o telefone do contato no estado (lido pela ferramenta send_message)
+    session = session_service.create_session(app_name=agent.name, user_id="user1", session_id="session1",
+                                             state={"phone": phone_number})
+    if inspect.isawaitable(session):
+        await session
+    # Cria um Runner para o agente
+    runner = sdk.Runner(agent=agent, app_name=agent.name, session_service=session_service)
+    # Cria o conteúdo da mensagem de entrada
+    content = _agent_content(sdk, _agent_input(message_text, phone_number, conversation), images)
+
+    # O runner do ADK executa as ferramentas; aqui só registramos as chamadas. Assíncrono para
+    # que o timeout cancele o turno de fato (nenhuma ferramenta roda depois do fallback)
+    result = llm_backend.AgentResult(tools_executed=True)
+    started, completed = time.perf_counter(), False
+    try:
+        async for event in runner.run_async(user_id="user1", session_id="session1", new_message=content):
+            result.add_usage(getattr(event, "usage_metadata", None))
+            for call in event.get_function_calls():
+                result.function_calls.append({"name": call.name, "args": dict(call.args or {})})
+            if event.is_final_response():
+              for part in event.content.parts:
+                if part.text is not None:
+                  result.text += part.text
+                  result.text += "\n"
+        completed = True
+        return result
+    finally:
+        # Registrado aqui para contar também o turno que falhou ou passou do prazo
+        _record_attempt_usage(agent, result, started, completed)
+
+def _run_agent_with_timeout(agent: "Agent", message_text: str, phone_number: str,
+                            conversation: "history.Conversation" = None,
+                            images: List[InboundImage] = None) -> llm_backend.AgentResult:
+    # Falhas e timeouts contam para o disjuntor do Gemini, mas só com um timeout de verdade:
+    # um prazo quase esgotado (espera na fila) não diz nada sobre a saúde do serviço
+    seconds = deadline.timeout(GEMINI_TIMEOUT_S, required=GEMINI_MIN_TIMEOUT_S)
+
+    def run():
+        # Os dois modos rodam no loop do próprio turno: no timeout o runner é cancelado, em vez de
+        # continuar numa thread auxiliar (e enviar a resposta depois do fallback)
+        runner = _run_agent_streaming if AGENT_STREAMING else _run_agent_live
+        try:
+            return asyncio.run(asyncio.wait_for(
+                runner(agent, message_text, phone_number, conversation, images), seconds
+            ))
+        except asyncio.TimeoutError:
+            raise deadline.DeadlineExceeded(f"Turno do agente excedeu {seconds:.1f}s") from None
+
+    return circuit_breaker.gemini.call(run)
+
+# Função auxiliar que envia uma mensagem para um agente via Runner e retorna o resultado do turno
+# (as imagens são citadas no texto pelo hash, que também diferencia as gravações do modo replay)
+def call_agent(agent: "Agent", message_text: str, phone_number: str, conversation: "history.Conversation" = None,
+               images: List[InboundImage] = None) -> llm_backend.AgentResult:
+    backend = llm_backend.get_backend()
+    try:
+        with metrics.timed(metrics.AGENT_LATENCY), tracing.span("agent.llm", model=agent.model, backend=backend.mode):
+            return backend.run_agent(agent.name, message_text,
+                                     lambda: _run_agent_with_timeout(agent, message_text, phone_number,
+                                                                     conversation, images))
+    except Exception as e:
+        metrics.record_error("agent", e)
+        raise
+
+def _turn_abandoned() -> bool:
+    # Turno que já recebeu o fallback (timeout ou erro): as ferramentas não agem mais
+    turn = _current_turn.get()
+    return turn is not None and turn.get("abandoned", False)
+
+def _make_send_message_tool(tenant: Tenant):
+    """
+    Cria a ferramenta send_message ligada a uma clínica.
+    """
+    def send_message_tool(to: str, type: str, message: str = "", image_url: str = "", tool_context=None) -> str:
+        """
+        Envia mensagens para o cliente.
+
+        Args:
+            to: Número do telefone do cliente
+            type: Tipo da mensagem (text, image, WELCOME, CALENDARIO, PROCEDIMENTO, ENDERECO, FALLBACK, ENCERRAMENTO)
+            message: Mensagem (texto) a ser enviada ao cliente
+            image_url: URL da imagem a ser enviada ao cliente
+
+        Returns:
+            Confirmação do envio
+        """
+        if _turn_abandoned():
+            return "Erro: turno encerrado, o contato já recebeu a mensagem de indisponibilidade"
+        # O destinatário é sempre o contato do turno, e não o número escrito pelo modelo
+        if tool_context is not None:
+            # No modo streaming a mensagem já foi enviada a partir do evento da chamada
+            if tool_context.state.get("dispatch") == "stream":
+                return "Mensagem enviada"
+            to = tool_context.state.get("phone", to)
+        return send_message(to, type, message, image_url, tenant=tenant)
+    send_message_tool.__name__ = "send_message"
+    return send_message_tool
+
+def _make_scheduling_tools(tenant: Tenant):
+    """
+    Cria as ferramentas da agenda própria ligadas a uma clínica.
+    """
+    def consultar_horarios(procedimento: str, a_partir_de: str = "", quantidade: int = 3,
+                           tool_context=None) -> str:
+        """
+        Consulta os próximos horários livres para um procedimento.
+
+        Args:
+            procedimento: ID ou nome do procedimento
+            a_partir_de: Data ou data e hora mínima (AAAA-MM-DD ou AAAA-MM-DDTHH:MM); vazio = o quanto antes
+            quantidade: Quantidade de horários (até 6)
+
+        Returns:
+            Horários livres (AAAA-MM-DDTHH:MM) ou o motivo da falha
+        """
+        try:
+            after = scheduling.scheduler.parse(a_partir_de) if a_partir_de else None
+            item, slots = scheduling.scheduler.free_slots(tenant, procedimento, after,
+                                                          count=max(1, min(int(quantidade), 6)))
+        except scheduling.SchedulingError as e:
+            return f"Erro: {str(e)}"
+        if not slots:
+            return f"Sem horários livres para {item['title']} nos próximos {scheduling.SCHEDULING_HORIZON_DAYS} dias"
+        return _format_slots(item, slots)
+
+    def agendar_horario(procedimento: str, inicio: str, tool_context=None) -> str:
+        """
+        Agenda o procedimento para o contato no horário escolhido por ele.
+
+        Args:
+            procedimento: ID ou nome do procedimento
+            inicio: Horário de início (AAAA-MM-DDTHH:MM), um dos devolvidos por consultar_horarios
+
+        Returns:
+            Confirmação do agendamento ou o motivo da falha com horários alternativos
+        """
+        if _turn_abandoned():
+            return "Erro: turno encerrado, nada foi agendado"
+        phone = tool_context.state.get("phone") if tool_context is not None else None
+        if not phone:
+            return "Erro: contato desconhecido"
+        try:
+            start = scheduling.scheduler.parse(inicio)
+            event = scheduling.scheduler.book(tenant, procedimento, start, phone)
+        except scheduling.SchedulingError as e:
+            # Alternativas a partir do dia pedido
+            try:
+                item, slots = scheduling.scheduler.free_slots(tenant, procedimento, _day_start(inicio), count=3)
+            except scheduling.SchedulingError:
+                return f"Erro: {str(e)}"
+            return f"Não agendado: {str(e)}. " + (_format_slots(item, slots) if slots else "Sem horários livres")
+        return f"Agendado: {event.procedure_id} em {scheduling.scheduler.format(event.start)} (código {event.event_id[:8]})"
+
+    return [consultar_horarios, agendar_horario]
+
+def _day_start(inicio: str):
+    try:
+        return scheduling.scheduler.parse(inicio[:10])
+    except scheduling.SchedulingError:
+        return None
+
+def _format_slots(item, slots) -> str:
+    duration = item.get("duration_min") or scheduling.DEFAULT_DURATION_MIN
+    options = ", ".join(
+        f"{scheduling.scheduler.format(start)} (inicio={scheduling.scheduler.iso(start)})"
+        for start in slots
+    )
+    return f"Horários livres para {item['title']} ({duration} min): {options}"
+
+def _build_agent(tenant: Tenant) -> "Agent":
+    tools = [_make_send_message_tool(tenant)]
+    instruction = tenant.prompt
+    if scheduling.SCHEDULING_STORE:
+        tools += _make_scheduling_tools(tenant)
+        instruction += instrucoes_agenda
+    # Replay e synthetic respondem sem o Gemini: um objeto com os mesmos atributos basta
+    # e o ADK não precisa estar instalado (load tests, CI)
+    agent_class = _load_sdk().Agent if llm_backend.get_backend().calls_model else SimpleNamespace
+    return agent_class(
         name="Secretária Virtual",
-        model="gemini-2.0-flash",
-        instruction=instrucoes.format(phone_number),
-        description="Você é uma atendente do WhatsApp, altamente especializada, que atua em nome da Clínica Essenza, prestando um serviço de excelência. Sua missão é atender aos pacientes de maneira ágil e eficiente, respondendo dúvidas sobre a clínica, os procedimento realizados e auxiliando os pacientes com agendamentos.",
-        tools=[tools]
+        model=tenant.model,
+        instruction=instruction,
+        description=tenant.description,
+        tools=tools
     )
 
-    lancamentos = call_agent(buscador, message)
-    return lancamentos
-
-def send_message(to, type, message="Olá! Esta é uma mensagem de teste da API do WhatsApp.", image_url="https://example.com/imagem.jpg"): 
-
-    client = create_client_from_env()
+def process_user_input(message, phone_number, tenant=None, images=None):
+    """
+    Executa um turno do agente para a mensagem de um contato.
+    
+    Args:
+        message: Texto recebido
+        phone_number: Número normalizado do contato
+        tenant: Clínica que recebeu a mensagem (padrão: clínica configurada no ambiente)
+        images: Imagens recebidas no turno (InboundImage), enviadas ao modelo junto com o texto
+        
+    Returns:
+        Texto final do agente
+    """
+    tenant = tenant or tenant_registry.default()
+    turn = {"start": time.perf_counter(), "replied": False, "tenant": tenant.tenant_id, "contact": phone_number,
+            "intent": None, "usage_recorded": False, "abandoned": False}
+
+    # Primeiro nível da cascata: fluxos fixos com alta confiança não passam pelo agente
+    # (turnos com imagem sempre vão ao modelo)
+    decision = None
+    if intent_router.INTENT_ROUTER and not images:
+        with tracing.span("router") as span, event_log.timed("router", tenant=tenant.tenant_id):
+            decision = router.route(message)
+            turn["intent"] = decision.intent
+            span.set_attribute("intent", decision.intent)
+            span.set_attribute("local", decision.local)
+        event_log.emit("route", tenant=tenant.tenant_id, contact=phone_number, intent=decision.intent,
+                       confidence=round(decision.confidence, 3), route="local" if decision.local else "agent")
+        if decision.local:
+            result = llm_backend.AgentResult(
+                function_calls=[{"name": "send_message", "args": {"type": decision.intent}}], tools_executed=True
+            )
+            token = _current_turn.set(turn)
+            try:
+                send_message(phone_number, decision.intent, tenant=tenant)
+            finally:
+                _current_turn.reset(token)
+            router.log(decision, latency_s=time.perf_counter() - turn["start"])
+            history.save_turn(tenant, phone_number, message, result)
+            return ""
+
+    # Contato acima do orçamento diário de tokens (conversa abusiva ou em loop): fallback em vez do modelo
+    if not usage.within_budget(tenant.tenant_id, phone_number):
+        metrics.AGENT_FALLBACKS.labels(reason="budget").inc()
+        send_message(phone_number, "fallback", tenant=tenant)
+        return ""
+
+    buscador = tenant_registry.get_agent(tenant, _build_agent)
+    with event_log.timed("history.load", tenant=tenant.tenant_id):
+        conversation = history.load_conversation(tenant, phone_number)
+
+    token = _current_turn.set(turn)
+    try:
+        started = time.perf_counter()
+        try:
+            with event_log.timed("agent.llm", tenant=tenant.tenant_id):
+                result = call_agent(buscador, message, phone_number, conversation, images)
+        except Exception as e:
+            # Sem resposta do modelo: fallback com os botões, na hora, se nada foi enviado ainda
+            reason = ("circuit_open" if isinstance(e, circuit_breaker.CircuitOpenError)
+                      else "timeout" if isinstance(e, TimeoutError) else "error")
+            logger.error(f"Agente indisponível para {phone_number} ({reason}): {str(e)}")
+            metrics.AGENT_FALLBACKS.labels(reason=reason).inc()
+            turn["abandoned"] = True
+            if not turn["replied"]:
+                send_message(phone_number, "fallback", tenant=tenant)
+            return ""
+
+        sent_types = [str(call["args"].get("type", "")) for call in result.function_calls
+                      if call["name"] == "send_message"]
+        # As chamadas ao Gemini registram o consumo de cada tentativa; respostas gravadas ou
+        # sintéticas não passam por elas
+        if not turn["usage_recorded"]:
+            usage.record(usage.Usage("agent", tenant.model, result.input_tokens, result.output_tokens,
+                                     time.perf_counter() - started, len(result.function_calls),
+                                     sent_types[0] if sent_types else decision.intent if decision else None),
+                         tenant.tenant_id, phone_number)
+
+        # Decisões do agente, para a análise offline; os argumentos (texto enviado ao contato) só com EVENT_LOG_TOOL_ARGS
+        for call in result.function_calls:
+            extra = {"args": call["args"]} if event_log.EVENT_LOG_TOOL_ARGS else {}
+            event_log.emit("tool_call", tenant=tenant.tenant_id, contact=phone_number, name=call["name"],
+                           type=str(call["args"].get("type", "")).lower(), **extra)
+
+        # Respostas gravadas ou sintéticas não passam pelo runner: executar as chamadas aqui
+        if not result.tools_executed:
+            for call in result.function_calls:
+                if call["name"] == "send_message":
+                    send_message(**dict(call["args"], to=phone_number, tenant=tenant))
+    finally:
+        _current_turn.reset(token)
+
+    if decision is not None:
+        # O que o agente escolheu serve de rótulo para treinar e calibrar o roteador
+        router.log(decision, latency_s=time.perf_counter() - turn["start"], agent_types=sent_types)
+    with event_log.timed("history.save", tenant=tenant.tenant_id):
+        history.save_turn(tenant, phone_number, message, result, conversation)
+    return result.text
+
+def send_message(to: str, type: str, message: str = "Olá! Esta é uma mensagem de teste da API do WhatsApp.", image_url: str = "https://example.com/imagem.jpg", tenant: Tenant = None) -> str:
+    """
+    Envia mensagens para o cliente.
+
+    Args:
+        to: Número do telefone do cliente
+        type: Tipo da mensagem (text, image, WELCOME, CALENDARIO, PROCEDIMENTO, ENDERECO, FALLBACK, ENCERRAMENTO)
+        message: Mensagem (texto) a ser enviada ao cliente
+        image_url: URL da imagem a ser enviada ao cliente
+        tenant: Clínica que envia a mensagem (padrão: clínica configurada no ambiente)
+
+    Returns:
+        Confirmação do envio
+    """
+    tenant = tenant or tenant_registry.default()
+    start = time.perf_counter()
+    with tracing.span("tool.send_message", type=str(type).lower(), tenant=tenant.tenant_id):
+        _send_message(tenant, to, str(type).lower(), message, image_url)
+    event_log.emit("send", tenant=tenant.tenant_id, contact=to, type=str(type).lower(),
+                   seconds=time.perf_counter() - start)
+    turn = _current_turn.get()
+    if turn is not None and not turn["replied"]:
+        turn["replied"] = True
+        metrics.AGENT_FIRST_REPLY_LATENCY.observe(time.perf_counter() - turn["start"])
+        event_log.emit("stage", stage="first_reply", seconds=time.perf_counter() - turn["start"],
+                       tenant=tenant.tenant_id)
+    return "Mensagem enviada"
+
+def _send_message(tenant, to, type, message, image_url):
+    client = tenant_registry.get_client(tenant)
+    metrics.MESSAGES_SENT.labels(type=type).inc()
 
     if type == 'text':
         response = client.send_text_message(
@@ -235,112 +794,71 @@ def send_message(to, type, message="Olá! Esta é uma mensagem de teste da API d
         )
         print(f"Resposta da mensagem de texto: {response}")
 
-    if type == 'image':
-        response = client.send_text_message(
+    elif type == 'image':
+        response = client.send_image(
             to=to,
             image_url=image_url,
-            message=message
+            caption=message
+        )
+        print(f"Resposta da imagem: {response}")
+
+    elif type == 'calendario':
+        response = client.send_text_message(
+            to=to,
+            message=tenant.messages["calendario"]
+        )
+        print(f"Resposta da mensagem de texto: {response}")
+
+    elif type in ('aguarde', 'ocupado'):
+        # Avisos da admissão durante picos (não são oferecidos ao agente)
+        response = client.send_text_message(
+            to=to,
+            message=tenant.messages[type]
         )
         print(f"Resposta da mensagem de texto: {response}")
     
     elif type == 'welcome':
-        # Exemplo 2: Enviar mensagem com botões
+        # Mensagem de boas-vindas com botões
         response = client.send_button_message(
             to=to,
-            message=f"""Olá! 👋 Seja bem-vinda(o) à Clínica Essenza.
-    Sou a assistente virtual da Dra. Camila Ribeiro e estou aqui para te ajudar com agendamentos, informações sobre nossos procedimentos estéticos ou qualquer outra dúvida.
-    Como posso te ajudar hoje?""",
-            buttons=[
-                {"id": "btn_endereco", "title": "Endereço"},
-                {"id": "btn_agendamento", "title": "Agendamentos"},
-                {"id": "btn_procedimentos", "title": "Procedimentos"}
-            ]
+            message=tenant.messages["welcome"],
+            buttons=tenant.buttons
         )
         print(f"Resposta da mensagem com botões: {response}")
     
     elif type == 'fallback':
-        # Exemplo 2: Enviar mensagem com botões
+        # Mensagem de fallback com botões
         response = client.send_button_message(
             to=to,
-            message=f"""Hmm... não entendi muito bem o que você quis dizer 😕
-Você pode reformular a pergunta ou escolher uma das opções abaixo:""",
-            buttons=[
-                {"id": "btn_endereco", "title": "Endereço"},
-                {"id": "btn_agendamento", "title": "Agendamentos"},
-                {"id": "btn_procedimentos", "title": "Procedimentos"}
-            ]
+            message=tenant.messages["fallback"],
+            buttons=tenant.buttons
         )
         print(f"Resposta da mensagem com botões: {response}")
 
-    elif type == 'procedimentos':
-        # Exemplo 3: Enviar mensagem com lista de opções
-        sections = [
-            {
-                "title": "Procedimentos",
-                "rows": [
-                    {
-                        "id": "limpeza_pele",
-                        "title": "Limpeza de Pele Profunda",
-                        "description": "Procedimento que remove impurezas, cravos e células mortas, promovendo a renovação celular e melhorando a textura da pele. Valor: R$ 180,00"
-                    },
-                    {
-                        "id": "peeling_diamante",
-                        "title": "Peeling de Diamante",
-                        "description": "Esfoliação mecânica para renovação celular e melhora da textura da pele. Valor: R$ 200,00"
-                    },
-                    {
-                        "id": "microagulhamento_facial",
-                        "title": "Microagulhamento Facial",
-                        "description": "Estimula a produção de colágeno e trata cicatrizes de acne, rugas finas e manchas. Valor: R$ 350,00"
-                    },
-                    {
-                        "id": "aplicacao_enzimas",
-                        "title": "Aplicação de Enzimas",
-                        "description": "Injeções subcutâneas que auxiliam na quebra de gordura localizada. Valor: R$ 280,00"
-                    },
-                    {
-                        "id": "revitalizacao_facial",
-                        "title": "Revitalização Facial",
-                        "description": "Combinação de hidratação profunda e vitaminas para melhorar o viço e a elasticidade da pele. Valor: R$ 220,00"
-                    },
-                    {
-                        "id": "botox_glabela",
-                        "title": "Botox (Área Glabelar)",
-                        "description": "Aplicação de toxina botulínica na região entre as sobrancelhas para suavizar linhas de expressão. Valor: R$ 600,00"
-                    },
-                    {
-                        "id": "preenchimento_labial",
-                        "title": "Preenchimento Labial",
-                        "description": "Harmonização dos lábios com ácido hialurônico para volume e contorno. Valor: R$ 950,00"
-                    }
-                ]
-            }
-        ]
-    
+    elif type in ('procedimento', 'procedimentos'):
+        # Lista de procedimentos montada a partir do catálogo da clínica
         response = client.send_list_message(
             to=to,
-            message="Gostaria de mais informações sobre qual dos procedimentos:",
-            button_text="Ver opções",
-            sections=sections
+            message=tenant.messages["procedimentos"],
+            button_text=tenant.messages["procedimentos_botao"],
+            sections=tenant.list_sections()
         )
         print(f"Resposta da mensagem com lista: {response}")
 
     elif type == 'endereco':
-        # Exemplo 7: Enviar localização
+        # Localização da clínica
         response = client.send_location(
             to=to,
-            latitude=-27.6041405,
-            longitude=-48.5621391,
-            name="Clínica Essenza",
-            address="Rua das Rosas, 123 – Centro, Florianópolis – SC"
+            latitude=tenant.location["latitude"],
+            longitude=tenant.location["longitude"],
+            name=tenant.location.get("name"),
+            address=tenant.location.get("address")
         )
         print(f"Resposta da localização: {response}")
 
     elif type == 'encerramento':
         response = client.send_text_message(
             to=to,
-            text=f"""Foi um prazer te atender! 💖
-Se tiver mais alguma dúvida ou quiser reagendar seu atendimento, é só me chamar aqui.
-A Clínica Essenza agradece sua confiança. Até logo! ✨')"""
+            message=tenant.messages["encerramento"]
         )
         print(f"Resposta da mensagem de texto: {response}")
@@ -1,8 +1,21 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import os
 import logging
 import json
-from utils import normalize_brazilian_phone
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from utils import normalize_brazilian_phone_cached
+import metrics
+import tracing
+import state
+import deadline
+import delivery_status
+import event_log
+import admission
+import profiler
+import usage
+from coalescer import MessageCoalescer
+from whatsapp_client import InboundImage
 
 
 # Configurar logging
@@ -13,12 +26,117 @@ import agent
 
 app = Flask(__name__)
 
-from whatsapp_client import WhatsAppClient, create_client_from_env
-whatsapp_client = create_client_from_env()
+# Clínicas (e seus clientes WhatsApp) são resolvidas na primeira mensagem, e não na importação
+tenant_registry = agent.tenant_registry
 
 # Chave de verificação do webhook (você deve definir isso como variável de ambiente)
 VERIFY_TOKEN = os.environ.get("VERIFY_TOKEN")
 
+# Por quanto tempo lembrar IDs de mensagens já processadas (o WhatsApp reenvia o
+# webhook quando não recebe 200 a tempo)
+DEDUPE_TTL_S = float(os.environ.get("DEDUPE_TTL_S", "86400"))
+
+# Concessão por contato: com vários nós, só um executa o turno de um contato por vez
+TURN_LEASE_TTL_S = float(os.environ.get("TURN_LEASE_TTL_S", "120"))
+TURN_LEASE_WAIT_S = float(os.environ.get("TURN_LEASE_WAIT_S", "30"))
+
+# Áudios longos: o agente responde ao primeiro trecho enquanto os demais são transcritos
+AUDIO_EARLY_START = os.environ.get("AUDIO_EARLY_START", "1") == "1"
+
+# Texto que entra no lote quando uma imagem recebida não pôde ser baixada ou aberta
+IMAGE_FAILED_TEXT = "[O paciente enviou uma imagem que não pôde ser aberta]"
+
+# Threads para baixar e transcrever áudios fora da thread do webhook
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "4"))
+_media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+# Threads que enviam os avisos de espera da admissão (fora da thread do webhook)
+_ack_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="admission-ack")
+
+def run_agent_turn(key, texts):
+    """
+    Executa um turno do agente com as mensagens agrupadas de um contato.
+    
+    Args:
+        key: Tupla (ID da clínica, número normalizado do contato)
+        texts: Conteúdos recebidos (mensagens, transcrições e imagens), em ordem
+    """
+    tenant_id, contact = key
+    try:
+        try:
+            tenant = tenant_registry.get(tenant_id)
+        except KeyError:
+            # Clínica removida por uma recarga enquanto o lote esperava na fila
+            logger.warning(f"Lote de {contact} descartado: clínica {tenant_id} não está mais configurada")
+            return
+        # Imagens entram no texto como uma linha de referência e seguem ao modelo como partes da mensagem
+        images = [item for item in texts if isinstance(item, InboundImage)]
+        texts = [item.as_text() if isinstance(item, InboundImage) else item for item in texts]
+        # O turno tem orçamento próprio a partir de agora: o prazo do webhook já pode ter sido
+        # consumido pela espera no coalescer e na fila de prioridade (lotes adiados)
+        with deadline.budget(inherit=False), profiler.profiled("turn"), usage.attributed(tenant_id, contact), \
+                event_log.timed("turn", tenant=tenant_id, contact=contact, messages=len(texts)), \
+                state.lease(f"turn:{tenant_id}:{contact}", TURN_LEASE_TTL_S, TURN_LEASE_WAIT_S), \
+                tracing.span("agent.run", coalesced=len(texts), tenant=tenant_id):
+            agent.process_user_input("\n".join(texts), contact, tenant, images=images)
+    finally:
+        admission_controller.turn_finished(key)
+
+coalescer = MessageCoalescer(run_agent_turn)
+# Prioridade e limite de espera das mensagens que entram no coalescer
+admission_controller = admission.AdmissionController(coalescer)
+
+def _transcribe_into(slot, tenant, message, wa_id):
+    """
+    Transcreve um áudio e preenche o lugar reservado no lote do contato.
+    """
+    def first_segment(text):
+        # Áudios longos: o agente começa pelo primeiro trecho e o restante entra no lote seguinte
+        nonlocal slot
+        slot = slot.fill_and_reserve(text)
+
+    transcription = None
+    try:
+        with usage.attributed(tenant.tenant_id, wa_id):
+            transcription = tenant_registry.get_client(tenant).process_audio_message(
+                message, wa_id, on_first_segment=first_segment if AUDIO_EARLY_START else None
+            )
+    finally:
+        slot.fill(transcription)
+
+def _prepare_image_into(slot, tenant, message):
+    """
+    Baixa e reduz uma imagem e preenche o lugar reservado no lote do contato.
+    """
+    image = None
+    try:
+        image = tenant_registry.get_client(tenant).process_image_message(message)
+    finally:
+        # Sem a imagem, o agente ainda sabe que o paciente enviou uma (e pode pedir outra)
+        slot.fill(image or IMAGE_FAILED_TEXT)
+
+def find_duplicate_messages(message_ids):
+    """
+    Verifica quais mensagens já foram recebidas (por este ou outro nó) e registra
+    as novas, numa única operação no backend de estado.
+    
+    Args:
+        message_ids: IDs das mensagens do WhatsApp
+        
+    Returns:
+        Lista com True para cada mensagem já processada, False caso contrário
+    """
+    keys = [f"msg:{message_id}" for message_id in message_ids if message_id]
+    if not keys:
+        return [False] * len(message_ids)
+    try:
+        claimed = iter(state.get_state().add_new(keys, DEDUPE_TTL_S))
+    except Exception as e:
+        # Sem o backend de estado, é melhor arriscar uma resposta duplicada do que perder a mensagem
+        metrics.record_error("state", e)
+        logger.error(f"Erro ao verificar mensagens duplicadas: {str(e)}")
+        return [False] * len(message_ids)
+    return [not next(claimed) if message_id else False for message_id in message_ids]
+
 @app.route("/webhook", methods=["GET"])
 def verify_webhook():
     """
@@ -43,30 +161,109 @@ def verify_webhook():
     
     return "Parâmetros inválidos", 400
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Endpoint de métricas no formato de exposição do Prometheus.
+    """
+    content, content_type = metrics.render()
+    return Response(content, mimetype=content_type)
+
+def _admin_denied():
+    """
+    Confere o token dos endpoints de administração.
+
+    Returns:
+        Resposta de erro ou None se autorizado
+    """
+    if not profiler.PROFILE_TOKEN:
+        return "Não encontrado", 404
+    if not profiler.check_token(request.headers.get("Authorization")):
+        logger.warning(f"Acesso negado a {request.path}")
+        return "Não autorizado", 401
+    return None
+
+@app.route("/admin/profile", methods=["GET"])
+def profile_endpoint():
+    """
+    Perfila todas as threads deste worker por ?seconds=N (padrão 10) e retorna as
+    pilhas no formato collapsed (flamegraph.pl, speedscope).
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+    except ValueError:
+        return "seconds inválido", 400
+    if not 0 < seconds <= profiler.PROFILE_MAX_S:
+        return f"seconds deve estar entre 0 e {profiler.PROFILE_MAX_S:.0f}", 400
+    profile = profiler.sampler.profile(seconds)
+    return Response(profile.collapsed(), mimetype="text/plain",
+                    headers={"X-Profile-Samples": str(profile.samples), "X-Worker-Pid": str(os.getpid())})
+
+@app.route("/admin/profiles", methods=["GET"])
+def profiles_endpoint():
+    """
+    Lista os perfis amostrados mais lentos deste worker (PROFILE_SAMPLE_RATE).
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify({"pid": os.getpid(), "profiles": [profile.summary() for profile in profiler.sampler.slowest()]})
+
+@app.route("/admin/profiles/<int:profile_id>", methods=["GET"])
+def profile_detail_endpoint(profile_id):
+    """
+    Retorna um perfil amostrado no formato collapsed.
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    profile = profiler.sampler.get(profile_id)
+    if profile is None:
+        return "Perfil não encontrado", 404
+    return Response(profile.collapsed(), mimetype="text/plain")
+
 @app.route("/webhook", methods=["POST"])
 def receive_webhook():
     """
     Endpoint para receber mensagens do WhatsApp.
     O WhatsApp envia uma solicitação POST com os dados da mensagem.
     """
+    with metrics.timed(metrics.WEBHOOK_LATENCY), profiler.profiled("webhook"):
+        return _handle_webhook()
+
+def _handle_webhook():
+    """
+    Processa o corpo de um POST no webhook e retorna a resposta HTTP.
+    """
     try:
         # Obter dados JSON do corpo da solicitação
         data = request.json
-        logger.info(f"Webhook recebido: {json.dumps(data, indent=2)}")
         
         # Verificar se é um evento do WhatsApp
         if data.get("object") == "whatsapp_business_account":
-            # Processar cada entrada
-            for entry in data.get("entry", []):
-                # Processar cada alteração
-                for change in entry.get("changes", []):
-                    # Verificar se é uma mensagem do WhatsApp
-                    if change.get("field") == "messages":
-                        value = change.get("value", {})
-                        
-                        # Processar mensagens
-                        for message in value.get("messages", []):
-                            process_message(message, value.get("contacts", []))
+            values = [change.get("value", {}) for entry in data.get("entry", [])
+                      for change in entry.get("changes", []) if change.get("field") == "messages"]
+
+            # Status de entrega (várias vezes mais numerosos que as mensagens): caminho leve,
+            # só acumulados em memória, sem log detalhado, trace ou agente
+            for value in values:
+                if value.get("statuses"):
+                    delivery_status.store.record(value["statuses"], value.get("metadata", {}))
+            if not any(value.get("messages") for value in values):
+                return "EVENT_RECEIVED", 200
+
+            logger.info(f"Webhook recebido: {json.dumps(data, indent=2)}")
+            for value in values:
+                messages = value.get("messages", [])
+                if not messages:
+                    continue
+                # Processar mensagens (a deduplicação de todas é feita de uma vez)
+                duplicates = find_duplicate_messages([message.get("id") for message in messages])
+                for message, duplicate in zip(messages, duplicates):
+                    process_message(message, value.get("contacts", []), value.get("metadata", {}), duplicate)
             
             return "EVENT_RECEIVED", 200
         else:
@@ -74,55 +271,115 @@ def receive_webhook():
             return "Objeto não reconhecido", 404
             
     except Exception as e:
+        metrics.record_error("webhook", e)
         logger.error(f"Erro ao processar webhook: {str(e)}")
         return "Erro interno", 500
 
-def process_message(message, contacts):
+def process_message(message, contacts, metadata=None, duplicate=None):
     """
     Processa uma mensagem recebida do WhatsApp.
     
     Args:
         message: Dados da mensagem
         contacts: Informações de contato do remetente
+        metadata: Metadados do número que recebeu a mensagem (phone_number_id)
+        duplicate: Resultado da deduplicação já feita pelo chamador (None para verificar aqui)
     """
 
-    try:
-        # Extrair informações da mensagem
-        message_id = message.get("id")
-        message_type = message.get("type")
-        timestamp = message.get("timestamp")
-        
-        # Obter informações do contato
-        contact = contacts[0] if contacts else {}
-        wa_id = contact.get("wa_id", "desconhecido")
-        profile_name = contact.get("profile", {}).get("name", "desconhecido")
-        normalized_wa_id = normalize_brazilian_phone(wa_id)
-        logger.info(f"Mensagem recebida de {profile_name} ({wa_id})")
-        
-        # Processar diferentes tipos de mensagens
-        if message_type == "text":
-            text = message.get("text", {}).get("body", "")
-            logger.info(f"Mensagem de texto: {text}")
-            agent.process_user_input(text, normalized_wa_id)
-
-        elif message_type == "audio":
-            logger.info("Áudio recebido")
-            transcription = whatsapp_client.process_audio_message(message, normalized_wa_id)
-            agent.process_user_input(text, normalized_wa_id)
-        
-        #elif message_type == "image":
-            # logger.info("Imagem recebida")
-            # Processar imagem
+    # Cada mensagem recebida inicia o seu próprio trace e o seu orçamento de tempo, que
+    # acompanha a mensagem no lote do coalescer e nas threads de mídia
+    with deadline.budget(), \
+            tracing.start_trace("whatsapp.message", message_type=message.get("type") or "desconhecido") as root:
+        try:
+            # Extrair informações da mensagem
+            message_id = message.get("id")
+            message_type = message.get("type")
+            timestamp = message.get("timestamp")
+            metrics.MESSAGES_RECEIVED.labels(type=message_type or "desconhecido").inc()
             
-        #elif message_type == "document":
-            # logger.info("Documento recebido")
-            # Processar documento
+            # Obter informações do contato
+            contact = contacts[0] if contacts else {}
+            wa_id = contact.get("wa_id", "desconhecido")
+            profile_name = contact.get("profile", {}).get("name", "desconhecido")
+            with tracing.span("normalize"):
+                normalized_wa_id = normalize_brazilian_phone_cached(wa_id)
+            logger.info(f"Mensagem recebida de {profile_name} ({wa_id}) [trace={root.trace_id}]")
             
-        else:
-            logger.info(f"Tipo de mensagem não processado: {message_type}")
+            if duplicate is None:
+                with tracing.span("dedupe"):
+                    duplicate = find_duplicate_messages([message_id])[0]
+            root.set_attribute("duplicate", duplicate)
+            if duplicate:
+                logger.info(f"Mensagem duplicada ignorada: {message_id}")
+                return
             
-    except Exception as e:
-        logger.error(f"Erro ao processar mensagem: {str(e)}")
+            # Clínica dona do número que recebeu a mensagem
+            phone_number_id = (metadata or {}).get("phone_number_id")
+            tenant = tenant_registry.resolve(phone_number_id)
+            if tenant is None:
+                logger.warning(f"Número sem clínica configurada: {phone_number_id}")
+                return
+            root.set_attribute("tenant", tenant.tenant_id)
+            key = (tenant.tenant_id, normalized_wa_id)
+
+            # Admissão: com a fila da classe cheia, a mensagem é adiada ou descartada, com aviso
+            priority = None
+            if admission.ADMISSION_ENABLED and message_type in ("text", "interactive", "audio", "image"):
+                decision = admission_controller.admit(key, message_type)
+                root.set_attribute("admission", decision.outcome)
+                event_log.emit("inbound", tenant=tenant.tenant_id, contact=normalized_wa_id, type=message_type,
+                               message_id=message_id, priority_class=decision.priority_class,
+                               admission=decision.outcome)
+                if decision.ack:
+                    _ack_executor.submit(contextvars.copy_context().run, agent.send_message,
+                                         normalized_wa_id, decision.ack, tenant=tenant)
+                if decision.outcome == "shed":
+                    return
+                priority = decision.priority
+            else:
+                event_log.emit("inbound", tenant=tenant.tenant_id, contact=normalized_wa_id, type=message_type,
+                               message_id=message_id)
+            
+            # Processar diferentes tipos de mensagens
+            # Textos e áudios entram no lote do contato; o agente roda em segundo plano
+            if message_type == "text":
+                text = message.get("text", {}).get("body", "")
+                logger.info(f"Mensagem de texto: {text}")
+                coalescer.add(key, text, priority)
+
+            elif message_type == "interactive":
+                # Botões e itens da lista entram no lote como o texto escolhido
+                interactive = message.get("interactive", {})
+                reply = interactive.get("button_reply") or interactive.get("list_reply") or {}
+                text = reply.get("title", "")
+                logger.info(f"Resposta interativa: {reply.get('id')} ({text})")
+                if text:
+                    coalescer.add(key, text, priority)
+
+            elif message_type == "audio":
+                logger.info("Áudio recebido")
+                slot = coalescer.reserve(key, priority)
+                _media_executor.submit(
+                    contextvars.copy_context().run, _transcribe_into, slot, tenant, message, normalized_wa_id
+                )
+            
+            elif message_type == "image":
+                # Baixada e reduzida numa thread de mídia; o lugar no lote preserva a ordem
+                logger.info("Imagem recebida")
+                slot = coalescer.reserve(key, priority)
+                _media_executor.submit(contextvars.copy_context().run, _prepare_image_into, slot, tenant, message)
+                
+            #elif message_type == "document":
+                # logger.info("Documento recebido")
+                # Processar documento
+                
+            else:
+                logger.info(f"Tipo de mensagem não processado: {message_type}")
+                
+        except Exception as e:
+            metrics.record_error("process_message", e)
+            root.set_attribute("error", type(e).__name__)
+            logger.error(f"Erro ao processar mensagem: {str(e)}")
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,106 @@
+import time
+import random
+import argparse
+from typing import Callable, List
+
+from utils import (
+    extract_area_code,
+    is_brazilian_number,
+    normalize_brazilian_phone,
+    normalize_brazilian_phone_cached,
+    normalize_many,
+)
+
+AREA_CODES = ["11", "21", "31", "41", "42", "47", "48", "51", "61", "71", "81", "85", "91"]
+
+
+def random_number(rng: random.Random) -> str:
+    """
+    Gera um número brasileiro num dos formatos encontrados em importações de contatos.
+    """
+    ddd = rng.choice(AREA_CODES)
+    subscriber = f"{rng.randrange(10**8):08d}"
+    style = rng.randrange(6)
+    if style == 0:
+        return f"55{ddd}9{subscriber}"
+    if style == 1:
+        return f"55{ddd}{subscriber}"
+    if style == 2:
+        return f"{ddd}9{subscriber}"
+    if style == 3:
+        return f"+55 ({ddd}) 9{subscriber[:4]}-{subscriber[4:]}"
+    if style == 4:
+        return f"({ddd}) {subscriber[:4]}-{subscriber[4:]}"
+    return f"{ddd} 9 {subscriber[:4]} {subscriber[4:]}"
+
+
+def make_dataset(size: int, distinct: float, seed: int = 42) -> List[str]:
+    """
+    Gera a lista de números, com a fração informada de números distintos
+    (o restante repete números já sorteados, como em listas de campanhas).
+    """
+    rng = random.Random(seed)
+    pool = [random_number(rng) for _ in range(max(1, int(size * distinct)))]
+    return [pool[i] if i < len(pool) else rng.choice(pool) for i in range(size)]
+
+
+def per_call(numbers: List[str]) -> None:
+    # Uso atual: uma chamada por número para cada informação
+    for number in numbers:
+        normalize_brazilian_phone(number)
+        is_brazilian_number(number)
+        extract_area_code(number)
+
+
+def batch(numbers: List[str]) -> None:
+    for _ in normalize_many(numbers):
+        pass
+
+
+def cached(numbers: List[str]) -> None:
+    normalize_brazilian_phone_cached.cache_clear()
+    for number in numbers:
+        normalize_brazilian_phone_cached(number)
+
+
+def measure(fn: Callable[[List[str]], None], numbers: List[str], repeat: int) -> float:
+    """
+    Executa fn repeat vezes e retorna a melhor taxa em números por segundo.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(numbers)
+        best = min(best, time.perf_counter() - start)
+    return len(numbers) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark da normalização de telefones")
+    parser.add_argument("--size", type=int, default=200_000, help="Quantidade de números")
+    parser.add_argument("--distinct", type=float, default=0.5, help="Fração de números distintos")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    numbers = make_dataset(args.size, args.distinct)
+
+    # Os resultados em lote precisam ser idênticos aos das funções individuais
+    for number, info in zip(numbers, normalize_many(numbers)):
+        assert info.normalized == normalize_brazilian_phone(number), number
+        assert info.area_code == extract_area_code(number), number
+        assert info.is_brazilian == is_brazilian_number(number), number
+
+    baseline = measure(per_call, numbers, args.repeat)
+    print(f"{args.size} números, {args.distinct:.0%} distintos")
+    print(f"{'modo':<42} {'números/s':>12} {'ganho':>8}")
+    for name, fn in [
+        ("por chamada (normalize + is_br + area_code)", per_call),
+        ("normalize_many", batch),
+        ("normalize_brazilian_phone_cached", cached),
+    ]:
+        rate = baseline if fn is per_call else measure(fn, numbers, args.repeat)
+        print(f"{name:<42} {rate:>12,.0f} {rate / baseline:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
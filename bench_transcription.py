@@ -0,0 +1,85 @@
+import os
+import time
+import argparse
+import subprocess
+import tempfile
+from typing import Dict, List
+
+import llm_backend
+import whatsapp_client
+from whatsapp_client import WhatsAppClient
+
+
+class SizeScaledBackend(llm_backend.LiveBackend):
+    """Transcrição simulada com latência proporcional ao tamanho do áudio enviado."""
+
+    mode = "bench"
+
+    def __init__(self, base_ms: float, ms_per_kb: float):
+        self.base_ms = base_ms
+        self.ms_per_kb = ms_per_kb
+
+    def transcribe(self, audio_data, live_call):
+        time.sleep((self.base_ms + len(audio_data) / 1024 * self.ms_per_kb) / 1000.0)
+        return f"[{len(audio_data)} bytes]"
+
+
+def generate_sample(seconds: float, directory: str) -> str:
+    """
+    Gera uma nota de voz sintética: tom de 5,5 s seguido de 1,5 s de pausa, em ciclo.
+    """
+    path = os.path.join(directory, f"sintetico-{seconds:.0f}s.mp3")
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi",
+        "-i", f"aevalsrc=0.3*sin(2*PI*220*t)*lt(mod(t\\,7)\\,5.5):s=16000:d={seconds}",
+        "-acodec", "libmp3lame", "-q:a", "2", path
+    ], check=True)
+    return path
+
+
+def run(client: WhatsAppClient, path: str, chunk_min_s: float) -> Dict[str, float]:
+    """
+    Transcreve o arquivo com o limiar de divisão informado e mede os tempos.
+    """
+    whatsapp_client.AUDIO_CHUNK_MIN_S = chunk_min_s
+    first = {}
+    start = time.perf_counter()
+    client.transcribe_audio_with_gemini(
+        path, on_first_segment=lambda text: first.setdefault("at", time.perf_counter() - start)
+    )
+    total = time.perf_counter() - start
+    return {"total": total, "first": first.get("at", total)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark da transcrição em trechos paralelos")
+    parser.add_argument("audio", nargs="*", help="Notas de voz reais (padrão: gera uma sintética)")
+    parser.add_argument("--generate", type=float, default=180, help="Duração da nota sintética em segundos")
+    parser.add_argument("--backend", choices=["simulated", "live"], default="simulated",
+                        help="simulated: latência proporcional ao tamanho; live: Gemini (GEMINI_API_KEY)")
+    parser.add_argument("--base-ms", type=float, default=800)
+    parser.add_argument("--ms-per-kb", type=float, default=4)
+    args = parser.parse_args()
+
+    if args.backend == "simulated":
+        llm_backend.set_backend(SizeScaledBackend(args.base_ms, args.ms_per_kb))
+    client = WhatsAppClient(os.environ.get("WHATSAPP_PHONE_NUMBER_ID", "bench"),
+                            os.environ.get("WHATSAPP_ACCESS_TOKEN", "bench"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths: List[str] = args.audio or [generate_sample(args.generate, directory)]
+        print(f"{'áudio':<32} {'duração':>8} {'trechos':>8} {'inteiro':>9} {'trechos':>9} "
+              f"{'1º trecho':>10} {'ganho':>7}")
+        for path in paths:
+            duration, silences = client._probe_audio(path)
+            segments = whatsapp_client.plan_segments(duration, silences)
+            single = run(client, path, chunk_min_s=0)
+            # Limiar mínimo: força a divisão mesmo em amostras curtas
+            chunked = run(client, path, chunk_min_s=0.001)
+            print(f"{os.path.basename(path)[:32]:<32} {duration:>7.0f}s {len(segments):>8} "
+                  f"{single['total']:>8.2f}s {chunked['total']:>8.2f}s {chunked['first']:>9.2f}s "
+                  f"{single['total'] / chunked['total']:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
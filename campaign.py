@@ -0,0 +1,342 @@
+import os
+import csv
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+
+import metrics
+from utils import normalize_many
+from whatsapp_client import WhatsAppClient
+
+logger = logging.getLogger("campaign")
+
+# Limite padrão de envios por segundo por número de WhatsApp (limite inicial da Cloud API)
+CAMPAIGN_RATE = float(os.environ.get("CAMPAIGN_RATE", "80"))
+# Envios simultâneos
+CAMPAIGN_WORKERS = int(os.environ.get("CAMPAIGN_WORKERS", "16"))
+# Tentativas por destinatário quando a API responde 429 ou 5xx
+CAMPAIGN_MAX_ATTEMPTS = int(os.environ.get("CAMPAIGN_MAX_ATTEMPTS", "4"))
+
+# Resultados finais: destinatários com esses status não são reenviados ao retomar
+_DONE = ("sent", "invalid")
+
+
+class TokenBucket:
+    """
+    Limita a taxa de envios. A taxa cai pela metade a cada 429 da API e volta
+    aos poucos ao limite configurado a cada envio bem-sucedido (AIMD).
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Bloqueia até haver uma ficha disponível.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self) -> None:
+        """
+        Reduz a taxa após um 429 e descarta a rajada acumulada.
+        """
+        with self._lock:
+            self.rate = max(1.0, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+def read_recipients(path: str, column: str = "phone", table: Optional[str] = None) -> Iterator[Dict[str, str]]:
+    """
+    Lê os destinatários de um CSV ou de uma tabela SQLite, sob demanda.
+
+    Args:
+        path: Arquivo .csv ou banco SQLite
+        column: Coluna com o telefone
+        table: Tabela do SQLite (obrigatória para bancos SQLite)
+
+    Returns:
+        Iterador de linhas {coluna: valor}
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            if column not in (reader.fieldnames or []):
+                raise ValueError(f"Coluna '{column}' não encontrada em {path}")
+            yield from reader
+        return
+    if not table:
+        raise ValueError("Informe a tabela (--table) para ler destinatários de um banco SQLite")
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        for row in conn.execute(f'SELECT * FROM "{table}"'):
+            yield {key: "" if row[key] is None else str(row[key]) for key in row.keys()}
+    finally:
+        conn.close()
+
+
+class CampaignStore:
+    """
+    Resultados por destinatário num arquivo SQLite, que também serve de
+    checkpoint: ao retomar, quem já tem resultado final é pulado.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (phone TEXT PRIMARY KEY, raw TEXT, status TEXT NOT NULL, "
+            "message_id TEXT, error TEXT, attempts INTEGER, updated_at REAL)"
+        )
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._flushed_at = time.monotonic()
+
+    def done(self) -> set:
+        """
+        Retorna os telefones que já têm resultado final.
+        """
+        rows = self._conn.execute(f"SELECT phone FROM results WHERE status IN ({','.join('?' * len(_DONE))})", _DONE)
+        return {phone for (phone,) in rows}
+
+    def record(self, phone: str, raw: str, status: str, message_id: Optional[str] = None,
+               error: Optional[str] = None, attempts: int = 0) -> None:
+        """
+        Registra o resultado de um destinatário. As gravações são feitas em lotes
+        de até 200 linhas ou 1 segundo: se o processo morrer, no máximo esse
+        intervalo é reenviado ao retomar.
+        """
+        with self._lock:
+            self._pending.append((phone, raw, status, message_id, error, attempts, time.time()))
+            if len(self._pending) >= 200 or time.monotonic() - self._flushed_at >= 1.0:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        self._conn.execute("BEGIN")
+        self._conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", self._pending)
+        self._conn.execute("COMMIT")
+        self._pending.clear()
+        self._flushed_at = time.monotonic()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._conn.execute("SELECT status, COUNT(*) FROM results GROUP BY status").fetchall())
+
+    def export_csv(self, path: str) -> None:
+        """
+        Exporta os resultados para CSV.
+        """
+        self.flush()
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["phone", "raw", "status", "message_id", "error", "attempts", "updated_at"])
+            writer.writerows(self._conn.execute("SELECT * FROM results ORDER BY updated_at"))
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+
+class Campaign:
+    """
+    Envia um template aprovado para uma lista de destinatários, com envios
+    concorrentes, limite de taxa por número e retomada a partir do checkpoint.
+    """
+
+    def __init__(self, client: WhatsAppClient, store: CampaignStore, template: str, language: str = "pt_BR",
+                 params: Optional[List[str]] = None, rate: float = CAMPAIGN_RATE,
+                 workers: int = CAMPAIGN_WORKERS, max_attempts: int = CAMPAIGN_MAX_ATTEMPTS):
+        """
+        Args:
+            client: Cliente WhatsApp do número que envia
+            store: Resultados e checkpoint
+            template: Nome do template aprovado
+            language: Idioma do template
+            params: Colunas usadas como parâmetros do corpo do template, em ordem
+            rate: Envios por segundo (limite do número)
+            workers: Envios simultâneos
+            max_attempts: Tentativas por destinatário em caso de 429 ou 5xx
+        """
+        self.client = client
+        self.store = store
+        self.template = template
+        self.language = language
+        self.params = params or []
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.stats = {"sent": 0, "failed": 0, "invalid": 0, "duplicate": 0, "skipped": 0}
+        self._stats_lock = threading.Lock()
+
+    def _components(self, row: Dict[str, str]) -> Optional[List[Dict[str, Any]]]:
+        if not self.params:
+            return None
+        return [{
+            "type": "body",
+            "parameters": [{"type": "text", "text": row.get(name, "")} for name in self.params],
+        }]
+
+    def _count(self, status: str) -> None:
+        with self._stats_lock:
+            self.stats[status] += 1
+
+    def _send(self, phone: str, raw: str, row: Dict[str, str]) -> None:
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            self.bucket.acquire()
+            try:
+                response = self.client.send_template_message(phone, self.template, self.language,
+                                                             self._components(row))
+                message_id = (response.get("messages") or [{}])[0].get("id")
+                metrics.MESSAGES_SENT.labels(type="template").inc()
+                self.bucket.succeeded()
+                self.store.record(phone, raw, "sent", message_id=message_id, attempts=attempt)
+                self._count("sent")
+                return
+            except requests.exceptions.RequestException as e:
+                response = getattr(e, "response", None)
+                status = response.status_code if response is not None else None
+                error = f"{status or type(e).__name__}: {response.text[:200] if response is not None else e}"
+                # Erros 4xx (exceto 429) não melhoram com novas tentativas
+                if status is not None and status != 429 and status < 500:
+                    break
+                backoff = min(30.0, 0.5 * 2 ** (attempt - 1))
+                if status == 429:
+                    self.bucket.throttled()
+                    retry_after = response.headers.get("Retry-After")
+                    backoff = float(retry_after) if retry_after and retry_after.isdigit() else backoff
+                time.sleep(backoff)
+        self.store.record(phone, raw, "failed", error=error, attempts=attempt)
+        self._count("failed")
+
+    def run(self, recipients: Iterator[Dict[str, str]], column: str = "phone") -> Dict[str, Any]:
+        """
+        Executa a campanha.
+
+        Args:
+            recipients: Linhas com os destinatários
+            column: Coluna com o telefone
+
+        Returns:
+            Resumo com contagens, duração e mensagens por segundo
+        """
+        done = self.store.done()
+        seen = set()
+        start = time.perf_counter()
+        last_report = start
+        # Fila limitada: a lista é lida sob demanda, sem criar um future por destinatário de uma vez
+        slots = threading.BoundedSemaphore(self.workers * 4)
+
+        def task(phone, raw, row):
+            try:
+                self._send(phone, raw, row)
+            except Exception as e:
+                logger.error(f"Erro inesperado ao enviar para {phone}: {str(e)}")
+                self.store.record(phone, raw, "failed", error=str(e))
+                self._count("failed")
+            finally:
+                slots.release()
+
+        # As duas cópias avançam juntas: tee guarda no máximo uma linha
+        rows, for_phones = itertools.tee(recipients)
+        infos = normalize_many(row.get(column, "") for row in for_phones)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="campaign") as executor:
+            for row, info in zip(rows, infos):
+                if not info.valid:
+                    self.store.record(info.normalized or info.raw, info.raw, "invalid", error="número inválido")
+                    self._count("invalid")
+                    continue
+                if info.normalized in done:
+                    self._count("skipped")
+                    continue
+                if info.normalized in seen:
+                    self._count("duplicate")
+                    continue
+                seen.add(info.normalized)
+                slots.acquire()
+                executor.submit(task, info.normalized, info.raw, row)
+
+                now = time.perf_counter()
+                if now - last_report >= 5:
+                    last_report = now
+                    logger.info(f"Progresso: {self.stats} ({self.stats['sent'] / (now - start):.1f} msg/s)")
+
+        self.store.flush()
+        elapsed = time.perf_counter() - start
+        return dict(self.stats, elapsed_s=round(elapsed, 2),
+                    messages_per_s=round(self.stats["sent"] / elapsed, 1) if elapsed else 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Envio de template para uma lista de pacientes")
+    parser.add_argument("recipients", help="Arquivo .csv ou banco SQLite com os destinatários")
+    parser.add_argument("--template", required=True, help="Nome do template aprovado")
+    parser.add_argument("--language", default="pt_BR")
+    parser.add_argument("--column", default="phone", help="Coluna com o telefone")
+    parser.add_argument("--table", help="Tabela (quando os destinatários estão num banco SQLite)")
+    parser.add_argument("--param", action="append", default=[],
+                        help="Coluna usada como parâmetro do corpo do template (repita na ordem)")
+    parser.add_argument("--results", help="Banco SQLite de resultados/checkpoint (padrão: <template>.results.db)")
+    parser.add_argument("--export-csv", help="Exporta os resultados para este CSV ao final")
+    parser.add_argument("--tenant", default="default",
+                        help="ID da clínica que envia (padrão: número configurado no ambiente)")
+    parser.add_argument("--rate", type=float, default=CAMPAIGN_RATE, help="Envios por segundo")
+    parser.add_argument("--workers", type=int, default=CAMPAIGN_WORKERS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    import agent
+    tenant = agent.tenant_registry.get(args.tenant)
+    if not tenant.phone_number_id or not tenant.access_token:
+        parser.error(f"Clínica '{args.tenant}' sem phone_number_id ou token de acesso")
+    # Cliente próprio, com uma conexão por thread de envio
+    client = WhatsAppClient(tenant.phone_number_id, tenant.access_token, pool_size=args.workers)
+
+    store = CampaignStore(args.results or f"{args.template}.results.db")
+    campaign = Campaign(client, store, args.template, args.language, args.param, args.rate, args.workers)
+    try:
+        summary = campaign.run(read_recipients(args.recipients, args.column, args.table), args.column)
+        summary["totals"] = store.counts()
+        print(json.dumps(summary, indent=2))
+        if args.export_csv:
+            store.export_csv(args.export_csv)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import time
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Falhas consecutivas (erros ou timeouts) que abrem o circuito
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+# Tempo com o circuito aberto antes de deixar uma chamada de teste passar
+BREAKER_RESET_S = float(os.environ.get("BREAKER_RESET_S", "30"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """O circuito está aberto: a chamada nem foi feita."""
+
+
+class CircuitBreaker:
+    """
+    Disjuntor por processo. Depois de BREAKER_FAILURES falhas seguidas, rejeita
+    as chamadas por BREAKER_RESET_S segundos; então deixa uma única chamada de
+    teste passar e fecha de novo se ela tiver sucesso.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET_S):
+        """
+        Args:
+            name: Nome do serviço protegido (label da métrica)
+            failure_threshold: Falhas consecutivas que abrem o circuito
+            reset_timeout: Segundos até a chamada de teste
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        metrics.CIRCUIT_STATE.labels(name=name).set(_STATE_VALUES[CLOSED])
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"Circuito '{self.name}': {self.state} -> {state}")
+            self.state = state
+            metrics.CIRCUIT_STATE.labels(name=self.name).set(_STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        """
+        Indica se uma chamada pode ser feita agora.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            metrics.CIRCUIT_REJECTED.labels(name=self.name).inc()
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Executa fn protegida pelo disjuntor.
+
+        Raises:
+            CircuitOpenError: Se o circuito estiver aberto
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"Circuito '{self.name}' aberto")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+# Disjuntor compartilhado pelas chamadas ao Gemini (agente e transcrição)
+gemini = CircuitBreaker("gemini")
+# Resumos do histórico rodam em segundo plano e têm disjuntor próprio: falhas do
+# modelo de resumo não abrem o disjuntor que protege os atendimentos
+summary = CircuitBreaker("gemini-summary")
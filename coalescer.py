@@ -0,0 +1,293 @@
+import os
+import time
+import heapq
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+import metrics
+import event_log
+
+logger = logging.getLogger(__name__)
+
+# Janela de espera após a última mensagem do contato antes de acionar o agente
+COALESCE_WINDOW_MS = float(os.environ.get("COALESCE_WINDOW_MS", "1200"))
+# Atraso máximo adicionado desde a primeira mensagem do lote
+COALESCE_MAX_DELAY_MS = float(os.environ.get("COALESCE_MAX_DELAY_MS", "4000"))
+# Threads que executam turnos do agente
+AGENT_WORKERS = int(os.environ.get("AGENT_WORKERS", "8"))
+
+_PENDING = object()
+
+
+class Slot:
+    """Lugar reservado no lote para um conteúdo que ainda está sendo preparado (ex: transcrição, imagem)."""
+
+    def __init__(self, coalescer: "MessageCoalescer", contact: Hashable, priority: Optional[int] = None):
+        self._coalescer = coalescer
+        self._contact = contact
+        self._priority = priority
+        self.text = _PENDING
+
+    def fill(self, text: Optional[Any]) -> None:
+        """
+        Preenche o lugar reservado. Com None (ex: falha na transcrição), o item é descartado.
+
+        Args:
+            text: Texto (ou outro conteúdo, ex: imagem) a incluir no lote
+        """
+        self._coalescer._fill(self._contact, self, text)
+
+    def fill_and_reserve(self, text: str) -> "Slot":
+        """
+        Preenche o lugar com a primeira parte do conteúdo (o lote pode ser disparado)
+        e reserva, na mesma operação, o lugar do restante logo em seguida.
+
+        Args:
+            text: Primeira parte do conteúdo
+
+        Returns:
+            Lugar reservado para o restante
+        """
+        with self._coalescer._lock:
+            self.fill(text)
+            return self._coalescer.reserve(self._contact, self._priority)
+
+
+class _Batch:
+    __slots__ = ("items", "first_at", "deadline", "context", "priority", "queued_at")
+
+    def __init__(self, now: float, priority: int):
+        self.items: List = []
+        self.first_at = now
+        self.deadline = now
+        # Menor valor é executado primeiro
+        self.priority = priority
+        self.queued_at = now
+        # Contexto (trace) da primeira mensagem do lote
+        self.context = contextvars.copy_context()
+
+
+class MessageCoalescer:
+    """
+    Agrupa mensagens consecutivas de um mesmo contato num único turno do agente.
+
+    Cada mensagem adia o disparo em COALESCE_WINDOW_MS, até o limite de
+    COALESCE_MAX_DELAY_MS desde a primeira mensagem do lote. Os turnos de um
+    mesmo contato são executados um de cada vez e na ordem de chegada. Entre
+    contatos, os lotes prontos aguardam uma thread livre por ordem de prioridade
+    e, na mesma prioridade, por ordem de chegada.
+    """
+
+    def __init__(self, handler: Callable[[Hashable, List[Any]], None], window_ms: float = COALESCE_WINDOW_MS,
+                 max_delay_ms: float = COALESCE_MAX_DELAY_MS, workers: int = AGENT_WORKERS):
+        """
+        Args:
+            handler: Função chamada com (chave do contato, conteúdos em ordem) para executar o turno
+            window_ms: Janela de espera após a última mensagem
+            max_delay_ms: Atraso máximo desde a primeira mensagem
+            workers: Número de threads que executam os turnos
+        """
+        self.handler = handler
+        self.window = window_ms / 1000.0
+        self.max_delay = max_delay_ms / 1000.0
+        self.workers = workers
+
+        self._lock = threading.Condition()
+        self._batches: Dict[Hashable, _Batch] = {}
+        # Lotes prontos aguardando o turno anterior do mesmo contato terminar
+        self._ready: Dict[Hashable, List[_Batch]] = {}
+        # Contatos com turno na fila ou em execução
+        self._running: set = set()
+        self._heap: List = []
+        # Lotes prontos aguardando uma thread livre: (prioridade, ordem, contato, lote)
+        self._queue: List = []
+        self._seq = 0
+        self._active = 0
+        # Lotes ainda não iniciados por prioridade (acumulando, aguardando o contato ou na fila)
+        self._backlog: Dict[int, int] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._scheduler: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    # ===== ENTRADA =====
+
+    def add(self, contact: Hashable, text: str, priority: Optional[int] = None) -> None:
+        """
+        Adiciona um texto ao lote do contato.
+
+        Args:
+            contact: Chave do contato (ex: clínica e número normalizado)
+            text: Texto da mensagem
+            priority: Prioridade de um lote novo (menor valor é executado primeiro; padrão: 0).
+                Um lote já aberto mantém a sua prioridade
+        """
+        with self._lock:
+            batch = self._touch(contact, priority)
+            batch.items.append(text)
+            self._lock.notify()
+
+    def reserve(self, contact: Hashable, priority: Optional[int] = None) -> Slot:
+        """
+        Reserva um lugar no lote do contato, preservando a ordem das mensagens
+        enquanto o conteúdo é preparado em segundo plano.
+
+        Args:
+            contact: Chave do contato (ex: clínica e número normalizado)
+            priority: Prioridade de um lote novo (padrão: 0)
+
+        Returns:
+            Lugar reservado, a ser preenchido com Slot.fill
+        """
+        with self._lock:
+            batch = self._touch(contact, priority)
+            slot = Slot(self, contact, priority)
+            batch.items.append(slot)
+            return slot
+
+    def backlog(self, priority: int) -> int:
+        """
+        Lotes com a prioridade informada que ainda não começaram a ser executados.
+        """
+        with self._lock:
+            return self._backlog.get(priority, 0)
+
+    def is_collecting(self, contact: Hashable) -> bool:
+        """
+        Indica se o contato tem um lote aberto (uma nova mensagem entra nele).
+        """
+        with self._lock:
+            return contact in self._batches
+
+    def is_pending(self, contact: Hashable) -> bool:
+        """
+        Indica se o contato tem lote aberto ou turno na fila ou em execução.
+        """
+        with self._lock:
+            return contact in self._batches or contact in self._running
+
+    def _fill(self, contact: Hashable, slot: Slot, text: Optional[Any]) -> None:
+        with self._lock:
+            slot.text = text
+            batch = self._batches.get(contact)
+            if batch is not None and slot in batch.items and time.monotonic() >= batch.deadline:
+                self._try_flush(contact, batch)
+
+    def _touch(self, contact: Hashable, priority: Optional[int]) -> _Batch:
+        self._ensure_started()
+        now = time.monotonic()
+        batch = self._batches.get(contact)
+        if batch is None:
+            batch = self._batches[contact] = _Batch(now, priority or 0)
+            self._backlog[batch.priority] = self._backlog.get(batch.priority, 0) + 1
+        batch.deadline = min(now + self.window, batch.first_at + self.max_delay)
+        heapq.heappush(self._heap, (batch.deadline, id(batch), contact))
+        return batch
+
+    # ===== AGENDAMENTO =====
+
+    def _ensure_started(self) -> None:
+        # Threads criadas sob demanda, também depois de um fork do Gunicorn
+        if self._scheduler is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._batches.clear()
+        self._ready.clear()
+        self._running.clear()
+        self._heap.clear()
+        self._queue.clear()
+        self._active = 0
+        self._backlog.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="agent-turn")
+        self._scheduler = threading.Thread(target=self._run_scheduler, name="coalescer", daemon=True)
+        self._scheduler.start()
+
+    def _run_scheduler(self) -> None:
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, batch_id, contact = heapq.heappop(self._heap)
+                    batch = self._batches.get(contact)
+                    # Entradas antigas (lote adiado por nova mensagem) são ignoradas
+                    if batch is not None and id(batch) == batch_id and batch.deadline == deadline:
+                        self._try_flush(contact, batch)
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._lock.wait(timeout)
+
+    def _try_flush(self, contact: Hashable, batch: _Batch) -> None:
+        # Só dispara quando todos os itens reservados já foram preenchidos
+        if any(isinstance(item, Slot) and item.text is _PENDING for item in batch.items):
+            return
+        del self._batches[contact]
+        waited = time.monotonic() - batch.first_at
+        metrics.COALESCE_WAIT.observe(waited)
+        event_log.emit("stage", stage="coalesce", seconds=waited, messages=len(batch.items))
+        if contact in self._running:
+            self._ready.setdefault(contact, []).append(batch)
+        else:
+            self._submit(contact, batch)
+
+    def _submit(self, contact: Hashable, batch: _Batch) -> None:
+        self._running.add(contact)
+        batch.queued_at = time.monotonic()
+        self._seq += 1
+        heapq.heappush(self._queue, (batch.priority, self._seq, contact, batch))
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        # A fila fica aqui (e não no executor) para que a prioridade valha na ordem de execução
+        while self._queue and self._active < self.workers:
+            priority, _, contact, batch = heapq.heappop(self._queue)
+            self._active += 1
+            self._backlog[priority] -= 1
+            waited = time.monotonic() - batch.queued_at
+            metrics.AGENT_QUEUE_WAIT.labels(priority=str(priority)).observe(waited)
+            event_log.emit("stage", stage="queue", seconds=waited, priority=priority)
+            self._executor.submit(self._run_turn, contact, batch)
+
+    def _run_turn(self, contact: Hashable, batch: _Batch) -> None:
+        texts = []
+        for item in batch.items:
+            text = item.text if isinstance(item, Slot) else item
+            if text:
+                texts.append(text)
+        try:
+            if texts:
+                metrics.COALESCE_BATCH_SIZE.observe(len(texts))
+                batch.context.run(self.handler, contact, texts)
+        except Exception as e:
+            metrics.record_error("agent_turn", e)
+            logger.error(f"Erro ao executar turno do agente para {contact}: {str(e)}")
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._running.discard(contact)
+                waiting = self._ready.get(contact)
+                if waiting:
+                    next_batch = waiting.pop(0)
+                    if not waiting:
+                        del self._ready[contact]
+                    self._submit(contact, next_batch)
+                self._dispatch()
+                self._lock.notify_all()
+
+    def drain(self, timeout: float = 10.0) -> None:
+        """
+        Dispara imediatamente os lotes pendentes e aguarda os turnos em execução
+        (usado no encerramento do worker).
+
+        Args:
+            timeout: Tempo máximo de espera em segundos
+        """
+        if self._scheduler is None or self._pid != os.getpid():
+            return
+        end = time.monotonic() + timeout
+        with self._lock:
+            for contact, batch in list(self._batches.items()):
+                batch.deadline = time.monotonic()
+                self._try_flush(contact, batch)
+            while (self._running or self._ready) and time.monotonic() < end:
+                self._lock.wait(end - time.monotonic())
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Callable, Dict, Optional, TypeVar
+
+# Orçamento de tempo de cada mensagem, do webhook até a última resposta
+MESSAGE_DEADLINE_S = float(os.environ.get("MESSAGE_DEADLINE_S", "45"))
+
+T = TypeVar("T")
+
+# Prazo absoluto (time.monotonic) da mensagem em processamento. Propaga junto com
+# o contexto (lotes do coalescer, threads de mídia, tarefas asyncio)
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+# Threads para chamadas bloqueantes que não aceitam timeout, um conjunto por tipo de chamada
+# (transcrições não esperam atrás de resumos presos, e vice-versa)
+DEADLINE_WORKERS = int(os.environ.get("DEADLINE_WORKERS", "8"))
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+class DeadlineExceeded(TimeoutError):
+    """O orçamento de tempo da mensagem acabou."""
+
+
+@contextmanager
+def budget(seconds: float = MESSAGE_DEADLINE_S, inherit: bool = True):
+    """
+    Define o prazo do bloco. Um prazo externo mais curto continua valendo.
+
+    Args:
+        seconds: Orçamento em segundos a partir de agora
+        inherit: False ignora o prazo externo (ex: turno que começa depois de esperar na fila)
+    """
+    current = _deadline.get() if inherit else None
+    target = time.monotonic() + seconds
+    token = _deadline.set(target if current is None else min(current, target))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """
+    Retorna os segundos que restam no prazo atual (None se não houver prazo).
+    """
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+
+def timeout(cap: float, minimum: float = 0.0, required: float = 0.0) -> float:
+    """
+    Timeout de uma etapa: o menor entre o limite da etapa e o que resta do prazo.
+
+    Args:
+        cap: Limite da própria etapa em segundos
+        minimum: Piso do timeout (ex: para ainda conseguir enviar a mensagem de fallback)
+        required: Tempo sem o qual a etapa nem começa (ex: uma chamada ao Gemini com menos
+            que isso só falharia e contaria como falha do serviço no disjuntor)
+
+    Returns:
+        Timeout em segundos
+
+    Raises:
+        DeadlineExceeded: Se o prazo já acabou e não há piso, ou se resta menos que required
+    """
+    left = remaining()
+    if left is None:
+        return cap
+    if left < required:
+        raise DeadlineExceeded(f"Prazo da mensagem insuficiente ({max(left, 0.0):.1f}s de {required:.1f}s)")
+    if left <= 0 and minimum <= 0:
+        raise DeadlineExceeded("Prazo da mensagem esgotado")
+    return max(minimum, min(cap, left))
+
+
+def _executor(pool: str) -> ThreadPoolExecutor:
+    executor = _executors.get(pool)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(pool)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=DEADLINE_WORKERS, thread_name_prefix=f"deadline-{pool}")
+                _executors[pool] = executor
+    return executor
+
+
+def call_with_timeout(fn: Callable[[], T], seconds: float, pool: str = "default") -> T:
+    """
+    Executa uma chamada bloqueante que não aceita timeout, esperando no máximo seconds.
+    Se o tempo acabar, quem chamou é liberado: a chamada ainda na fila é cancelada, e a
+    que já começou continua numa thread auxiliar do seu conjunto (só para chamadas sem
+    efeitos colaterais; turnos do agente são cancelados no próprio loop asyncio).
+
+    Args:
+        fn: Função sem argumentos
+        seconds: Tempo máximo de espera
+        pool: Conjunto de threads da chamada (ex: transcription)
+
+    Returns:
+        Retorno de fn
+
+    Raises:
+        DeadlineExceeded: Se o tempo acabar
+    """
+    future = _executor(pool).submit(contextvars.copy_context().run, fn)
+    try:
+        return future.result(timeout=seconds)
+    except FutureTimeout:
+        queued = future.cancel()
+        raise DeadlineExceeded(f"Chamada excedeu {seconds:.1f}s" + (" na fila" if queued else "")) from None
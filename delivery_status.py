@@ -0,0 +1,220 @@
+import os
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Arquivo SQLite local com o status de entrega de cada mensagem enviada
+STATUS_DB_PATH = os.environ.get("STATUS_DB_PATH", "delivery_status.db")
+# Intervalo e tamanho máximos de um lote em memória antes da gravação
+STATUS_FLUSH_S = float(os.environ.get("STATUS_FLUSH_S", "5"))
+STATUS_FLUSH_ROWS = int(os.environ.get("STATUS_FLUSH_ROWS", "1000"))
+
+_STATUSES = ("sent", "delivered", "read", "failed")
+_COLUMNS = ("message_id", "phone_number_id", "recipient", "sent_at", "delivered_at", "read_at", "failed_at",
+            "error_code", "error_title", "updated_at")
+
+
+class DeliveryStatusStore:
+    """
+    Status de entrega (sent, delivered, read, failed) das mensagens enviadas,
+    agregados em memória por mensagem e gravados em lotes num SQLite local.
+    Nada aqui passa pelo agente nem pelo backend de estado compartilhado.
+    """
+
+    def __init__(self, path: str = STATUS_DB_PATH, flush_s: float = STATUS_FLUSH_S,
+                 flush_rows: int = STATUS_FLUSH_ROWS):
+        """
+        Args:
+            path: Arquivo SQLite
+            flush_s: Intervalo máximo entre gravações em segundos
+            flush_rows: Mensagens acumuladas que antecipam a gravação
+        """
+        self.path = path
+        self.flush_s = flush_s
+        self.flush_rows = flush_rows
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Condition()
+        # Gravações em série (thread de gravação e encerramento do worker)
+        self._write_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._flusher: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Uma conexão por processo (os workers do Gunicorn gravam no mesmo arquivo)
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn_pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS message_status (message_id TEXT PRIMARY KEY, phone_number_id TEXT, "
+                "recipient TEXT, sent_at REAL, delivered_at REAL, read_at REAL, failed_at REAL, "
+                "error_code INTEGER, error_title TEXT, updated_at REAL)"
+            )
+        return self._conn
+
+    def _ensure_started(self) -> None:
+        # Thread criada sob demanda, também depois de um fork do Gunicorn
+        if self._flusher is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending.clear()
+        self._flusher = threading.Thread(target=self._run_flusher, name="delivery-status", daemon=True)
+        self._flusher.start()
+
+    def record(self, statuses: Iterable[Dict[str, Any]], metadata: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Acumula os status recebidos no webhook (sem I/O).
+
+        Args:
+            statuses: Lista "statuses" de um evento do webhook
+            metadata: Metadados do número que enviou as mensagens
+        """
+        phone_number_id = (metadata or {}).get("phone_number_id")
+        with self._lock:
+            self._ensure_started()
+            for status in statuses:
+                message_id, kind = status.get("id"), status.get("status")
+                metrics.STATUS_EVENTS.labels(status=kind if kind in _STATUSES else "other").inc()
+                if not message_id or kind not in _STATUSES:
+                    continue
+                row = self._pending.get(message_id)
+                if row is None:
+                    row = self._pending[message_id] = dict.fromkeys(_COLUMNS)
+                    row.update(message_id=message_id, phone_number_id=phone_number_id,
+                               recipient=status.get("recipient_id"))
+                timestamp = float(status.get("timestamp") or time.time())
+                column = f"{kind}_at"
+                row[column] = timestamp if row[column] is None else min(row[column], timestamp)
+                if kind == "failed" and status.get("errors"):
+                    error = status["errors"][0]
+                    row.update(error_code=error.get("code"), error_title=error.get("title"))
+                row["updated_at"] = time.time()
+            if len(self._pending) >= self.flush_rows:
+                self._lock.notify()
+
+    def _run_flusher(self) -> None:
+        while True:
+            with self._lock:
+                self._lock.wait(self.flush_s)
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Grava as mensagens acumuladas numa única transação.
+
+        Returns:
+            Quantidade de mensagens gravadas
+        """
+        with self._lock:
+            rows, self._pending = list(self._pending.values()), {}
+        if not rows:
+            return 0
+        try:
+            with self._write_lock:
+                self._write(rows)
+        except Exception as e:
+            metrics.record_error("delivery_status", e)
+            logger.error(f"Erro ao gravar {len(rows)} status de entrega: {str(e)}")
+            return 0
+        return len(rows)
+
+    def _write(self, rows: List[Dict[str, Any]]) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                f"INSERT INTO message_status VALUES ({', '.join('?' * len(_COLUMNS))}) "
+                "ON CONFLICT(message_id) DO UPDATE SET "
+                "sent_at = COALESCE(message_status.sent_at, excluded.sent_at), "
+                "delivered_at = COALESCE(message_status.delivered_at, excluded.delivered_at), "
+                "read_at = COALESCE(message_status.read_at, excluded.read_at), "
+                "failed_at = COALESCE(message_status.failed_at, excluded.failed_at), "
+                "error_code = COALESCE(excluded.error_code, message_status.error_code), "
+                "error_title = COALESCE(excluded.error_title, message_status.error_title), "
+                "updated_at = excluded.updated_at",
+                [tuple(row[column] for column in _COLUMNS) for row in rows],
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def report(self, since: float = 0.0, phone_number_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Resume as entregas das mensagens enviadas desde since.
+
+        Args:
+            since: Timestamp inicial
+            phone_number_id: Número da clínica (padrão: todos)
+
+        Returns:
+            Totais, taxa de leitura, percentis da latência de entrega e falhas por código
+        """
+        self.flush()
+        where = "COALESCE(sent_at, delivered_at, read_at, failed_at) >= ?"
+        params: List[Any] = [since]
+        if phone_number_id:
+            where += " AND phone_number_id = ?"
+            params.append(phone_number_id)
+        conn = self._connection()
+        total, delivered, read, failed = conn.execute(
+            f"SELECT COUNT(*), COUNT(delivered_at), COUNT(read_at), COUNT(failed_at) FROM message_status WHERE {where}",
+            params,
+        ).fetchone()
+        latencies = sorted(value for (value,) in conn.execute(
+            f"SELECT delivered_at - sent_at FROM message_status WHERE {where} "
+            "AND delivered_at IS NOT NULL AND sent_at IS NOT NULL", params
+        ))
+        failures = conn.execute(
+            f"SELECT error_code, error_title, COUNT(*) FROM message_status WHERE {where} AND failed_at IS NOT NULL "
+            "GROUP BY error_code, error_title ORDER BY COUNT(*) DESC", params
+        ).fetchall()
+
+        def percentile(p: float) -> Optional[float]:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+
+        return {
+            "messages": total,
+            "delivered": delivered,
+            "read": read,
+            "failed": failed,
+            "read_rate": round(read / delivered, 3) if delivered else None,
+            "delivery_latency_s": {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99)},
+            "failures": [{"code": code, "title": title, "count": count} for code, title, count in failures],
+        }
+
+
+# Status das mensagens enviadas por este processo
+store = DeliveryStatusStore()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relatório de entregas das mensagens enviadas")
+    parser.add_argument("--db", default=STATUS_DB_PATH)
+    parser.add_argument("--hours", type=float, default=24, help="Janela do relatório em horas")
+    parser.add_argument("--phone-number-id", help="Número da clínica (padrão: todos)")
+    args = parser.parse_args()
+
+    report = DeliveryStatusStore(args.db).report(time.time() - args.hours * 3600, args.phone_number_id)
+    latency = report["delivery_latency_s"]
+    print(f"{report['messages']} mensagens, {report['delivered']} entregues, {report['read']} lidas, "
+          f"{report['failed']} com falha")
+    if report["read_rate"] is not None:
+        print(f"Taxa de leitura: {report['read_rate']:.1%}")
+    if latency["p50"] is not None:
+        print(f"Latência de entrega: p50 {latency['p50']:.1f}s, p90 {latency['p90']:.1f}s, p99 {latency['p99']:.1f}s")
+    for failure in report["failures"]:
+        print(f"Falha {failure['code']} ({failure['title']}): {failure['count']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+import os
+import glob
+import atexit
+import json
+import math
+import time
+import zlib
+import struct
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Diretório dos segmentos do log de eventos (vazio, o padrão, desliga o log). Os
+# eventos têm o número do contato: ligar o log exige a retenção abaixo
+EVENT_LOG_DIR = os.environ.get("EVENT_LOG_DIR", "")
+# Tamanho e idade máximos de um segmento antes de abrir o próximo
+EVENT_LOG_SEGMENT_BYTES = int(os.environ.get("EVENT_LOG_SEGMENT_MB", "64")) * 1024 * 1024
+EVENT_LOG_SEGMENT_S = float(os.environ.get("EVENT_LOG_SEGMENT_S", "3600"))
+# Intervalo e tamanho máximos de um bloco em memória antes da gravação
+EVENT_LOG_FLUSH_S = float(os.environ.get("EVENT_LOG_FLUSH_S", "2"))
+EVENT_LOG_BATCH = int(os.environ.get("EVENT_LOG_BATCH", "5000"))
+# Eventos em memória acima dos quais os novos são descartados (disco lento ou cheio)
+EVENT_LOG_MAX_PENDING = int(os.environ.get("EVENT_LOG_MAX_PENDING", "100000"))
+# Retenção: segmentos mais antigos que isso, ou além do tamanho total, são apagados (0 desliga o limite)
+EVENT_LOG_RETENTION_DAYS = float(os.environ.get("EVENT_LOG_RETENTION_DAYS", "30"))
+EVENT_LOG_MAX_BYTES = int(os.environ.get("EVENT_LOG_MAX_MB", "2048")) * 1024 * 1024
+# Argumentos das chamadas de ferramenta (texto livre enviado ao contato) nos eventos tool_call
+EVENT_LOG_TOOL_ARGS = os.environ.get("EVENT_LOG_TOOL_ARGS", "0") == "1"
+
+# Formato dos segmentos: cabeçalho do arquivo seguido de blocos. Cada bloco tem um
+# cabeçalho JSON (quantidade, intervalo de tempo e tamanho de cada coluna) e uma
+# lista JSON comprimida por coluna, para que as consultas leiam só as colunas usadas
+_FILE_MAGIC = b"GEV1"
+_BLOCK_MAGIC = b"BLK1"
+_BLOCK_HEADER = struct.Struct(">4sI")
+_SEGMENT_GLOB = "events-*.gev"
+
+
+class EventLog:
+    """
+    Log de eventos das conversas (mensagens recebidas, decisões do agente, envios
+    e latências por etapa), somente de inclusão. Os eventos ficam em memória e uma
+    thread grava cada lote como um bloco colunar comprimido no segmento atual do
+    processo; os segmentos são trocados por tamanho e por idade, e a cada troca os
+    segmentos fora da retenção são apagados.
+    """
+
+    def __init__(self, directory: str = EVENT_LOG_DIR, segment_bytes: int = EVENT_LOG_SEGMENT_BYTES,
+                 segment_s: float = EVENT_LOG_SEGMENT_S, flush_s: float = EVENT_LOG_FLUSH_S,
+                 batch: int = EVENT_LOG_BATCH, retention_s: float = EVENT_LOG_RETENTION_DAYS * 86400,
+                 max_bytes: int = EVENT_LOG_MAX_BYTES):
+        """
+        Args:
+            directory: Diretório dos segmentos (vazio desliga o log)
+            segment_bytes: Tamanho máximo de um segmento em bytes
+            segment_s: Idade máxima de um segmento em segundos
+            flush_s: Intervalo máximo entre gravações em segundos
+            batch: Eventos acumulados que antecipam a gravação
+            retention_s: Idade máxima dos segmentos em segundos (0: sem limite)
+            max_bytes: Tamanho total máximo dos segmentos do diretório (0: sem limite)
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_s = segment_s
+        self.flush_s = flush_s
+        self.batch = batch
+        self.retention_s = retention_s
+        self.max_bytes = max_bytes
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.Condition()
+        # Gravações em série (thread de gravação e encerramento do worker)
+        self._write_lock = threading.Lock()
+        self._file = None
+        self._file_pid: Optional[int] = None
+        self._file_opened_at = 0.0
+        self._flusher: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def _ensure_started(self) -> None:
+        # Thread criada sob demanda, também depois de um fork do Gunicorn
+        if self._flusher is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending.clear()
+        self._flusher = threading.Thread(target=self._run_flusher, name="event-log", daemon=True)
+        self._flusher.start()
+
+    def emit(self, kind: str, **fields: Any) -> None:
+        """
+        Registra um evento (sem I/O). O trace ativo, se houver, acompanha o evento.
+
+        Args:
+            kind: Tipo do evento (inbound, route, tool_call, send, stage, cache)
+            **fields: Campos do evento (valores serializáveis em JSON)
+        """
+        if not self.directory:
+            return
+        event = {"ts": time.time(), "kind": kind, "trace": tracing.current_trace_id()}
+        event.update(fields)
+        with self._lock:
+            self._ensure_started()
+            if len(self._pending) >= EVENT_LOG_MAX_PENDING:
+                metrics.EVENT_LOG_DROPPED.inc()
+                return
+            self._pending.append(event)
+            if len(self._pending) >= self.batch:
+                self._lock.notify()
+
+    def _run_flusher(self) -> None:
+        while True:
+            with self._lock:
+                self._lock.wait(self.flush_s)
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Grava os eventos acumulados como um bloco do segmento atual.
+
+        Returns:
+            Quantidade de eventos gravados
+        """
+        with self._lock:
+            events, self._pending = self._pending, []
+        if not events:
+            return 0
+        try:
+            with self._write_lock:
+                size = self._write(events)
+        except Exception as e:
+            metrics.record_error("event_log", e)
+            logger.error(f"Erro ao gravar {len(events)} eventos: {str(e)}")
+            return 0
+        metrics.EVENT_LOG_BYTES.inc(size)
+        return len(events)
+
+    def _segment(self):
+        # Um segmento por processo (os workers do Gunicorn gravam no mesmo diretório)
+        now = time.time()
+        if self._file is not None and self._file_pid == os.getpid() \
+                and self._file.tell() < self.segment_bytes and now - self._file_opened_at < self.segment_s:
+            return self._file
+        if self._file is not None and self._file_pid == os.getpid():
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"events-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}-{os.getpid()}.gev"
+        self._file = open(os.path.join(self.directory, name), "ab")
+        self._file_pid = os.getpid()
+        self._file_opened_at = now
+        if self._file.tell() == 0:
+            self._file.write(_FILE_MAGIC)
+        self.prune(now)
+        return self._file
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """
+        Apaga os segmentos mais antigos que a retenção e, se o diretório passar do
+        tamanho máximo, os mais antigos até caber. O segmento atual fica.
+
+        Args:
+            now: Timestamp de referência (padrão: agora)
+
+        Returns:
+            Quantidade de segmentos apagados
+        """
+        now = time.time() if now is None else now
+        current = self._file.name if self._file is not None else None
+        stats = []
+        for path in segments(self.directory):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in stats)
+        removed = 0
+        # Do mais antigo para o mais novo (os workers apagam os segmentos uns dos outros)
+        for mtime, size, path in sorted(stats):
+            expired = self.retention_s and now - mtime > self.retention_s
+            if path == current or not (expired or (self.max_bytes and total > self.max_bytes)):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                metrics.record_error("event_log", e)
+                logger.error(f"Erro ao apagar o segmento {path}: {str(e)}")
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"{removed} segmentos do log de eventos apagados pela retenção")
+        return removed
+
+    def _write(self, events: List[Dict[str, Any]]) -> int:
+        block = encode_block(events)
+        segment = self._segment()
+        segment.write(block)
+        segment.flush()
+        return len(block)
+
+
+def encode_block(events: Sequence[Dict[str, Any]]) -> bytes:
+    """
+    Codifica eventos como um bloco colunar.
+
+    Args:
+        events: Eventos com "ts" e "kind"
+
+    Returns:
+        Bloco pronto para ser anexado a um segmento
+    """
+    t0 = min(event["ts"] for event in events)
+    t1 = max(event["ts"] for event in events)
+    names: Dict[str, None] = {}
+    for event in events:
+        names.update(dict.fromkeys(event))
+    columns = []
+    for name in names:
+        if name == "ts":
+            # Milissegundos desde o início do bloco: inteiros pequenos comprimem melhor
+            values = [round((event["ts"] - t0) * 1000) for event in events]
+        else:
+            values = [event.get(name) for event in events]
+        columns.append((name, zlib.compress(json.dumps(values, ensure_ascii=False, separators=(",", ":"),
+                                                       default=str).encode("utf-8"))))
+    header = json.dumps({"n": len(events), "t0": t0, "t1": t1,
+                         "cols": [[name, len(data)] for name, data in columns]}).encode("utf-8")
+    return b"".join([_BLOCK_HEADER.pack(_BLOCK_MAGIC, len(header)), header] + [data for _, data in columns])
+
+
+def segments(directory: str = EVENT_LOG_DIR) -> List[str]:
+    """
+    Lista os segmentos do diretório em ordem cronológica.
+    """
+    return sorted(glob.glob(os.path.join(directory, _SEGMENT_GLOB)))
+
+
+def read_blocks(directory: str = EVENT_LOG_DIR, columns: Sequence[str] = ("ts", "kind"),
+                since: float = 0.0, until: Optional[float] = None) -> Iterator[Dict[str, list]]:
+    """
+    Lê os blocos dos segmentos, um por vez, decodificando só as colunas pedidas.
+    Blocos fora do intervalo de tempo são pulados sem leitura das colunas.
+
+    Args:
+        directory: Diretório dos segmentos
+        columns: Colunas desejadas (ausentes no bloco vêm como None)
+        since: Timestamp inicial
+        until: Timestamp final (padrão: sem limite)
+
+    Yields:
+        Dicionário coluna -> lista de valores de um bloco
+    """
+    for path in segments(directory):
+        with open(path, "rb") as f:
+            if f.read(len(_FILE_MAGIC)) != _FILE_MAGIC:
+                logger.warning(f"Segmento ignorado (formato desconhecido): {path}")
+                continue
+            while True:
+                raw = f.read(_BLOCK_HEADER.size)
+                if len(raw) < _BLOCK_HEADER.size:
+                    break
+                magic, header_len = _BLOCK_HEADER.unpack(raw)
+                try:
+                    if magic != _BLOCK_MAGIC:
+                        raise ValueError("marcador de bloco inválido")
+                    header = json.loads(f.read(header_len))
+                except ValueError:
+                    # Bloco incompleto no fim do segmento (processo encerrado durante a gravação)
+                    logger.warning(f"Segmento truncado: {path}")
+                    break
+                offset = f.tell()
+                sizes = dict(header["cols"])
+                end = offset + sum(sizes.values())
+                if header["t1"] < since or (until is not None and header["t0"] > until):
+                    f.seek(end)
+                    continue
+                block: Dict[str, list] = {}
+                position = offset
+                for name, size in header["cols"]:
+                    if name in columns:
+                        f.seek(position)
+                        data = f.read(size)
+                        if len(data) < size:
+                            break
+                        values = json.loads(zlib.decompress(data))
+                        if name == "ts":
+                            values = [header["t0"] + value / 1000 for value in values]
+                        block[name] = values
+                    position += size
+                f.seek(end)
+                for name in columns:
+                    if name not in block:
+                        block[name] = [None] * header["n"]
+                yield block
+
+
+def _rows(directory: str, columns: Sequence[str], since: float, until: Optional[float],
+          kinds: Optional[Sequence[str]]) -> Iterator[tuple]:
+    # Tuplas (ts, kind, *columns): as agregações evitam um dicionário por evento
+    columns = ["ts", "kind", *columns]
+    for block in read_blocks(directory, columns, since, until):
+        for row in zip(*(block[name] for name in columns)):
+            if row[0] < since or (until is not None and row[0] > until):
+                continue
+            if kinds is None or row[1] in kinds:
+                yield row
+
+
+def iter_events(directory: str = EVENT_LOG_DIR, columns: Sequence[str] = ("ts", "kind"),
+                since: float = 0.0, until: Optional[float] = None,
+                kinds: Optional[Sequence[str]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Percorre os eventos (só as colunas pedidas), bloco a bloco.
+
+    Args:
+        directory: Diretório dos segmentos
+        columns: Colunas desejadas
+        since: Timestamp inicial
+        until: Timestamp final (padrão: sem limite)
+        kinds: Tipos de evento desejados (padrão: todos)
+
+    Yields:
+        Um dicionário por evento
+    """
+    columns = [name for name in dict.fromkeys(columns) if name not in ("ts", "kind")]
+    names = ["ts", "kind", *columns]
+    for row in _rows(directory, columns, since, until, kinds):
+        yield dict(zip(names, row))
+
+
+class LogHistogram:
+    """
+    Histograma com baldes logarítmicos (erro relativo de ~2,5%) para percentis
+    sobre milhões de valores em memória constante.
+    """
+
+    _BASE = 1.05
+    _MIN = 1e-4
+
+    def __init__(self):
+        self.buckets: Counter = Counter()
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float) -> None:
+        index = 0 if value <= self._MIN else math.ceil(math.log(value / self._MIN, self._BASE))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Centro geométrico do balde
+                return self._MIN * self._BASE ** (index - 0.5) if index else self._MIN
+        return None
+
+
+def intent_mix(directory: str = EVENT_LOG_DIR, since: float = 0.0, tenant: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Mistura de intenções: rota do roteador e tipos de mensagem escolhidos pelo agente.
+    """
+    routes: Counter = Counter()
+    tools: Counter = Counter()
+    for _, kind, event_tenant, intent, route, type in _rows(directory, ("tenant", "intent", "route", "type"),
+                                                           since, None, ("route", "tool_call")):
+        if tenant and event_tenant != tenant:
+            continue
+        if kind == "route":
+            routes[(route, intent)] += 1
+        else:
+            tools[type] += 1
+    return {"routes": routes, "tools": tools}
+
+
+def cache_rates(directory: str = EVENT_LOG_DIR, since: float = 0.0, tenant: Optional[str] = None) -> Dict[str, Dict]:
+    """
+    Acertos e faltas por cache.
+    """
+    totals: Dict[str, Counter] = defaultdict(Counter)
+    for _, _, event_tenant, cache, hit in _rows(directory, ("tenant", "cache", "hit"), since, None, ("cache",)):
+        if tenant and event_tenant != tenant:
+            continue
+        totals[cache]["hit" if hit else "miss"] += 1
+    return {name: {"hits": counts["hit"], "misses": counts["miss"],
+                   "hit_rate": counts["hit"] / (counts["hit"] + counts["miss"])}
+            for name, counts in totals.items()}
+
+
+def stage_latencies(directory: str = EVENT_LOG_DIR, since: float = 0.0,
+                    tenant: Optional[str] = None) -> Dict[str, LogHistogram]:
+    """
+    Histograma da latência de cada etapa (eventos "stage" e envios).
+    """
+    histograms: Dict[str, LogHistogram] = defaultdict(LogHistogram)
+    for _, kind, event_tenant, stage, seconds in _rows(directory, ("tenant", "stage", "seconds"), since, None,
+                                                         ("stage", "send")):
+        if tenant and event_tenant != tenant:
+            continue
+        if seconds is not None:
+            histograms[stage or kind].add(seconds)
+    return histograms
+
+
+def usage_totals(directory: str = EVENT_LOG_DIR, since: float = 0.0, tenant: Optional[str] = None,
+                 by: str = "flow") -> Dict[str, Counter]:
+    """
+    Chamadas, tokens, custo e chamadas de ferramenta do modelo (eventos "usage"),
+    agregados por contato, fluxo ou dia.
+    """
+    totals: Dict[str, Counter] = defaultdict(Counter)
+    columns = ("tenant", "contact", "flow", "input_tokens", "output_tokens", "cost", "tool_calls")
+    for ts, _, event_tenant, contact, flow, input_tokens, output_tokens, cost, tool_calls in _rows(
+            directory, columns, since, None, ("usage",)):
+        if tenant and event_tenant != tenant:
+            continue
+        key = contact if by == "contact" else time.strftime("%Y-%m-%d", time.localtime(ts)) if by == "day" else flow
+        counts = totals[key or "-"]
+        counts["calls"] += 1
+        counts["input_tokens"] += input_tokens or 0
+        counts["output_tokens"] += output_tokens or 0
+        counts["cost"] += cost or 0.0
+        counts["tool_calls"] += tool_calls or 0
+    return totals
+
+
+# Log de eventos deste processo (o encerramento do worker do Gunicorn também grava o que restar)
+log = EventLog()
+atexit.register(log.flush)
+
+
+def emit(kind: str, **fields: Any) -> None:
+    """
+    Registra um evento no log do processo.
+    """
+    log.emit(kind, **fields)
+
+
+@contextmanager
+def timed(stage: str, **fields: Any):
+    """
+    Registra a duração do bloco como um evento "stage".
+
+    Args:
+        stage: Nome da etapa (ex: router, agent.llm)
+        **fields: Campos do evento (ex: tenant, contact)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        log.emit("stage", stage=stage, seconds=time.perf_counter() - start, **fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consultas ao log de eventos das conversas")
+    parser.add_argument("query", choices=["summary", "intents", "cache", "latency", "usage"])
+    parser.add_argument("--dir", default=EVENT_LOG_DIR or "events")
+    parser.add_argument("--hours", type=float, default=24, help="Janela da consulta em horas (0: tudo)")
+    parser.add_argument("--tenant", help="Clínica (padrão: todas)")
+    parser.add_argument("--by", choices=["flow", "contact", "day"], default="flow", help="Agrupamento da consulta usage")
+    parser.add_argument("--top", type=int, default=20, help="Linhas da consulta usage (maior custo primeiro)")
+    args = parser.parse_args()
+    since = time.time() - args.hours * 3600 if args.hours else 0.0
+
+    if args.query == "summary":
+        kinds: Counter = Counter()
+        for block in read_blocks(args.dir, ("kind", "tenant"), since):
+            kinds.update(kind for kind, tenant in zip(block["kind"], block["tenant"])
+                         if not args.tenant or tenant == args.tenant)
+        for kind, count in kinds.most_common():
+            print(f"{kind:<12} {count:>10}")
+        print(f"{'total':<12} {sum(kinds.values()):>10}")
+
+    elif args.query == "intents":
+        mix = intent_mix(args.dir, since, args.tenant)
+        total = sum(mix["routes"].values())
+        print("Roteador:")
+        for (route, intent), count in mix["routes"].most_common():
+            print(f"  {route or '-':<6} {intent or '-':<14} {count:>10} {count / total:>7.1%}")
+        total = sum(mix["tools"].values())
+        print("Mensagens enviadas pelo agente:")
+        for kind, count in mix["tools"].most_common():
+            print(f"  {kind or '-':<21} {count:>10} {count / total:>7.1%}")
+
+    elif args.query == "cache":
+        for name, rates in sorted(cache_rates(args.dir, since, args.tenant).items()):
+            print(f"{name:<12} {rates['hits']:>10} acertos {rates['misses']:>10} faltas "
+                  f"{rates['hit_rate']:>7.1%}")
+
+    elif args.query == "usage":
+        totals = usage_totals(args.dir, since, args.tenant, args.by)
+        rows = sorted(totals.items()) if args.by == "day" else \
+            sorted(totals.items(), key=lambda item: item[1]["cost"], reverse=True)[:args.top]
+        print(f"{args.by:<16} {'chamadas':>9} {'entrada':>12} {'saída':>10} {'ferram.':>8} {'USD':>10}")
+        for key, counts in rows:
+            print(f"{key:<16} {counts['calls']:>9} {counts['input_tokens']:>12} {counts['output_tokens']:>10} "
+                  f"{counts['tool_calls']:>8} {counts['cost']:>10.4f}")
+        print(f"{'total':<16} {sum(c['calls'] for c in totals.values()):>9} "
+              f"{sum(c['input_tokens'] for c in totals.values()):>12} "
+              f"{sum(c['output_tokens'] for c in totals.values()):>10} "
+              f"{sum(c['tool_calls'] for c in totals.values()):>8} {sum(c['cost'] for c in totals.values()):>10.4f}")
+
+    else:
+        print(f"{'etapa':<22} {'n':>9} {'média':>9} {'p50':>9} {'p90':>9} {'p99':>9}")
+        for stage, histogram in sorted(stage_latencies(args.dir, since, args.tenant).items()):
+            print(f"{stage:<22} {histogram.count:>9} {histogram.total / histogram.count:>8.3f}s "
+                  f"{histogram.percentile(50):>8.3f}s {histogram.percentile(90):>8.3f}s "
+                  f"{histogram.percentile(99):>8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
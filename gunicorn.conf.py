@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+
+# Configuração do Gunicorn (usada com: gunicorn -c gunicorn.conf.py app:app)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Carregar o app (e os SDKs pesados) uma vez no master; os workers herdam via fork
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# Diretório compartilhado onde cada worker grava suas métricas Prometheus.
+# Precisa existir antes de o app (e o prometheus_client) ser importado, o que
+# com preload_app acontece antes do hook on_starting.
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "gena_prometheus")
+)
+# Descartar métricas de execuções anteriores
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir, exist_ok=True)
+
+
+def when_ready(server):
+    # Executado no master antes de criar os workers
+    if preload_app:
+        import agent
+        timings = agent.preload()
+        server.log.info(f"SDKs pré-carregados em {sum(timings.values()):.2f}s")
+
+
+def post_worker_init(worker):
+    # kill -USR2 <pid do worker> grava um perfil de CPU do worker em PROFILE_DIR
+    import profiler
+    profiler.install_signal_handler()
+
+
+def child_exit(server, worker):
+    # Remover os gauges "live" do worker encerrado
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # Disparar os lotes de mensagens pendentes antes de encerrar o worker
+    import app
+    app.coalescer.drain()
+    app.delivery_status.store.flush()
+    app.event_log.log.flush()
@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Liga o hedging das chamadas ao Gemini (segunda requisição quando a primeira demora)
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "0") == "1"
+# Percentil do tempo até a primeira chamada de ferramenta usado como espera antes da segunda requisição
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+# Espera usada enquanto não há amostras suficientes
+HEDGE_DELAY_S = float(os.environ.get("HEDGE_DELAY_S", "3"))
+# Menor espera permitida (evita duplicar quase todas as chamadas quando o serviço está rápido)
+HEDGE_MIN_DELAY_S = float(os.environ.get("HEDGE_MIN_DELAY_S", "0.5"))
+# Fração máxima de requisições extras em relação às chamadas
+HEDGE_MAX_RATIO = float(os.environ.get("HEDGE_MAX_RATIO", "0.1"))
+# Amostras usadas no cálculo do percentil
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", "200"))
+HEDGE_MIN_SAMPLES = 20
+# Requisições extras que podem ser acumuladas para uma rajada de lentidão
+HEDGE_MAX_BURST = 10.0
+
+T = TypeVar("T")
+
+
+class Hedger:
+    """
+    Dispara uma segunda requisição idêntica quando a primeira não se compromete
+    (primeira chamada de ferramenta ou fim da resposta) dentro de um percentil
+    do tempo observado. A tentativa que se compromete primeiro é a vencedora e
+    as outras são canceladas. As requisições extras ficam limitadas a
+    HEDGE_MAX_RATIO das chamadas.
+    """
+
+    def __init__(self, name: str, percentile: float = HEDGE_PERCENTILE, max_ratio: float = HEDGE_MAX_RATIO):
+        """
+        Args:
+            name: Nome do serviço (label das métricas)
+            percentile: Percentil do tempo até o compromisso usado como espera
+            max_ratio: Fração máxima de requisições extras
+        """
+        self.name = name
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self._samples = deque(maxlen=HEDGE_WINDOW)
+        self._budget = HEDGE_MAX_BURST
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        """
+        Espera antes da segunda requisição, em segundos.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DELAY_S
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(HEDGE_MIN_DELAY_S, samples[index])
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def _deposit(self) -> None:
+        with self._lock:
+            self._budget = min(HEDGE_MAX_BURST, self._budget + self.max_ratio)
+
+    def _withdraw(self) -> bool:
+        with self._lock:
+            # Tolerância: dez depósitos de 0.1 somam 0.999...
+            if self._budget < 1 - 1e-9:
+                return False
+            self._budget -= 1
+            return True
+
+    async def run(self, attempt: Callable[[int, Callable[[], bool]], Awaitable[T]],
+                  delay: Optional[float] = None) -> T:
+        """
+        Executa attempt com hedging.
+
+        Args:
+            attempt: Corrotina attempt(index, commit). A tentativa chama commit() antes
+                do primeiro efeito colateral e ao terminar; se commit() retornar False,
+                outra tentativa venceu e esta deve parar sem efeitos
+            delay: Espera antes da segunda requisição (padrão: percentil observado)
+
+        Returns:
+            Resultado da tentativa vencedora
+        """
+        self._deposit()
+        start = time.monotonic()
+        winner = None
+        committed = asyncio.Event()
+
+        def commit_for(index: int) -> Callable[[], bool]:
+            def commit() -> bool:
+                nonlocal winner
+                if winner is None:
+                    winner = index
+                    committed.set()
+                    self.observe(time.monotonic() - start)
+                return winner == index
+            return commit
+
+        tasks = [asyncio.create_task(attempt(0, commit_for(0)))]
+        commit_wait = asyncio.create_task(committed.wait())
+        try:
+            delay = self.delay() if delay is None else delay
+            done, _ = await asyncio.wait([tasks[0], commit_wait], timeout=delay,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if self._withdraw():
+                    logger.info(f"Hedging '{self.name}': segunda requisição após {delay:.2f}s")
+                    metrics.HEDGE_REQUESTS.labels(name=self.name, outcome="fired").inc()
+                    tasks.append(asyncio.create_task(attempt(1, commit_for(1))))
+                else:
+                    metrics.HEDGE_REQUESTS.labels(name=self.name, outcome="budget_exhausted").inc()
+
+            # Uma tentativa que falha antes de se comprometer não encerra as outras
+            pending = set(tasks)
+            errors = []
+            while winner is None:
+                done, _ = await asyncio.wait([*pending, commit_wait], return_when=asyncio.FIRST_COMPLETED)
+                for task in done & pending:
+                    pending.discard(task)
+                    if winner is None and task.exception() is not None:
+                        errors.append(task.exception())
+                if winner is None and not pending:
+                    raise errors[0]
+
+            for index, task in enumerate(tasks):
+                if index != winner:
+                    task.cancel()
+            if len(tasks) > 1:
+                metrics.HEDGE_WINS.labels(name=self.name, winner="hedge" if winner else "primary").inc()
+            return await tasks[winner]
+        finally:
+            commit_wait.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, commit_wait, return_exceptions=True)
+
+
+# Hedging dos turnos do agente no Gemini
+gemini = Hedger("gemini")
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+import state
+import deadline
+import llm_backend
+import circuit_breaker
+import usage
+from tenants import Tenant
+
+logger = logging.getLogger(__name__)
+
+# Mensagens guardadas por conversa (as mais antigas já resumidas são descartadas)
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", "20"))
+HISTORY_TTL_S = float(os.environ.get("HISTORY_TTL_S", str(24 * 3600)))
+# Turnos recentes enviados ao agente na íntegra
+HISTORY_WINDOW_TURNS = int(os.environ.get("HISTORY_WINDOW_TURNS", "3"))
+# Turnos fora da janela acumulados antes de atualizar o resumo
+HISTORY_SUMMARY_BATCH = int(os.environ.get("HISTORY_SUMMARY_BATCH", "3"))
+# Tamanho máximo do resumo das mensagens antigas
+HISTORY_SUMMARY_MAX_CHARS = int(os.environ.get("HISTORY_SUMMARY_MAX_CHARS", "800"))
+HISTORY_SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL", "gemini-2.0-flash")
+HISTORY_SUMMARY_TIMEOUT_S = float(os.environ.get("HISTORY_SUMMARY_TIMEOUT_S", "20"))
+# Imagens lembradas no estado da conversa
+HISTORY_MAX_IMAGES = 5
+
+# Como cada fluxo fixo aparece no contexto do agente
+FLOW_LABELS = {
+    "welcome": "boas-vindas com o menu",
+    "calendario": "link de agendamento",
+    "procedimento": "lista de procedimentos",
+    "procedimentos": "lista de procedimentos",
+    "endereco": "localização da clínica",
+    "encerramento": "mensagem de encerramento",
+    "fallback": "menu de opções",
+}
+
+SUMMARY_PROMPT = """Atualize o resumo da conversa entre um contato e a secretária virtual de uma clínica de estética.
+Mantenha apenas o que importa para os próximos atendimentos: procedimentos de interesse, dúvidas já respondidas,
+preferências de horário e dados informados pelo contato. Responda só com o resumo, em português, com no máximo {max_chars} caracteres.
+
+RESUMO ATUAL:
+{summary}
+
+NOVAS MENSAGENS:
+{messages}"""
+
+# Resumos são gerados fora do caminho da resposta
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("HISTORY_WORKERS", "2")), thread_name_prefix="history")
+
+
+@dataclass
+class Conversation:
+    """Contexto de uma conversa: mensagens recentes, resumo das antigas e o que já foi enviado."""
+
+    entries: List[Dict[str, Any]] = field(default_factory=list)
+    summary: str = ""
+    # Turno (timestamp) da última mensagem incluída no resumo
+    summarized_upto: float = 0.0
+    # {"sent": [fluxos fixos já enviados], "images": [procedimentos cujas imagens foram enviadas]}
+    facts: Dict[str, Any] = field(default_factory=dict)
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """
+        Mensagens ainda não incluídas no resumo.
+        """
+        return [entry for entry in self.entries if entry.get("turn", 0) > self.summarized_upto]
+
+    def pending_turns(self) -> List[float]:
+        return sorted({entry.get("turn", 0) for entry in self.recent()})
+
+    def __bool__(self) -> bool:
+        return bool(self.entries or self.summary or self.facts)
+
+
+def _keys(tenant: Tenant, phone_number: str) -> Dict[str, str]:
+    suffix = f"{tenant.tenant_id}:{phone_number}"
+    return {"entries": f"hist:{suffix}", "summary": f"hist-summary:{suffix}",
+            "facts": f"hist-facts:{suffix}", "lock": f"hist-compact:{suffix}"}
+
+
+def load_conversation(tenant: Tenant, phone_number: str) -> Conversation:
+    """
+    Lê o contexto da conversa com o contato.
+
+    Returns:
+        Conversa (vazia se não houver histórico ou se o estado estiver indisponível)
+    """
+    keys = _keys(tenant, phone_number)
+    try:
+        backend = state.get_state()
+        summary_raw, facts_raw = backend.get_many([keys["summary"], keys["facts"]])
+        entries = [json.loads(item) for item in backend.get_list(keys["entries"])]
+    except Exception as e:
+        metrics.record_error("state", e)
+        logger.error(f"Erro ao ler o histórico de {phone_number}: {str(e)}")
+        return Conversation()
+    summary = json.loads(summary_raw) if summary_raw else {}
+    return Conversation(entries=entries, summary=summary.get("text", ""), summarized_upto=summary.get("upto", 0.0),
+                        facts=json.loads(facts_raw) if facts_raw else {})
+
+
+def _update_facts(facts: Dict[str, Any], tenant: Tenant, calls: List[Dict[str, Any]]) -> bool:
+    titles = {item.get("image"): item["title"] for item in tenant.catalog if item.get("image")}
+    sent, images = list(facts.get("sent", [])), list(facts.get("images", []))
+    for call in calls:
+        args = call["args"]
+        kind = str(args.get("type", "")).lower()
+        if kind in FLOW_LABELS and kind not in sent:
+            sent.append(kind)
+        elif kind == "image":
+            image = titles.get(args.get("image_url")) or (args.get("message") or "")[:60]
+            if image and image not in images:
+                images = (images + [image])[-HISTORY_MAX_IMAGES:]
+    changed = sent != facts.get("sent", []) or images != facts.get("images", [])
+    facts.update(sent=sent, images=images)
+    return changed
+
+
+def save_turn(tenant: Tenant, phone_number: str, message: str, result: llm_backend.AgentResult,
+              conversation: Optional[Conversation] = None) -> None:
+    """
+    Acrescenta ao histórico a mensagem do contato e as respostas em texto do agente.
+    Os fluxos fixos e as imagens enviadas entram no estado da conversa, e não no texto.
+
+    Args:
+        tenant: Clínica
+        phone_number: Número normalizado do contato
+        message: Mensagem do contato
+        result: Resultado do turno
+        conversation: Conversa lida no início do turno (None para ler aqui)
+    """
+    conversation = conversation if conversation is not None else load_conversation(tenant, phone_number)
+    calls = [call for call in result.function_calls if call["name"] == "send_message"]
+    replies = [call["args"]["message"] for call in calls
+               if str(call["args"].get("type", "")).lower() == "text" and call["args"].get("message")]
+    if result.text.strip():
+        replies.append(result.text.strip())
+    turn = time.time()
+    entries = [{"role": "user", "text": message, "turn": turn}]
+    if replies:
+        entries.append({"role": "assistant", "text": "\n".join(replies), "turn": turn})
+
+    keys = _keys(tenant, phone_number)
+    try:
+        backend = state.get_state()
+        backend.append(keys["entries"], [json.dumps(entry, ensure_ascii=False) for entry in entries],
+                       max_len=HISTORY_MAX_MESSAGES, ttl=HISTORY_TTL_S)
+        # O turno roda sob a concessão do contato: ler, alterar e gravar os fatos é seguro
+        if _update_facts(conversation.facts, tenant, calls):
+            backend.set_many({keys["facts"]: json.dumps(conversation.facts, ensure_ascii=False)}, ttl=HISTORY_TTL_S)
+    except Exception as e:
+        metrics.record_error("state", e)
+        logger.error(f"Erro ao gravar o histórico de {phone_number}: {str(e)}")
+        return
+
+    if len(conversation.pending_turns()) + 1 >= HISTORY_WINDOW_TURNS + HISTORY_SUMMARY_BATCH:
+        _executor.submit(compact, tenant, phone_number)
+
+
+def compact(tenant: Tenant, phone_number: str) -> bool:
+    """
+    Inclui no resumo os turnos que saíram da janela recente.
+
+    Returns:
+        True se o resumo foi atualizado
+    """
+    keys = _keys(tenant, phone_number)
+    owner = uuid.uuid4().hex
+    backend = state.get_state()
+    try:
+        # Um único resumo por conversa em andamento, em qualquer nó
+        if not backend.acquire(keys["lock"], owner, ttl=HISTORY_SUMMARY_TIMEOUT_S * 2):
+            return False
+    except Exception as e:
+        metrics.record_error("state", e)
+        return False
+    try:
+        conversation = load_conversation(tenant, phone_number)
+        turns = conversation.pending_turns()[:-HISTORY_WINDOW_TURNS or None]
+        if not turns:
+            return False
+        folded = [entry for entry in conversation.recent() if entry.get("turn", 0) <= turns[-1]]
+        # Roda fora do turno: o consumo do resumo é atribuído ao contato aqui
+        with usage.attributed(tenant.tenant_id, phone_number):
+            summary, source = summarize(conversation.summary, folded)
+        backend.set_many({keys["summary"]: json.dumps({"text": summary, "upto": turns[-1]}, ensure_ascii=False)},
+                         ttl=HISTORY_TTL_S)
+        metrics.HISTORY_COMPACTIONS.labels(source=source).inc()
+        logger.info(f"Resumo de {phone_number} atualizado com {len(turns)} turnos ({source})")
+        return True
+    except Exception as e:
+        metrics.record_error("history_compact", e)
+        logger.error(f"Erro ao resumir o histórico de {phone_number}: {str(e)}")
+        return False
+    finally:
+        try:
+            backend.release(keys["lock"], owner)
+        except Exception as e:
+            metrics.record_error("state", e)
+
+
+def _format_entries(entries: List[Dict[str, Any]]) -> str:
+    lines = []
+    for entry in entries:
+        who = "Paciente" if entry["role"] == "user" else "Atendente"
+        lines.append(f"{who}: {entry['text']}")
+    return "\n".join(lines)
+
+
+def summarize(previous: str, entries: List[Dict[str, Any]]) -> Tuple[str, str]:
+    """
+    Gera o novo resumo a partir do anterior e das mensagens que saíram da janela.
+    Sem o modelo (indisponível, modo sintético ou sem gravação), usa um resumo
+    extrativo local.
+
+    Returns:
+        Tupla (resumo, origem: "llm" ou "local")
+    """
+    prompt = SUMMARY_PROMPT.format(max_chars=HISTORY_SUMMARY_MAX_CHARS, summary=previous or "(vazio)",
+                                   messages=_format_entries(entries))
+    try:
+        text = llm_backend.get_backend().summarize(prompt, lambda: _summarize_live(prompt))
+    except Exception as e:
+        metrics.record_error("history_summary", e)
+        logger.warning(f"Resumo pelo modelo indisponível: {str(e)}")
+        text = None
+    if text and text.strip():
+        return text.strip()[:HISTORY_SUMMARY_MAX_CHARS], "llm"
+    return _local_summary(previous, entries), "local"
+
+
+def _local_summary(previous: str, entries: List[Dict[str, Any]]) -> str:
+    # Mensagens encurtadas; quando o limite é atingido, ficam as mais recentes
+    parts = [previous] if previous else []
+    parts += [f"{'Paciente' if entry['role'] == 'user' else 'Atendente'}: {entry['text'][:120]}" for entry in entries]
+    kept, size = [], 0
+    for part in reversed(parts):
+        size += len(part) + 3
+        if kept and size > HISTORY_SUMMARY_MAX_CHARS:
+            break
+        kept.append(part)
+    return " | ".join(reversed(kept))[-HISTORY_SUMMARY_MAX_CHARS:]
+
+
+def _summarize_live(prompt: str) -> Optional[str]:
+    try:
+        import google.generativeai as genai
+    except ImportError:
+        logger.error("Biblioteca google.generativeai não instalada. Instale com: pip install google-generativeai")
+        return None
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        logger.error("GEMINI_API_KEY não configurada")
+        return None
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(HISTORY_SUMMARY_MODEL)
+
+    def generate() -> str:
+        start = time.perf_counter()
+        response = model.generate_content(prompt)
+        metadata = getattr(response, "usage_metadata", None)
+        usage.record(usage.Usage("summary", HISTORY_SUMMARY_MODEL,
+                                 getattr(metadata, "prompt_token_count", 0) or 0,
+                                 getattr(metadata, "candidates_token_count", 0) or 0,
+                                 time.perf_counter() - start))
+        return response.text
+
+    # Disjuntor e threads próprios: um resumo lento não ocupa a vez dos atendimentos
+    return circuit_breaker.summary.call(deadline.call_with_timeout, generate, HISTORY_SUMMARY_TIMEOUT_S, "summary")
+
+
+def format_context(conversation: Conversation) -> str:
+    """
+    Monta o bloco de contexto enviado ao agente antes da nova mensagem.
+    """
+    blocks = []
+    if conversation.summary:
+        blocks.append(f"RESUMO DA CONVERSA ANTERIOR:\n{conversation.summary}")
+    sent = [FLOW_LABELS[kind] for kind in conversation.facts.get("sent", []) if kind in FLOW_LABELS]
+    images = conversation.facts.get("images", [])
+    if sent or images:
+        lines = []
+        if sent:
+            lines.append(", ".join(dict.fromkeys(sent)))
+        if images:
+            lines.append(f"imagens: {', '.join(images)}")
+        blocks.append("JÁ ENVIADO AO CONTATO:\n" + "\n".join(lines))
+    recent = conversation.recent()
+    if recent:
+        blocks.append(f"HISTÓRICO RECENTE:\n{_format_entries(recent)}")
+    return "\n\n".join(blocks)
@@ -0,0 +1,429 @@
+import os
+import re
+import json
+import math
+import time
+import logging
+import argparse
+import threading
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import metrics
+import event_log
+from utils import fold_text
+
+logger = logging.getLogger(__name__)
+
+# Liga o roteador (mensagens simples não passam pelo agente completo)
+INTENT_ROUTER = os.environ.get("INTENT_ROUTER", "1") == "1"
+# Confiança mínima para responder sem o agente
+INTENT_THRESHOLD = float(os.environ.get("INTENT_THRESHOLD", "0.9"))
+# Mensagens mais longas que isso sempre vão para o agente (perguntas livres)
+INTENT_MAX_WORDS = int(os.environ.get("INTENT_MAX_WORDS", "8"))
+# Modelo treinado (gerado com: python intent_router.py train ...); sem ele, usa os exemplos embutidos
+INTENT_MODEL_PATH = os.environ.get("INTENT_MODEL_PATH", "intent_model.json")
+# Vantagem mínima da intenção sobre a segunda colocada, medida palavra a palavra (de -1 a 1)
+INTENT_MIN_MARGIN = float(os.environ.get("INTENT_MIN_MARGIN", "0.6"))
+# Registra cada decisão no log de eventos (evento "routing"), para calibrar o limiar (desligado por padrão)
+INTENT_LOG = os.environ.get("INTENT_LOG", "0") == "1"
+# Inclui o texto do paciente no registro, necessário para treinar com o tráfego (desligado por padrão)
+INTENT_LOG_TEXT = os.environ.get("INTENT_LOG_TEXT", "0") == "1"
+
+# Fluxos fixos que podem ser respondidos sem o agente; AGENT = precisa do agente completo
+FIXED_INTENTS = ("WELCOME", "CALENDARIO", "PROCEDIMENTO", "ENDERECO", "FALLBACK", "ENCERRAMENTO")
+AGENT = "AGENT"
+
+SEED_EXAMPLES = [
+    ("oi", "WELCOME"), ("olá", "WELCOME"), ("ola boa tarde", "WELCOME"), ("bom dia", "WELCOME"),
+    ("boa noite", "WELCOME"), ("oi tudo bem", "WELCOME"), ("olá, tudo bem?", "WELCOME"), ("e aí", "WELCOME"),
+    ("oii", "WELCOME"), ("opa", "WELCOME"),
+    ("quero agendar", "CALENDARIO"), ("gostaria de marcar um horário", "CALENDARIO"), ("agendamentos", "CALENDARIO"),
+    ("tem horário disponível?", "CALENDARIO"), ("quero marcar uma consulta", "CALENDARIO"),
+    ("como faço para agendar", "CALENDARIO"), ("agenda", "CALENDARIO"), ("marcar avaliação", "CALENDARIO"),
+    ("procedimentos", "PROCEDIMENTO"), ("quais procedimentos vocês fazem?", "PROCEDIMENTO"),
+    ("quais tratamentos vocês tem", "PROCEDIMENTO"), ("ver opções", "PROCEDIMENTO"),
+    ("quero conhecer os procedimentos", "PROCEDIMENTO"), ("procedimento", "PROCEDIMENTO"), ("quais serviços", "PROCEDIMENTO"),
+    ("endereço", "ENDERECO"), ("agendamento", "CALENDARIO"), ("onde fica a clínica?", "ENDERECO"), ("qual o endereço", "ENDERECO"),
+    ("onde vocês ficam", "ENDERECO"), ("localização", "ENDERECO"), ("como chego aí", "ENDERECO"),
+    ("me manda a localização", "ENDERECO"),
+    ("obrigada", "ENCERRAMENTO"), ("obrigado", "ENCERRAMENTO"), ("tchau", "ENCERRAMENTO"),
+    ("valeu, até mais", "ENCERRAMENTO"), ("muito obrigada pela ajuda", "ENCERRAMENTO"), ("até logo", "ENCERRAMENTO"),
+    ("ok obrigada", "ENCERRAMENTO"),
+    ("asdf", "FALLBACK"), ("?", "FALLBACK"), ("kkkk", "FALLBACK"), ("hmm", "FALLBACK"),
+    ("quanto custa o botox?", AGENT), ("qual o valor da limpeza de pele", AGENT),
+    ("vocês aceitam cartão?", AGENT), ("o preenchimento labial dói?", AGENT),
+    ("quanto tempo dura o efeito do botox", AGENT), ("posso fazer peeling grávida?", AGENT),
+    ("qual a diferença entre peeling e limpeza de pele", AGENT), ("quem faz os procedimentos?", AGENT),
+    ("vocês parcelam?", AGENT), ("preciso remarcar minha consulta de amanhã", AGENT),
+    ("fiz botox semana passada e está inchado", AGENT), ("tem estacionamento?", AGENT),
+]
+
+_WORD = re.compile(r"\w+")
+# Fronteiras de oração: pontuação e quebras de linha (mensagens agrupadas chegam uma por linha)
+_CLAUSE = re.compile(r"[.,;:!?\n]+")
+
+
+def _words(text: str) -> List[str]:
+    return _WORD.findall(fold_text(text))
+
+
+def clauses(text: str) -> int:
+    """
+    Número de orações (trechos com palavras entre pontuações ou quebras de linha).
+    """
+    return sum(1 for part in _CLAUSE.split(text) if _WORD.search(part))
+
+
+def features(text: str) -> List[str]:
+    """
+    Palavras (sem acentos) e pares de palavras consecutivas.
+    """
+    words = _words(text)
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+
+class IntentClassifier:
+    """
+    Naive Bayes multinomial sobre palavras e bigramas, com uma tabela de frases
+    exatas (títulos dos botões, saudações curtas) que responde sem estimativa.
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self.class_counts: Counter = Counter()
+        self.feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        self.phrases: Dict[str, Counter] = defaultdict(Counter)
+        self.vocab: set = set()
+
+    def fit(self, examples: Iterable[Tuple[str, str]]) -> "IntentClassifier":
+        """
+        Treina com pares (texto, intenção).
+        """
+        for text, label in examples:
+            feats = features(text)
+            if not feats:
+                continue
+            self.class_counts[label] += 1
+            self.feature_counts[label].update(feats)
+            self.phrases[" ".join(_words(text))][label] += 1
+            self.vocab.update(feats)
+        self._totals = {label: sum(counts.values()) for label, counts in self.feature_counts.items()}
+        return self
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """
+        Classifica um texto.
+
+        Returns:
+            Tupla (intenção, probabilidade)
+        """
+        words = _words(text)
+        phrase = self.phrases.get(" ".join(words))
+        if phrase:
+            label, count = phrase.most_common(1)[0]
+            return label, count / sum(phrase.values())
+        feats = [f for f in features(text) if f in self.vocab]
+        # Nenhuma palavra conhecida: não há base para decidir sem o agente
+        if not feats:
+            return AGENT, 0.0
+        n = sum(self.class_counts.values())
+        vocab_size = len(self.vocab)
+        scores = {}
+        for label, count in self.class_counts.items():
+            denominator = self._totals[label] + self.alpha * vocab_size
+            counts = self.feature_counts[label]
+            score = math.log(count / n)
+            for feat in feats:
+                score += math.log((counts[feat] + self.alpha) / denominator)
+            scores[label] = score
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        # Palavras desconhecidas não entram no cálculo; a confiança cai na mesma proporção
+        coverage = sum(word in self.vocab for word in words) / len(words)
+        return best, coverage / total
+
+    def is_phrase(self, text: str) -> bool:
+        """
+        Indica se o texto é uma das frases exatas conhecidas (títulos dos botões, saudações).
+        """
+        return " ".join(_words(text)) in self.phrases
+
+    def margin(self, text: str, intent: str) -> float:
+        """
+        Vantagem da intenção sobre a segunda colocada, palavra a palavra. Cada palavra
+        conhecida vota na classe em que é mais provável, com peso igual à razão (log)
+        para a segunda classe. O Naive Bayes soma todas as evidências e fica confiante
+        demais numa mensagem com dois pedidos ("boa tarde, tudo bem? quero marcar" sai
+        WELCOME com 0,9999); aqui cada pedido aparece como votos de uma classe diferente.
+
+        Returns:
+            (votos da intenção - votos da maior outra classe) / soma dos dois, de -1 a 1
+        """
+        votes: Counter = Counter()
+        vocab_size = len(self.vocab)
+        for word in _words(text):
+            if word not in self.vocab:
+                continue
+            scores = sorted(
+                ((math.log((self.feature_counts[label][word] + self.alpha) / (self._totals[label] + self.alpha * vocab_size)),
+                  label) for label in self.class_counts),
+                reverse=True,
+            )
+            if len(scores) > 1:
+                votes[scores[0][1]] += scores[0][0] - scores[1][0]
+        own = votes.pop(intent, 0.0)
+        other = max(votes.values(), default=0.0)
+        return (own - other) / (own + other) if own + other > 0 else 0.0
+
+    def to_dict(self) -> Dict:
+        return {"alpha": self.alpha, "class_counts": dict(self.class_counts),
+                "feature_counts": {label: dict(counts) for label, counts in self.feature_counts.items()},
+                "phrases": {phrase: dict(counts) for phrase, counts in self.phrases.items()}}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "IntentClassifier":
+        model = cls(data.get("alpha", 0.1))
+        model.class_counts = Counter(data["class_counts"])
+        for phrase, counts in data.get("phrases", {}).items():
+            model.phrases[phrase] = Counter(counts)
+        for label, counts in data["feature_counts"].items():
+            model.feature_counts[label] = Counter(counts)
+            model.vocab.update(counts)
+        model._totals = {label: sum(counts.values()) for label, counts in model.feature_counts.items()}
+        return model
+
+
+@dataclass
+class Decision:
+    """Decisão do roteador para uma mensagem."""
+
+    text: str
+    intent: str
+    confidence: float
+    # True quando a mensagem é respondida sem o agente
+    local: bool
+    # Vantagem palavra a palavra sobre a segunda intenção (IntentClassifier.margin)
+    margin: float = 0.0
+    words: int = 0
+    clauses: int = 0
+    # Frase exata conhecida (dispensa as verificações de oração única e vantagem)
+    phrase: bool = False
+
+
+class IntentRouter:
+    """
+    Primeiro nível da cascata: responde na hora os fluxos fixos quando o
+    classificador tem confiança suficiente e manda o resto para o agente.
+
+    Só vai direto ao fluxo fixo uma mensagem curta com uma única oração em que a
+    intenção vence a segunda colocada com folga (ou uma frase exata conhecida). Um
+    lote agrupado com saudação e pedido ("oi\nquero marcar") vai ao agente, que
+    atende os dois.
+    """
+
+    def __init__(self, model_path: str = INTENT_MODEL_PATH, threshold: float = INTENT_THRESHOLD,
+                 max_words: int = INTENT_MAX_WORDS, min_margin: float = INTENT_MIN_MARGIN,
+                 local_intents: Iterable[str] = FIXED_INTENTS, log: bool = INTENT_LOG,
+                 log_text: bool = INTENT_LOG_TEXT):
+        self.model_path = model_path
+        self.threshold = threshold
+        self.max_words = max_words
+        self.min_margin = min_margin
+        self.log_enabled = log
+        self.log_text = log_text
+        # Fluxos respondidos sem o agente (ex: sem CALENDARIO quando o agente consulta a agenda)
+        self.local_intents = frozenset(local_intents)
+        self._model: Optional[IntentClassifier] = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> IntentClassifier:
+        # Carregado (ou treinado com os exemplos embutidos) na primeira mensagem
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    if self.model_path and os.path.exists(self.model_path):
+                        with open(self.model_path, encoding="utf-8") as f:
+                            self._model = IntentClassifier.from_dict(json.load(f))
+                        logger.info(f"Modelo de intenções carregado de {self.model_path}")
+                    else:
+                        self._model = IntentClassifier().fit(SEED_EXAMPLES)
+        return self._model
+
+    def route(self, text: str) -> Decision:
+        """
+        Decide se a mensagem pode ser respondida sem o agente.
+
+        Args:
+            text: Mensagem do contato (já agrupada)
+
+        Returns:
+            Decisão com a intenção e a confiança
+        """
+        model = self.model
+        intent, confidence = model.predict(text)
+        phrase = model.is_phrase(text)
+        decision = Decision(text, intent, round(confidence, 4), False,
+                            margin=1.0 if phrase else round(model.margin(text, intent), 4),
+                            words=len(_WORD.findall(text)), clauses=clauses(text), phrase=phrase)
+        decision.local = self.is_local(decision)
+        local = decision.local
+        route = "local" if local else "agent"
+        metrics.ROUTER_DECISIONS.labels(route=route, intent=intent).inc()
+        metrics.ROUTER_CONFIDENCE.observe(confidence)
+        logger.info(f"Roteamento: {route} intent={intent} confiança={confidence:.3f}")
+        return decision
+
+    def is_local(self, decision: Decision, threshold: Optional[float] = None) -> bool:
+        """
+        Indica se a decisão pode ser respondida sem o agente.
+
+        Args:
+            decision: Decisão (intenção, confiança e medidas do texto)
+            threshold: Confiança mínima (padrão: a do roteador)
+        """
+        return (
+            decision.intent in self.local_intents
+            and decision.confidence >= (self.threshold if threshold is None else threshold)
+            and decision.words <= self.max_words
+            and (decision.phrase or (decision.clauses == 1 and decision.margin >= self.min_margin))
+        )
+
+    def log(self, decision: Decision, agent_types: Optional[List[str]] = None, latency_s: float = 0.0) -> None:
+        """
+        Registra a decisão (e, quando o agente respondeu, o que ele escolheu) como evento
+        "routing" no log de eventos, para calibrar o limiar. O texto do paciente só entra
+        com log_text (INTENT_LOG_TEXT), necessário para treinar com o tráfego.
+
+        Args:
+            decision: Decisão do roteador
+            agent_types: Tipos de send_message escolhidos pelo agente
+            latency_s: Duração do turno
+        """
+        if not self.log_enabled:
+            return
+        fields = {"intent": decision.intent, "confidence": decision.confidence, "margin": decision.margin,
+                  "words": decision.words, "clauses": decision.clauses, "phrase": decision.phrase,
+                  "route": "local" if decision.local else "agent", "latency_s": round(latency_s, 3)}
+        if agent_types is not None:
+            fields["agent_types"] = agent_types
+        if self.log_text:
+            fields["text"] = decision.text
+        # Sem I/O aqui: o log de eventos grava em lote numa thread própria
+        event_log.emit("routing", **fields)
+
+
+def label_from_calls(types: List[str]) -> Optional[str]:
+    """
+    Converte as chamadas de send_message de um turno do agente num rótulo de treino.
+    """
+    types = [str(t).upper() for t in types]
+    if not types:
+        return None
+    # Texto livre ou imagem: a resposta dependeu do agente
+    if any(t in ("TEXT", "IMAGE") for t in types):
+        return AGENT
+    types = ["PROCEDIMENTO" if t == "PROCEDIMENTOS" else t for t in types]
+    return types[0] if len(set(types)) == 1 and types[0] in FIXED_INTENTS else AGENT
+
+
+def load_examples(paths: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    Lê exemplos rotulados dos cassetes gravados pelo llm_backend (modo record).
+    """
+    examples = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("kind") != "agent":
+                    continue
+                text = record.get("input", "")
+                types = [call.get("args", {}).get("type") for call in record.get("function_calls", [])
+                         if call.get("name") == "send_message"]
+                label = label_from_calls(types)
+                if text and label:
+                    examples.append((text, label))
+    return examples
+
+
+def logged_examples(directory: str = event_log.EVENT_LOG_DIR, since: float = 0.0) -> List[Tuple[str, str]]:
+    """
+    Lê exemplos rotulados dos eventos "routing" (turnos que foram ao agente). Só
+    existem com INTENT_LOG_TEXT ligado; sem o texto, o evento serve apenas para calibrar.
+    """
+    examples = []
+    for row in event_log.iter_events(directory, ("text", "agent_types"), since=since, kinds=("routing",)):
+        label = label_from_calls(row["agent_types"]) if row["agent_types"] is not None else None
+        if row["text"] and label:
+            examples.append((row["text"], label))
+    return examples
+
+
+def evaluate(directory: str, thresholds: Iterable[float], since: float = 0.0,
+             router: Optional["IntentRouter"] = None) -> List[Dict]:
+    """
+    Mede, para cada limiar, a fração de mensagens que seria respondida sem o
+    agente e a concordância com a escolha do agente nos turnos registrados
+    (eventos "routing"; usa as medidas gravadas, não precisa do texto).
+    """
+    router = router or IntentRouter(log=False)
+    columns = ("intent", "confidence", "margin", "words", "clauses", "phrase", "agent_types")
+    rows = []
+    for row in event_log.iter_events(directory, columns, since=since, kinds=("routing",)):
+        label = label_from_calls(row["agent_types"]) if row["agent_types"] is not None else None
+        if label:
+            rows.append((Decision("", row["intent"], row["confidence"] or 0.0, False, margin=row["margin"] or 0.0,
+                                  words=row["words"] or 0, clauses=row["clauses"] or 0,
+                                  phrase=bool(row["phrase"])), label))
+    report = []
+    for threshold in thresholds:
+        local = agree = 0
+        for decision, label in rows:
+            if router.is_local(decision, threshold):
+                local += 1
+                agree += decision.intent == label
+        report.append({"threshold": threshold, "local_fraction": round(local / len(rows), 3) if rows else 0.0,
+                       "agreement": round(agree / local, 3) if local else None, "turns": len(rows)})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classificador de intenções do primeiro nível da cascata")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train = sub.add_parser("train", help="Treina com os exemplos embutidos e o tráfego registrado")
+    train.add_argument("cassettes", nargs="*", help="Cassetes gravados (llm_cassettes.jsonl)")
+    train.add_argument("--events", help="Diretório do log de eventos (turnos registrados com INTENT_LOG_TEXT=1)")
+    train.add_argument("--out", default=INTENT_MODEL_PATH)
+    evaluate_cmd = sub.add_parser("evaluate", help="Fração local e concordância com o agente por limiar")
+    evaluate_cmd.add_argument("--events", default=event_log.EVENT_LOG_DIR or "events", help="Diretório do log de eventos")
+    evaluate_cmd.add_argument("--hours", type=float, default=0.0, help="Só as últimas N horas (0 = tudo)")
+    evaluate_cmd.add_argument("--thresholds", default="0.6,0.7,0.8,0.9,0.95,0.99")
+    predict = sub.add_parser("predict", help="Classifica um texto")
+    predict.add_argument("text")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        examples = SEED_EXAMPLES + load_examples(args.cassettes)
+        if args.events:
+            examples += logged_examples(args.events)
+        model = IntentClassifier().fit(examples)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(model.to_dict(), f, ensure_ascii=False)
+        print(f"{len(examples)} exemplos ({dict(Counter(label for _, label in examples))}) -> {args.out}")
+    elif args.command == "evaluate":
+        thresholds = [float(t) for t in args.thresholds.split(",")]
+        since = time.time() - args.hours * 3600 if args.hours else 0.0
+        for row in evaluate(args.events, thresholds, since=since):
+            print(json.dumps(row))
+    else:
+        router = IntentRouter(log=False)
+        print(router.route(args.text))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import os
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import logging
+import threading
+import itertools
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from utils import fold_text
+
+logger = logging.getLogger(__name__)
+
+# Modo do backend de modelo: live, record, replay ou synthetic
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "live").lower()
+# Arquivo JSON lines com as respostas gravadas (cassetes)
+LLM_CASSETTE_PATH = os.environ.get("LLM_CASSETTE_PATH", "llm_cassettes.jsonl")
+# Distribuição de latência simulada nos modos replay e synthetic:
+#   recorded            latência gravada no cassete (padrão)
+#   fixed:MS            latência constante
+#   uniform:MIN:MAX     uniforme entre MIN e MAX ms
+#   lognormal:P50:P99   log-normal com mediana e p99 em ms
+LLM_LATENCY = os.environ.get("LLM_LATENCY", "recorded")
+
+
+@dataclass
+class AgentResult:
+    """Resultado de um turno do agente."""
+
+    text: str = ""
+    # Chamadas de função emitidas pelo modelo: [{"name": ..., "args": {...}}]
+    function_calls: List[Dict[str, Any]] = field(default_factory=list)
+    # True quando as ferramentas já foram executadas pelo runner do ADK
+    tools_executed: bool = False
+    # Tokens do turno (somados entre as chamadas ao modelo), do usage_metadata do Gemini
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+    def add_usage(self, usage_metadata: Any) -> None:
+        """
+        Soma o usage_metadata de uma resposta do modelo (ignorado se ausente).
+        """
+        if usage_metadata is not None:
+            self.input_tokens += getattr(usage_metadata, "prompt_token_count", None) or 0
+            self.output_tokens += getattr(usage_metadata, "candidates_token_count", None) or 0
+
+
+def _key(kind: str, *parts: Any) -> str:
+    digest = hashlib.sha256(kind.encode("utf-8"))
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class LatencyModel:
+    """Sorteia latências simuladas a partir da especificação em LLM_LATENCY."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        name, _, params = spec.partition(":")
+        self.name = name
+        self.params = [float(p) for p in params.split(":") if p]
+        if name == "lognormal":
+            median, p99 = self.params
+            # z(0.99) = 2.326
+            self._mu = math.log(median)
+            self._sigma = math.log(p99 / median) / 2.326 if p99 > median else 0.0
+        elif name not in ("recorded", "fixed", "uniform"):
+            raise ValueError(f"Distribuição de latência desconhecida: {spec}")
+
+    def sample_ms(self, recorded_ms: float = 0.0) -> float:
+        if self.name == "recorded":
+            return recorded_ms
+        if self.name == "fixed":
+            return self.params[0]
+        if self.name == "uniform":
+            return random.uniform(self.params[0], self.params[1])
+        return random.lognormvariate(self._mu, self._sigma)
+
+    def sleep(self, recorded_ms: float = 0.0) -> None:
+        delay = self.sample_ms(recorded_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+
+class LiveBackend:
+    """Chama o Gemini de verdade."""
+
+    mode = "live"
+    # False nos backends que respondem sem o Gemini (o agente do ADK nem é criado)
+    calls_model = True
+
+    def run_agent(self, agent_name: str, message_text: str,
+                  live_call: Callable[[], AgentResult]) -> AgentResult:
+        """
+        Executa um turno do agente.
+
+        Args:
+            agent_name: Nome do agente
+            message_text: Mensagem do usuário
+            live_call: Função que executa o turno no Gemini
+
+        Returns:
+            Resultado do turno
+        """
+        return live_call()
+
+    def transcribe(self, audio_data: bytes, live_call: Callable[[], Optional[str]]) -> Optional[str]:
+        """
+        Transcreve um áudio.
+
+        Args:
+            audio_data: Conteúdo do áudio convertido
+            live_call: Função que transcreve o áudio no Gemini
+
+        Returns:
+            Texto transcrito
+        """
+        return live_call()
+
+    def summarize(self, prompt: str, live_call: Callable[[], Optional[str]]) -> Optional[str]:
+        """
+        Resume mensagens antigas de uma conversa.
+
+        Args:
+            prompt: Instruções com o resumo atual e as mensagens a incluir
+            live_call: Função que gera o resumo no Gemini
+
+        Returns:
+            Resumo (None para usar o resumo local)
+        """
+        return live_call()
+
+
+class RecordingBackend(LiveBackend):
+    """Chama o Gemini e grava cada resposta (com as chamadas de função) em cassete."""
+
+    mode = "record"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def run_agent(self, agent_name, message_text, live_call):
+        start = time.perf_counter()
+        result = live_call()
+        self._write({
+            "kind": "agent",
+            "key": _key("agent", agent_name, message_text),
+            "input": message_text,
+            "text": result.text,
+            "function_calls": result.function_calls,
+            "input_tokens": result.input_tokens,
+            "output_tokens": result.output_tokens,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+        })
+        return result
+
+    def transcribe(self, audio_data, live_call):
+        start = time.perf_counter()
+        text = live_call()
+        if text is not None:
+            self._write({
+                "kind": "transcription",
+                "key": _key("transcription", audio_data),
+                "audio_bytes": len(audio_data),
+                "text": text,
+                "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            })
+        return text
+
+    def summarize(self, prompt, live_call):
+        start = time.perf_counter()
+        text = live_call()
+        if text is not None:
+            self._write({
+                "kind": "summary",
+                "key": _key("summary", prompt),
+                "text": text,
+                "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            })
+        return text
+
+
+class ReplayBackend(LiveBackend):
+    """
+    Serve respostas gravadas, sem rede. Entradas sem gravação exata recebem,
+    em rodízio, outra resposta gravada do mesmo tipo.
+    """
+
+    mode = "replay"
+    calls_model = False
+
+    def __init__(self, path: str, latency: LatencyModel):
+        self.latency = latency
+        self._by_key: Dict[str, Dict[str, Any]] = {}
+        by_kind: Dict[str, List[Dict[str, Any]]] = {"agent": [], "transcription": []}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                self._by_key[record["key"]] = record
+                by_kind.setdefault(record["kind"], []).append(record)
+        self._cycle = {kind: itertools.cycle(records) for kind, records in by_kind.items() if records}
+        self._lock = threading.Lock()
+        logger.info(f"{len(self._by_key)} respostas carregadas de {path}")
+
+    def _lookup(self, kind: str, key: str) -> Dict[str, Any]:
+        record = self._by_key.get(key)
+        if record is None:
+            if kind not in self._cycle:
+                raise LookupError(f"Nenhuma resposta do tipo '{kind}' gravada no cassete")
+            with self._lock:
+                record = next(self._cycle[kind])
+        return record
+
+    def run_agent(self, agent_name, message_text, live_call):
+        record = self._lookup("agent", _key("agent", agent_name, message_text))
+        self.latency.sleep(record.get("latency_ms", 0.0))
+        return AgentResult(
+            text=record.get("text", ""),
+            function_calls=[dict(call, args=dict(call.get("args", {}))) for call in record.get("function_calls", [])],
+            input_tokens=record.get("input_tokens", 0),
+            output_tokens=record.get("output_tokens", 0),
+        )
+
+    def transcribe(self, audio_data, live_call):
+        record = self._lookup("transcription", _key("transcription", audio_data))
+        self.latency.sleep(record.get("latency_ms", 0.0))
+        return record.get("text")
+
+    def summarize(self, prompt, live_call):
+        record = self._by_key.get(_key("summary", prompt))
+        # Resumos não gravados não são trocados por outro: o chamador usa o resumo local
+        return record.get("text") if record else None
+
+
+class SyntheticBackend(LiveBackend):
+    """Gera chamadas plausíveis de send_message a partir de palavras-chave, sem modelo."""
+
+    mode = "synthetic"
+    calls_model = False
+
+    RULES = [
+        (re.compile(r"\b(agend|marcar|horario|disponib|agenda)"), "CALENDARIO"),
+        (re.compile(r"\b(endereco|onde fica|localiza|como chego|mapa)"), "ENDERECO"),
+        (re.compile(r"\b(procediment|tratament|servico|opcoes)"), "PROCEDIMENTO"),
+        (re.compile(r"\b(obrigad|tchau|ate mais|ate logo|valeu)"), "ENCERRAMENTO"),
+        (re.compile(r"^\s*(oi|ola|bom dia|boa tarde|boa noite|e ai)\b"), "WELCOME"),
+        (re.compile(r"\b(preco|valor|quanto custa|custa|pagamento|cartao|pix)"), "text"),
+    ]
+
+    # Tokens aproximados das instruções do agente
+    PROMPT_TOKENS = 1500
+
+    TRANSCRIPTIONS = [
+        "Oi, tudo bem? Queria saber o valor do botox.",
+        "Bom dia, vocês têm horário para limpeza de pele essa semana?",
+        "Onde fica a clínica?",
+        "Quais procedimentos vocês fazem?",
+    ]
+
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+
+    def run_agent(self, agent_name, message_text, live_call):
+        self.latency.sleep()
+        folded = fold_text(message_text)
+        message_type = "FALLBACK"
+        for pattern, candidate in self.RULES:
+            if pattern.search(folded):
+                message_type = candidate
+                break
+        args: Dict[str, Any] = {"type": message_type}
+        if message_type == "text":
+            args["message"] = "Os valores dos procedimentos variam de R$ 180,00 a R$ 950,00 😊 Quer ver a lista completa?"
+        # Tokens estimados (caracteres / 4, mais as instruções), para exercitar a contabilidade
+        return AgentResult(function_calls=[{"name": "send_message", "args": args}],
+                           input_tokens=self.PROMPT_TOKENS + len(message_text) // 4,
+                           output_tokens=len(args.get("message", "")) // 4 + 10)
+
+    def transcribe(self, audio_data, live_call):
+        self.latency.sleep()
+        return random.choice(self.TRANSCRIPTIONS)
+
+    def summarize(self, prompt, live_call):
+        # Sem modelo: o chamador usa o resumo local
+        return None
+
+
+_backend: Optional[LiveBackend] = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(mode: str = LLM_BACKEND, cassette_path: str = LLM_CASSETTE_PATH,
+                   latency: str = LLM_LATENCY) -> LiveBackend:
+    """
+    Cria o backend de modelo para o modo informado.
+
+    Args:
+        mode: live, record, replay ou synthetic
+        cassette_path: Arquivo de cassetes (modos record e replay)
+        latency: Especificação da latência simulada (modos replay e synthetic)
+
+    Returns:
+        Backend configurado
+    """
+    if mode == "live":
+        return LiveBackend()
+    if mode == "record":
+        return RecordingBackend(cassette_path)
+    if mode == "replay":
+        return ReplayBackend(cassette_path, LatencyModel(latency))
+    if mode == "synthetic":
+        return SyntheticBackend(LatencyModel(latency))
+    raise ValueError(f"Modo de LLM_BACKEND desconhecido: {mode}")
+
+
+def get_backend() -> LiveBackend:
+    """
+    Retorna o backend de modelo do processo (criado a partir das variáveis de ambiente).
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+                logger.info(f"Backend de modelo: {_backend.mode}")
+    return _backend
+
+
+def set_backend(backend: LiveBackend) -> None:
+    """
+    Substitui o backend do processo (útil em benchmarks executados no mesmo processo).
+
+    Args:
+        backend: Novo backend
+    """
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,320 @@
+import math
+import time
+import json
+import random
+import logging
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from mock_graph_api import MockGraphAPI
+
+logger = logging.getLogger("loadtest")
+
+PHONE_NUMBER_ID = "123456789012345"
+
+SAMPLE_TEXTS = [
+    "Oi",
+    "Tudo bem?",
+    "Quanto custa o botox?",
+    "Quais procedimentos vocês fazem?",
+    "Onde fica a clínica?",
+    "Quero agendar uma limpeza de pele",
+    "Vocês aceitam cartão?",
+    "Obrigada, até mais!",
+]
+
+BUTTON_REPLIES = [
+    ("btn_endereco", "Endereço"),
+    ("btn_agendamento", "Agendamentos"),
+    ("btn_procedimentos", "Procedimentos"),
+]
+
+DEFAULT_MIX = "text=60,audio=10,interactive=15,status=10,multi=5"
+
+_contact_seq = itertools.count(1)
+_message_seq = itertools.count(1)
+
+
+# ===== PAYLOADS DO WEBHOOK =====
+
+def _new_contact() -> str:
+    # Um contato novo por requisição permite casar o envio com a primeira resposta
+    return f"55489{next(_contact_seq):08d}"
+
+
+def _message_id() -> str:
+    return f"wamid.LOADTEST{next(_message_seq):012d}"
+
+
+def _envelope(values: List[Dict[str, Any]], entries: int = 1) -> Dict[str, Any]:
+    per_entry = max(1, len(values) // entries)
+    entry_list = []
+    for i in range(0, len(values), per_entry):
+        entry_list.append({
+            "id": "WHATSAPP_BUSINESS_ACCOUNT_ID",
+            "changes": [{"field": "messages", "value": value} for value in values[i:i + per_entry]],
+        })
+    return {"object": "whatsapp_business_account", "entry": entry_list}
+
+
+def _message_value(contact: str, message: Dict[str, Any]) -> Dict[str, Any]:
+    message.setdefault("from", contact)
+    message.setdefault("id", _message_id())
+    message.setdefault("timestamp", str(int(time.time())))
+    return {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "554891234567", "phone_number_id": PHONE_NUMBER_ID},
+        "contacts": [{"profile": {"name": "Paciente Teste"}, "wa_id": contact}],
+        "messages": [message],
+    }
+
+
+def text_payload() -> Tuple[Dict[str, Any], List[str]]:
+    contact = _new_contact()
+    value = _message_value(contact, {"type": "text", "text": {"body": random.choice(SAMPLE_TEXTS)}})
+    return _envelope([value]), [contact]
+
+
+def audio_payload() -> Tuple[Dict[str, Any], List[str]]:
+    contact = _new_contact()
+    value = _message_value(contact, {
+        "type": "audio",
+        "audio": {"mime_type": "audio/ogg; codecs=opus", "id": f"MEDIA{next(_message_seq)}", "voice": True},
+    })
+    return _envelope([value]), [contact]
+
+
+def interactive_payload() -> Tuple[Dict[str, Any], List[str]]:
+    contact = _new_contact()
+    button_id, title = random.choice(BUTTON_REPLIES)
+    value = _message_value(contact, {
+        "type": "interactive",
+        "interactive": {"type": "button_reply", "button_reply": {"id": button_id, "title": title}},
+    })
+    return _envelope([value]), [contact]
+
+
+def status_payload() -> Tuple[Dict[str, Any], List[str]]:
+    contact = _new_contact()
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "554891234567", "phone_number_id": PHONE_NUMBER_ID},
+        "statuses": [{
+            "id": _message_id(),
+            "status": random.choice(["sent", "delivered", "read"]),
+            "timestamp": str(int(time.time())),
+            "recipient_id": contact,
+        }],
+    }
+    # Status não gera resposta: não há contato a esperar
+    return _envelope([value]), []
+
+
+def multi_entry_payload() -> Tuple[Dict[str, Any], List[str]]:
+    contacts = [_new_contact(), _new_contact()]
+    values = [
+        _message_value(contact, {"type": "text", "text": {"body": random.choice(SAMPLE_TEXTS)}})
+        for contact in contacts
+    ]
+    return _envelope(values, entries=2), contacts
+
+
+PAYLOAD_BUILDERS: Dict[str, Callable[[], Tuple[Dict[str, Any], List[str]]]] = {
+    "text": text_payload,
+    "audio": audio_payload,
+    "interactive": interactive_payload,
+    "status": status_payload,
+    "multi": multi_entry_payload,
+}
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    """
+    Converte uma string "text=60,audio=10" em pesos por tipo de payload.
+
+    Args:
+        mix: Pesos no formato tipo=peso separados por vírgula
+
+    Returns:
+        Lista de (tipo, peso)
+    """
+    weights = []
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in PAYLOAD_BUILDERS:
+            raise ValueError(f"Tipo de payload desconhecido: {kind}")
+        weights.append((kind, float(weight or 1)))
+    return weights
+
+
+# ===== EXECUÇÃO =====
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """
+    Percentil pelo método nearest-rank.
+
+    Args:
+        values: Amostras
+        pct: Percentil desejado (0-100)
+
+    Returns:
+        Valor do percentil ou None sem amostras
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LoadTest:
+    """Gera carga de webhooks em taxa constante (open loop) e mede as respostas."""
+
+    def __init__(self, target: str, rate: float, duration: float, mix: List[Tuple[str, float]],
+                 mock: Optional[MockGraphAPI], concurrency: int = 64, reply_timeout: float = 30.0):
+        self.target = target
+        self.rate = rate
+        self.duration = duration
+        self.kinds = [kind for kind, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.mock = mock
+        self.concurrency = concurrency
+        self.reply_timeout = reply_timeout
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self.http_latencies: List[float] = []
+        self.http_errors: Dict[str, int] = {}
+        self.sent_by_kind: Dict[str, int] = {kind: 0 for kind in self.kinds}
+        # contato -> horário de envio do webhook
+        self.pending_replies: Dict[str, float] = {}
+
+    def _fire(self, kind: str) -> None:
+        payload, contacts = PAYLOAD_BUILDERS[kind]()
+        body = json.dumps(payload)
+        start = time.time()
+        for contact in contacts:
+            with self._lock:
+                self.pending_replies[contact] = start
+        try:
+            response = self.session.post(self.target, data=body,
+                                         headers={"Content-Type": "application/json"}, timeout=60)
+            elapsed = time.time() - start
+            with self._lock:
+                self.http_latencies.append(elapsed)
+                if response.status_code >= 400:
+                    key = f"HTTP {response.status_code}"
+                    self.http_errors[key] = self.http_errors.get(key, 0) + 1
+        except requests.exceptions.RequestException as e:
+            with self._lock:
+                key = type(e).__name__
+                self.http_errors[key] = self.http_errors.get(key, 0) + 1
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Executa o teste e retorna o relatório.
+        """
+        total = int(self.rate * self.duration)
+        interval = 1.0 / self.rate
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i in range(total):
+                # Agenda cada envio no seu horário, independente das respostas (open loop)
+                delay = started + i * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                kind = random.choices(self.kinds, self.weights)[0]
+                self.sent_by_kind[kind] += 1
+                executor.submit(self._fire, kind)
+        send_elapsed = time.time() - started
+
+        e2e = self._wait_replies()
+        return self._report(total, send_elapsed, e2e)
+
+    def _wait_replies(self) -> List[float]:
+        if not self.mock:
+            return []
+        deadline = time.time() + self.reply_timeout
+        while time.time() < deadline:
+            with self.mock._lock:
+                missing = [c for c in self.pending_replies if c not in self.mock.first_reply_at]
+            if not missing:
+                break
+            time.sleep(0.2)
+        with self.mock._lock:
+            return [self.mock.first_reply_at[c] - sent_at
+                    for c, sent_at in self.pending_replies.items() if c in self.mock.first_reply_at]
+
+    def _report(self, total: int, send_elapsed: float, e2e: List[float]) -> Dict[str, Any]:
+        def summary(values: List[float]) -> Dict[str, Optional[float]]:
+            return {f"p{p}_ms": (round(percentile(values, p) * 1000, 1) if values else None)
+                    for p in (50, 95, 99)}
+
+        errors = sum(self.http_errors.values())
+        report = {
+            "requests": total,
+            "by_kind": self.sent_by_kind,
+            "throughput_rps": round(len(self.http_latencies) / send_elapsed, 2) if send_elapsed else 0,
+            "http_latency": summary(self.http_latencies),
+            "http_errors": self.http_errors,
+            "http_error_rate": round(errors / total, 4) if total else 0,
+        }
+        if self.mock:
+            expected = len(self.pending_replies)
+            report["e2e_latency"] = summary(e2e)
+            report["replies_received"] = len(e2e)
+            report["replies_missing_rate"] = round(1 - len(e2e) / expected, 4) if expected else 0
+            report["graph_api"] = self.mock.stats()
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga offline do webhook")
+    parser.add_argument("--target", default="http://127.0.0.1:5000/webhook", help="URL do webhook em teste")
+    parser.add_argument("--rate", type=float, default=20.0, help="Requisições por segundo")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duração em segundos")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Pesos por tipo de payload (padrão: {DEFAULT_MIX})")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--reply-timeout", type=float, default=30.0,
+                        help="Tempo máximo de espera pelas respostas após o último envio")
+    parser.add_argument("--no-mock", action="store_true", help="Não iniciar a Graph API simulada")
+    parser.add_argument("--mock-port", type=int, default=8081)
+    parser.add_argument("--mock-latency-ms", type=float, default=80.0)
+    parser.add_argument("--mock-jitter-ms", type=float, default=40.0)
+    parser.add_argument("--mock-rate-429", type=float, default=0.0)
+    parser.add_argument("--mock-media-file", help="Arquivo de áudio servido nos downloads de mídia")
+    parser.add_argument("--seed", type=int, help="Semente para reprodutibilidade")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    mock = None
+    if not args.no_mock:
+        mock = MockGraphAPI(port=args.mock_port, latency_ms=args.mock_latency_ms,
+                            jitter_ms=args.mock_jitter_ms, rate_429=args.mock_rate_429,
+                            media_file=args.mock_media_file).start()
+        logger.info(f"Inicie o app com WHATSAPP_GRAPH_URL={mock.url}")
+
+    test = LoadTest(args.target, args.rate, args.duration, parse_mix(args.mix), mock,
+                    concurrency=args.concurrency, reply_timeout=args.reply_timeout)
+    report = test.run()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if mock:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, Optional
+
+import metrics
+import event_log
+import state
+
+if TYPE_CHECKING:
+    from whatsapp_client import WhatsAppClient
+
+logger = logging.getLogger(__name__)
+
+# Envia imagens pelo ID de mídia (upload único) em vez do link externo
+MEDIA_CACHE_ENABLED = os.environ.get("MEDIA_CACHE_ENABLED", "1") == "1"
+# IDs de mídia enviados por upload valem 30 dias na Cloud API
+MEDIA_ID_TTL_S = float(os.environ.get("MEDIA_ID_TTL_S", str(30 * 24 * 3600)))
+# Antecedência com que um ID é renovado (em segundo plano) antes de expirar
+MEDIA_REFRESH_BEFORE_S = float(os.environ.get("MEDIA_REFRESH_BEFORE_S", str(3 * 24 * 3600)))
+# Tamanho máximo aceito para imagens (limite do WhatsApp: 5 MB)
+MEDIA_MAX_BYTES = 5 * 1024 * 1024
+# Depois de uma falha no download ou no upload, a imagem vai pelo link durante esse tempo
+MEDIA_FAILURE_TTL_S = float(os.environ.get("MEDIA_FAILURE_TTL_S", "300"))
+
+
+class MediaCache:
+    """
+    Faz o upload de cada imagem uma única vez para o endpoint /media do número
+    e guarda o ID retornado (com a validade) no backend de estado, para que
+    todos os workers e nós reutilizem o mesmo ID.
+
+    Só as imagens do catálogo da clínica (set_catalog) passam por aqui: qualquer
+    outra URL emitida pelo modelo vai pelo link, e quem a baixa é a Meta, nunca
+    este servidor.
+    """
+
+    def __init__(self, client: "WhatsAppClient", ttl: float = MEDIA_ID_TTL_S,
+                 refresh_before: float = MEDIA_REFRESH_BEFORE_S, failure_ttl: float = MEDIA_FAILURE_TTL_S):
+        """
+        Args:
+            client: Cliente WhatsApp do número dono das mídias
+            ttl: Validade de um ID de mídia em segundos
+            refresh_before: Antecedência da renovação em segundos
+            failure_ttl: Tempo em que uma imagem que falhou vai direto pelo link
+        """
+        self.client = client
+        self.ttl = ttl
+        self.refresh_before = refresh_before
+        self.failure_ttl = failure_ttl
+        # Imagens do catálogo (as únicas enviadas por upload); uma trava por imagem
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._refreshing: set = set()
+        # Imagem -> instante (monotonic) até o qual a falha vale
+        self._failures: Dict[str, float] = {}
+
+    def _key(self, url: str) -> str:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        return f"media:{self.client.phone_number_id}:{digest}"
+
+    def set_catalog(self, urls: Iterable[str]) -> None:
+        """
+        Define as imagens do catálogo (substitui as anteriores) e faz o upload das
+        novas em segundo plano.
+        """
+        urls = [url for url in dict.fromkeys(urls) if url]
+        with self._locks_lock:
+            self._locks = {url: self._locks.get(url) or threading.Lock() for url in urls}
+            self._failures = {url: until for url, until in self._failures.items() if url in self._locks}
+        self.warm_async(urls)
+
+    def _lock_for(self, url: str) -> Optional[threading.Lock]:
+        with self._locks_lock:
+            return self._locks.get(url)
+
+    def _failed_recently(self, url: str) -> bool:
+        until = self._failures.get(url)
+        return until is not None and time.monotonic() < until
+
+    def get_media_id(self, url: str) -> Optional[str]:
+        """
+        Retorna o ID de mídia da imagem, fazendo o upload na primeira vez.
+
+        Args:
+            url: URL pública da imagem
+
+        Returns:
+            ID de mídia ou None (imagem fora do catálogo, ou falha recente): o chamador usa o link
+        """
+        lock = self._lock_for(url)
+        if lock is None:
+            return None
+        entry = self._read(url)
+        if entry is not None:
+            event_log.emit("cache", cache="media", hit=True, phone_number_id=self.client.phone_number_id)
+            if entry["expires_at"] - time.time() < self.refresh_before:
+                self._refresh_async(url)
+            return entry["id"]
+        if self._failed_recently(url):
+            return None
+        # Uma única thread faz o upload de cada URL; as outras aguardam e reutilizam o ID
+        with lock:
+            entry = self._read(url)
+            event_log.emit("cache", cache="media", hit=entry is not None,
+                           phone_number_id=self.client.phone_number_id)
+            if entry is not None:
+                return entry["id"]
+            # Quem esperava a trava não repete um upload que acabou de falhar
+            if self._failed_recently(url):
+                return None
+            return self._upload(url)
+
+    def invalidate(self, url: str) -> None:
+        """
+        Descarta o ID de uma imagem (ex: rejeitado pela API).
+        """
+        try:
+            state.get_state().delete([self._key(url)])
+        except Exception as e:
+            metrics.record_error("state", e)
+
+    def warm(self, urls: Iterable[str]) -> None:
+        """
+        Faz o upload das imagens do catálogo que ainda não estão em cache.
+        """
+        for url in urls:
+            self.get_media_id(url)
+
+    def warm_async(self, urls: Iterable[str]) -> None:
+        """
+        Igual a warm, numa thread em segundo plano.
+        """
+        urls = [url for url in urls if url]
+        if urls:
+            threading.Thread(target=self.warm, args=(urls,), name="media-warm", daemon=True).start()
+
+    def _read(self, url: str) -> Optional[Dict]:
+        try:
+            raw = state.get_state().get_many([self._key(url)])[0]
+        except Exception as e:
+            metrics.record_error("state", e)
+            return None
+        return json.loads(raw) if raw else None
+
+    def _refresh_async(self, url: str) -> None:
+        with self._locks_lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+
+        def refresh():
+            try:
+                lock = self._lock_for(url)
+                if lock is None:
+                    return
+                with lock:
+                    self._upload(url)
+            finally:
+                with self._locks_lock:
+                    self._refreshing.discard(url)
+
+        threading.Thread(target=refresh, name="media-refresh", daemon=True).start()
+
+    def _upload(self, url: str) -> Optional[str]:
+        try:
+            content, mime_type = self.client.fetch_url(url, max_bytes=MEDIA_MAX_BYTES)
+            filename = url.rsplit("/", 1)[-1].split("?", 1)[0] or "imagem"
+            media_id = self.client.upload_media(content, mime_type, filename)
+        except Exception as e:
+            metrics.record_error("media_upload", e)
+            logger.error(f"Erro ao fazer upload da imagem {url} (link por {self.failure_ttl:.0f}s): {str(e)}")
+            with self._locks_lock:
+                if url in self._locks:
+                    self._failures[url] = time.monotonic() + self.failure_ttl
+            return None
+        with self._locks_lock:
+            self._failures.pop(url, None)
+        entry = {"id": media_id, "expires_at": time.time() + self.ttl}
+        try:
+            # Expira do cache um pouco antes do ID na API
+            state.get_state().set_many({self._key(url): json.dumps(entry)}, ttl=self.ttl - 60)
+        except Exception as e:
+            metrics.record_error("state", e)
+        logger.info(f"Imagem {url} enviada como mídia {media_id}")
+        return media_id
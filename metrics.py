@@ -0,0 +1,313 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+from typing import Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+logger = logging.getLogger(__name__)
+
+# Buckets pensados para o intervalo que vai de uma chamada rápida à Graph API
+# (dezenas de ms) até uma execução lenta do Gemini (dezenas de segundos)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+# ===== HISTOGRAMAS DE LATÊNCIA =====
+
+WEBHOOK_LATENCY = Histogram(
+    "gena_webhook_duration_seconds",
+    "Tempo de processamento de um POST no webhook",
+    buckets=LATENCY_BUCKETS,
+)
+
+AGENT_LATENCY = Histogram(
+    "gena_agent_call_duration_seconds",
+    "Tempo de execução do agente (chamada ao LLM) em call_agent",
+    buckets=LATENCY_BUCKETS,
+)
+
+AGENT_INPUT_TOKENS = Histogram(
+    "gena_agent_input_tokens",
+    "Tokens estimados (caracteres / 4) da mensagem enviada ao agente, sem as instruções",
+    buckets=(50, 100, 200, 400, 800, 1200, 1600, 2400, 3200, 6400),
+)
+
+AGENT_FIRST_REPLY_LATENCY = Histogram(
+    "gena_agent_first_reply_seconds",
+    "Tempo do início do turno do agente até a primeira mensagem enviada ao contato",
+    buckets=LATENCY_BUCKETS,
+)
+
+GRAPH_API_LATENCY = Histogram(
+    "gena_graph_api_duration_seconds",
+    "Tempo de cada chamada à Graph API feita por _send_request",
+    ["operation", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+MEDIA_DOWNLOAD_LATENCY = Histogram(
+    "gena_media_download_duration_seconds",
+    "Tempo de download de mídia do WhatsApp",
+    buckets=LATENCY_BUCKETS,
+)
+
+AUDIO_CONVERSION_LATENCY = Histogram(
+    "gena_audio_conversion_duration_seconds",
+    "Tempo de conversão de áudio com FFmpeg",
+    ["format"],
+    buckets=LATENCY_BUCKETS,
+)
+
+TRANSCRIPTION_LATENCY = Histogram(
+    "gena_transcription_duration_seconds",
+    "Tempo de transcrição de áudio com o Gemini",
+    buckets=LATENCY_BUCKETS,
+)
+
+TRANSCRIPTION_FIRST_SEGMENT_LATENCY = Histogram(
+    "gena_transcription_first_segment_seconds",
+    "Tempo até o texto do primeiro trecho de um áudio dividido",
+    buckets=LATENCY_BUCKETS,
+)
+
+TRANSCRIPTION_SEGMENTS = Histogram(
+    "gena_transcription_segments",
+    "Trechos por áudio dividido",
+    buckets=(2, 3, 4, 6, 8, 12, 16, 24),
+)
+
+IMAGE_DOWNSCALE_LATENCY = Histogram(
+    "gena_image_downscale_duration_seconds",
+    "Tempo de redução e regravação de uma imagem recebida",
+    buckets=LATENCY_BUCKETS,
+)
+
+IMAGE_BYTES_SAVED = Histogram(
+    "gena_image_bytes_saved",
+    "Bytes economizados por imagem recebida (original menos a versão enviada ao modelo)",
+    buckets=(10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_000_000, 5_000_000),
+)
+
+AGENT_TOOL_CALLS = Histogram(
+    "gena_agent_tool_calls",
+    "Chamadas de ferramenta por turno do agente",
+    buckets=(0, 1, 2, 3, 4, 6, 8),
+)
+
+COALESCE_WAIT = Histogram(
+    "gena_coalesce_wait_seconds",
+    "Atraso adicionado pelo agrupamento de mensagens, da primeira mensagem ao disparo do turno",
+    buckets=LATENCY_BUCKETS,
+)
+
+COALESCE_BATCH_SIZE = Histogram(
+    "gena_coalesce_batch_size",
+    "Mensagens agrupadas em cada turno do agente",
+    buckets=(1, 2, 3, 4, 5, 8, 13),
+)
+
+AGENT_QUEUE_WAIT = Histogram(
+    "gena_agent_queue_wait_seconds",
+    "Espera de um lote pronto por uma thread livre, por prioridade",
+    ["priority"],
+    buckets=LATENCY_BUCKETS,
+)
+
+STATE_LATENCY = Histogram(
+    "gena_state_op_duration_seconds",
+    "Tempo de cada operação no backend de estado compartilhado",
+    ["backend", "op"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+SCHEDULING_LATENCY = Histogram(
+    "gena_scheduling_duration_seconds",
+    "Tempo das operações da agenda (free_slots e book no índice em memória, refresh no armazenamento)",
+    ["op"],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.05, 0.25, 1.0),
+)
+
+# ===== CONTADORES =====
+
+MESSAGES_RECEIVED = Counter(
+    "gena_messages_received_total",
+    "Mensagens recebidas pelo webhook, por tipo",
+    ["type"],
+)
+
+MESSAGES_SENT = Counter(
+    "gena_send_message_total",
+    "Chamadas a send_message, por tipo",
+    ["type"],
+)
+
+ERRORS = Counter(
+    "gena_errors_total",
+    "Erros capturados, por etapa e classe de exceção",
+    ["stage", "error"],
+)
+
+STATUS_EVENTS = Counter(
+    "gena_status_events_total",
+    "Status de entrega recebidos no webhook (sent, delivered, read, failed)",
+    ["status"],
+)
+
+IMAGE_BYTES = Counter(
+    "gena_image_bytes_total",
+    "Bytes das imagens recebidas, originais (original) e enviadas ao modelo (sent)",
+    ["kind"],
+)
+
+EVENT_LOG_BYTES = Counter(
+    "gena_event_log_bytes_total",
+    "Bytes gravados nos segmentos do log de eventos",
+)
+
+EVENT_LOG_DROPPED = Counter(
+    "gena_event_log_dropped_total",
+    "Eventos descartados com a fila do log de eventos cheia",
+)
+
+ADMISSION_DECISIONS = Counter(
+    "gena_admission_total",
+    "Mensagens na admissão do webhook, por classe e resultado (admitted, deferred, shed)",
+    ["priority_class", "outcome"],
+)
+
+AGENT_FALLBACKS = Counter(
+    "gena_agent_fallback_total",
+    "Turnos respondidos com a mensagem de fallback em vez do agente, por motivo",
+    ["reason"],
+)
+
+CIRCUIT_REJECTED = Counter(
+    "gena_circuit_rejected_total",
+    "Chamadas rejeitadas com o circuito aberto",
+    ["name"],
+)
+
+HEDGE_REQUESTS = Counter(
+    "gena_hedge_requests_total",
+    "Segundas requisições de hedging (fired) e as não disparadas por falta de orçamento",
+    ["name", "outcome"],
+)
+
+HEDGE_WINS = Counter(
+    "gena_hedge_wins_total",
+    "Tentativa vencedora nas chamadas com hedging (primary ou hedge)",
+    ["name", "winner"],
+)
+
+HISTORY_COMPACTIONS = Counter(
+    "gena_history_compactions_total",
+    "Resumos de histórico gerados, por origem (llm ou local)",
+    ["source"],
+)
+
+CONTENT_RELOADS = Counter(
+    "gena_content_reloads_total",
+    "Recargas do conteúdo das clínicas, por resultado (ok ou error)",
+    ["outcome"],
+)
+
+PROFILES = Counter(
+    "gena_profiles_total",
+    "Perfis de CPU coletados, por tipo (process = pedido no endpoint ou por sinal; webhook e turn = amostrados)",
+    ["kind"],
+)
+
+LLM_TOKENS = Counter(
+    "gena_llm_tokens_total",
+    "Tokens consumidos no Gemini, por chamada (agent, transcription, summary), modelo e direção (input, output)",
+    ["call", "model", "direction"],
+)
+
+LLM_COST = Counter(
+    "gena_llm_cost_usd_total",
+    "Custo estimado das chamadas ao Gemini em USD, por chamada e fluxo",
+    ["call", "flow"],
+)
+
+SCHEDULING_BOOKINGS = Counter(
+    "gena_scheduling_bookings_total",
+    "Pedidos de agendamento, por resultado (booked, conflict, limit)",
+    ["outcome"],
+)
+
+ROUTER_DECISIONS = Counter(
+    "gena_router_decisions_total",
+    "Decisões do roteador de intenções (local = respondida sem o agente), por intenção",
+    ["route", "intent"],
+)
+
+ROUTER_CONFIDENCE = Histogram(
+    "gena_router_confidence",
+    "Confiança do classificador de intenções",
+    buckets=(0.3, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.99, 1.0),
+)
+
+# ===== ESTADO =====
+
+CIRCUIT_STATE = Gauge(
+    "gena_circuit_state",
+    "Estado do disjuntor (0 = fechado, 1 = meio-aberto, 2 = aberto)",
+    ["name"],
+    multiprocess_mode="livemax",
+)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """
+    Mede o tempo de um bloco e registra no histograma informado.
+
+    Args:
+        histogram: Histograma de destino
+        **labels: Labels do histograma (se houver)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        target = histogram.labels(**labels) if labels else histogram
+        target.observe(time.perf_counter() - start)
+
+
+def record_error(stage: str, error: BaseException) -> None:
+    """
+    Incrementa o contador de erros para a etapa e a classe da exceção.
+
+    Args:
+        stage: Etapa do pipeline onde o erro ocorreu (ex: webhook, graph_api)
+        error: Exceção capturada
+    """
+    ERRORS.labels(stage=stage, error=type(error).__name__).inc()
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    Gera o conteúdo do endpoint /metrics.
+
+    Com vários workers do Gunicorn, cada processo grava suas métricas em
+    PROMETHEUS_MULTIPROC_DIR e a coleta agrega todos os arquivos, de modo que
+    qualquer worker que atenda o scrape devolve os totais do servidor.
+
+    Returns:
+        Tupla (conteúdo, content-type)
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
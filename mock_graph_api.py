@@ -0,0 +1,215 @@
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("mock_graph_api")
+
+_MESSAGES_PATH = re.compile(r"^/v[\d.]+/(?P<phone_id>[^/]+)/messages$")
+_MEDIA_UPLOAD_PATH = re.compile(r"^/v[\d.]+/(?P<phone_id>[^/]+)/media$")
+_MEDIA_META_PATH = re.compile(r"^/v[\d.]+/(?P<media_id>[^/]+)$")
+_MEDIA_DOWNLOAD_PATH = re.compile(r"^/media/(?P<media_id>[^/]+)$")
+
+
+class MockGraphAPI:
+    """
+    Servidor local que simula os endpoints da Graph API usados pelo WhatsAppClient:
+    envio de mensagens, metadados de mídia e download de mídia.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency_ms: float = 80.0,
+                 jitter_ms: float = 40.0, rate_429: float = 0.0, media_file: Optional[str] = None,
+                 media_size: int = 32 * 1024, media_mime: str = "audio/ogg"):
+        """
+        Inicializa o servidor simulado.
+
+        Args:
+            host: Endereço de escuta
+            port: Porta de escuta (0 escolhe uma porta livre)
+            latency_ms: Latência média adicionada a cada resposta
+            jitter_ms: Variação máxima (para mais ou para menos) da latência
+            rate_429: Fração das requisições de envio respondidas com 429
+            media_file: Arquivo servido nos downloads de mídia (opcional)
+            media_size: Tamanho do conteúdo aleatório servido quando não há media_file
+            media_mime: Content-Type da mídia servida
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.media_mime = media_mime
+        if media_file:
+            with open(media_file, "rb") as f:
+                self.media_content = f.read()
+        else:
+            self.media_content = random.randbytes(media_size)
+
+        # Mensagens recebidas (horário, destinatário e tipo) e primeira resposta por contato
+        self.sent: List[Dict[str, Any]] = []
+        self.first_reply_at: Dict[str, float] = {}
+        self.counters = {"messages": 0, "throttled": 0, "media_meta": 0, "media_download": 0,
+                         "media_upload": 0, "other": 0}
+        self._lock = threading.Lock()
+        self._message_seq = 0
+
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockGraphAPI":
+        """
+        Inicia o servidor numa thread em segundo plano.
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-graph-api", daemon=True)
+        self._thread.start()
+        logger.info(f"Graph API simulada ouvindo em {self.url}")
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.sent.clear()
+            self.first_reply_at.clear()
+            for key in self.counters:
+                self.counters[key] = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.counters, replies=len(self.sent))
+
+    def _sleep(self) -> None:
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _record_message(self, payload: Dict[str, Any]) -> str:
+        now = time.time()
+        to = str(payload.get("to", ""))
+        with self._lock:
+            self._message_seq += 1
+            self.counters["messages"] += 1
+            self.sent.append({"at": now, "to": to, "type": payload.get("type")})
+            self.first_reply_at.setdefault(to, now)
+            return f"wamid.MOCK{self._message_seq:012d}"
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                # Sem log por requisição: o servidor precisa aguentar milhares de req/s
+                pass
+
+            def _reply(self, status: int, body: Any, content_type: str = "application/json") -> None:
+                data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                mock._sleep()
+                if _MEDIA_UPLOAD_PATH.match(self.path):
+                    with mock._lock:
+                        mock.counters["media_upload"] += 1
+                        mock._message_seq += 1
+                        media_id = f"{9000000000000000 + mock._message_seq}"
+                    return self._reply(200, {"id": media_id})
+                match = _MESSAGES_PATH.match(self.path)
+                if not match:
+                    with mock._lock:
+                        mock.counters["other"] += 1
+                    return self._reply(404, {"error": {"message": "Unknown path", "code": 100}})
+                if mock.rate_429 and random.random() < mock.rate_429:
+                    with mock._lock:
+                        mock.counters["throttled"] += 1
+                    return self._reply(429, {"error": {
+                        "message": "(#130429) Rate limit hit", "type": "OAuthException", "code": 130429
+                    }})
+                try:
+                    payload = json.loads(raw or b"{}")
+                except ValueError:
+                    return self._reply(400, {"error": {"message": "Invalid JSON", "code": 100}})
+                message_id = mock._record_message(payload)
+                to = payload.get("to", "")
+                self._reply(200, {
+                    "messaging_product": "whatsapp",
+                    "contacts": [{"input": to, "wa_id": to}],
+                    "messages": [{"id": message_id}],
+                })
+
+            def do_GET(self):
+                mock._sleep()
+                download = _MEDIA_DOWNLOAD_PATH.match(self.path)
+                if download:
+                    with mock._lock:
+                        mock.counters["media_download"] += 1
+                    return self._reply(200, mock.media_content, mock.media_mime)
+                meta = _MEDIA_META_PATH.match(self.path)
+                if meta:
+                    media_id = meta.group("media_id")
+                    with mock._lock:
+                        mock.counters["media_meta"] += 1
+                    # O mesmo caminho atende a consulta de informações da conta
+                    return self._reply(200, {
+                        "messaging_product": "whatsapp",
+                        "id": media_id,
+                        "url": f"{mock.url}/media/{media_id}",
+                        "mime_type": mock.media_mime,
+                        "file_size": len(mock.media_content),
+                    })
+                with mock._lock:
+                    mock.counters["other"] += 1
+                self._reply(404, {"error": {"message": "Unknown path", "code": 100}})
+
+            def do_HEAD(self):
+                if _MEDIA_DOWNLOAD_PATH.match(self.path):
+                    return self._reply(200, mock.media_content, mock.media_mime)
+                self._reply(404, b"", "text/plain")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Graph API do WhatsApp simulada para testes offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=80.0)
+    parser.add_argument("--jitter-ms", type=float, default=40.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fração de envios respondidos com 429")
+    parser.add_argument("--media-file", help="Arquivo servido nos downloads de mídia")
+    parser.add_argument("--media-mime", default="audio/ogg")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mock = MockGraphAPI(args.host, args.port, args.latency_ms, args.jitter_ms, args.rate_429,
+                        args.media_file, media_mime=args.media_mime)
+    print(f"Graph API simulada em {mock.url} (use WHATSAPP_GRAPH_URL={mock.url})")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(mock.stats()))
+
+
+if __name__ == "__main__":
+    main()
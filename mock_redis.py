@@ -0,0 +1,249 @@
+import time
+import logging
+import argparse
+import threading
+import socketserver
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("mock_redis")
+
+
+class MockRedis:
+    """
+    Servidor local que fala o protocolo RESP e implementa o subconjunto de
+    comandos usado pelo RedisStateBackend, para testes offline sem um Redis.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6380, latency_ms: float = 0.0):
+        """
+        Inicializa o servidor simulado.
+
+        Args:
+            host: Endereço de escuta
+            port: Porta de escuta (0 escolhe uma porta livre)
+            latency_ms: Latência adicionada a cada leitura do socket (simula a ida e volta na rede)
+        """
+        self.latency_ms = latency_ms
+        # {chave: [valor, expira_em]}; listas são guardadas como list
+        self._data: Dict[str, List[Any]] = {}
+        self._lock = threading.Lock()
+        self.counters = {"commands": 0, "round_trips": 0}
+
+        mock = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                buffer = b""
+                while True:
+                    try:
+                        chunk = self.request.recv(65536)
+                    except OSError:
+                        return
+                    if not chunk:
+                        return
+                    buffer += chunk
+                    # Todos os comandos completos já recebidos (um pipeline) são
+                    # respondidos juntos, numa única ida e volta
+                    replies = []
+                    while True:
+                        command, buffer = mock._parse_command(buffer)
+                        if command is None:
+                            break
+                        replies.append(mock._execute(command))
+                    if not replies:
+                        continue
+                    with mock._lock:
+                        mock.counters["round_trips"] += 1
+                    if mock.latency_ms:
+                        time.sleep(mock.latency_ms / 1000.0)
+                    self.request.sendall(b"".join(replies))
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> "MockRedis":
+        """
+        Inicia o servidor numa thread em segundo plano.
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-redis", daemon=True)
+        self._thread.start()
+        logger.info(f"Redis simulado ouvindo em {self.url}")
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.counters, keys=len(self._data))
+
+    # ===== PROTOCOLO =====
+
+    @staticmethod
+    def _parse_command(buffer: bytes):
+        # Retorna (comando, restante) ou (None, buffer) se o comando ainda está incompleto
+        end = buffer.find(b"\r\n")
+        if end < 0:
+            return None, buffer
+        if buffer[:1] != b"*":
+            # Comando inline (ex: PING digitado no telnet)
+            return buffer[:end].decode("utf-8").split(), buffer[end + 2:]
+        pos = end + 2
+        args = []
+        for _ in range(int(buffer[1:end])):
+            end = buffer.find(b"\r\n", pos)
+            if end < 0:
+                return None, buffer
+            size = int(buffer[pos + 1:end])
+            start = end + 2
+            if len(buffer) < start + size + 2:
+                return None, buffer
+            args.append(buffer[start:start + size].decode("utf-8"))
+            pos = start + size + 2
+        return args, buffer[pos:]
+
+    @staticmethod
+    def _encode(value: Any) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, Exception):
+            return b"-ERR %s\r\n" % str(value).encode("utf-8")
+        if value is True:
+            return b"+OK\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(MockRedis._encode(item) for item in value)
+        data = str(value).encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    # ===== COMANDOS =====
+
+    def _get(self, key: str, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def _execute(self, command: List[str]) -> bytes:
+        name, args = command[0].upper(), command[1:]
+        handler = getattr(self, f"_cmd_{name.lower()}", None)
+        with self._lock:
+            self.counters["commands"] += 1
+            if handler is None:
+                return self._encode(ValueError(f"unknown command '{name}'"))
+            try:
+                return self._encode(handler(time.monotonic(), *args))
+            except Exception as e:
+                return self._encode(e)
+
+    def _cmd_ping(self, now, *args):
+        return args[0] if args else "PONG"
+
+    def _cmd_select(self, now, db):
+        return True
+
+    def _cmd_auth(self, now, *args):
+        return True
+
+    def _cmd_flushdb(self, now, *args):
+        self._data.clear()
+        return True
+
+    def _cmd_get(self, now, key):
+        entry = self._get(key, now)
+        return entry[0] if entry else None
+
+    def _cmd_mget(self, now, *keys):
+        return [self._cmd_get(now, key) for key in keys]
+
+    def _cmd_set(self, now, key, value, *options):
+        options = [option.upper() if not option.isdigit() else option for option in options]
+        expires = None
+        if "PX" in options:
+            expires = now + int(options[options.index("PX") + 1]) / 1000.0
+        if "EX" in options:
+            expires = now + int(options[options.index("EX") + 1])
+        exists = self._get(key, now) is not None
+        if ("NX" in options and exists) or ("XX" in options and not exists):
+            return None
+        self._data[key] = [value, expires]
+        return True
+
+    def _cmd_del(self, now, *keys):
+        return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def _cmd_incrby(self, now, key, amount):
+        entry = self._get(key, now) or [0, None]
+        entry[0] = str(int(entry[0]) + int(amount))
+        self._data[key] = entry
+        return int(entry[0])
+
+    def _cmd_pexpire(self, now, key, ms):
+        entry = self._get(key, now)
+        if entry is None:
+            return 0
+        entry[1] = now + int(ms) / 1000.0
+        return 1
+
+    def _cmd_pttl(self, now, key):
+        entry = self._get(key, now)
+        if entry is None:
+            return -2
+        return -1 if entry[1] is None else int((entry[1] - now) * 1000)
+
+    def _cmd_rpush(self, now, key, *values):
+        if not values:
+            raise ValueError("wrong number of arguments for 'rpush' command")
+        entry = self._get(key, now)
+        if entry is None:
+            entry = self._data[key] = [[], None]
+        entry[0].extend(values)
+        return len(entry[0])
+
+    def _cmd_lrange(self, now, key, start, stop):
+        entry = self._get(key, now)
+        if entry is None:
+            return []
+        items = entry[0]
+        start, stop = int(start), int(stop)
+        stop = len(items) if stop == -1 else (stop + 1 if stop >= 0 else len(items) + stop + 1)
+        return items[start if start >= 0 else max(0, len(items) + start):stop]
+
+    def _cmd_ltrim(self, now, key, start, stop):
+        entry = self._get(key, now)
+        if entry is not None:
+            entry[0] = self._cmd_lrange(now, key, start, stop)
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Redis simulado (subconjunto do protocolo) para testes offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latência simulada por ida e volta")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mock = MockRedis(args.host, args.port, args.latency_ms)
+    print(f"Redis simulado em {mock.url} (use STATE_BACKEND={mock.url})")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(mock.stats())
+
+
+if __name__ == "__main__":
+    main()
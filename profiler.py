@@ -0,0 +1,305 @@
+import os
+import sys
+import time
+import heapq
+import hmac
+import random
+import signal
+import logging
+import itertools
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Token dos endpoints /admin/profile* (sem token, os endpoints ficam desligados)
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+# Amostras por segundo
+PROFILE_HZ = float(os.environ.get("PROFILE_HZ", "100"))
+# Duração máxima de um perfil pedido no endpoint
+PROFILE_MAX_S = float(os.environ.get("PROFILE_MAX_S", "60"))
+# Fração dos webhooks perfilados continuamente (0 desliga)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# Perfis mais lentos guardados por worker
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "20"))
+# Perfis disparados por sinal (kill -USR2 <pid do worker>): duração e diretório de saída
+PROFILE_SIGNAL_S = float(os.environ.get("PROFILE_SIGNAL_S", "30"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# Decisão de amostragem da requisição, herdada pelo lote do coalescer e pelo turno
+_sampled: contextvars.ContextVar = contextvars.ContextVar("gena_profile_sampled", default=None)
+
+
+@dataclass
+class Profile:
+    """Pilhas amostradas de um intervalo, no formato "collapsed" dos flame graphs."""
+
+    profile_id: int
+    name: str
+    started_at: float
+    duration_s: float = 0.0
+    samples: int = 0
+    trace_id: Optional[str] = None
+    # (nome da thread, pilha da raiz à folha) -> amostras
+    stacks: Counter = field(default_factory=Counter)
+
+    def collapsed(self) -> str:
+        """
+        Uma linha por pilha ("thread;função (arquivo:linha);... amostras"), aceita por
+        flamegraph.pl, speedscope e inferno.
+        """
+        lines = []
+        for (thread_name, stack), count in self.stacks.most_common():
+            frames = ";".join(_label(code) for code in stack)
+            lines.append(f"{thread_name};{frames} {count}" if frames else f"{thread_name} {count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.profile_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_s": round(self.duration_s, 4),
+            "samples": self.samples,
+            "trace_id": self.trace_id,
+        }
+
+
+_labels: Dict[Any, str] = {}
+
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+def _stack(frame) -> Tuple[Any, ...]:
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+class _Collector:
+    __slots__ = ("profile", "thread_id")
+
+    def __init__(self, profile: Profile, thread_id: Optional[int]):
+        self.profile = profile
+        # None = todas as threads do processo
+        self.thread_id = thread_id
+
+
+class SamplingProfiler:
+    """
+    Profiler por amostragem do próprio worker: uma thread lê as pilhas de todas as
+    threads (sys._current_frames) PROFILE_HZ vezes por segundo, sem instrumentar o
+    código. A thread só existe enquanto há um perfil em andamento, e fora disso o
+    custo é zero. As amostras só acontecem quando a thread do profiler consegue o
+    GIL, então trechos longos em C aparecem como uma única pilha.
+    """
+
+    def __init__(self, hz: float = PROFILE_HZ, keep: int = PROFILE_KEEP,
+                 sample_rate: float = PROFILE_SAMPLE_RATE):
+        """
+        Args:
+            hz: Amostras por segundo
+            keep: Perfis mais lentos guardados
+            sample_rate: Fração das requisições perfiladas continuamente
+        """
+        self.hz = hz
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self._collectors: List[_Collector] = []
+        self._lock = threading.Condition()
+        self._sampler: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._ids = itertools.count(1)
+        # Heap (duração, id, perfil) com os mais lentos
+        self._slowest: List[Tuple[float, int, Profile]] = []
+
+    def _ensure_started(self) -> None:
+        # Thread criada sob demanda, também depois de um fork do Gunicorn (chamado com o lock)
+        if self._sampler is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._collectors = []
+        self._slowest = []
+        self._sampler = threading.Thread(target=self._run_sampler, name="profiler", daemon=True)
+        self._sampler.start()
+
+    def _run_sampler(self) -> None:
+        interval = 1.0 / self.hz
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                # A amostra é feita com o lock: um perfil encerrado não recebe mais amostras
+                while not self._collectors:
+                    self._lock.wait()
+                started = time.perf_counter()
+                frames = sys._current_frames()
+                names = None
+                for collector in self._collectors:
+                    profile = collector.profile
+                    if collector.thread_id is None:
+                        if names is None:
+                            names = {thread.ident: thread.name for thread in threading.enumerate()}
+                        for ident, frame in frames.items():
+                            if ident != me:
+                                profile.stacks[(names.get(ident, str(ident)), _stack(frame))] += 1
+                        profile.samples += 1
+                    else:
+                        frame = frames.get(collector.thread_id)
+                        if frame is not None:
+                            profile.stacks[(profile.name, _stack(frame))] += 1
+                            profile.samples += 1
+                del frames
+            time.sleep(max(0.0, interval - (time.perf_counter() - started)))
+
+    @contextmanager
+    def _collect(self, name: str, thread_id: Optional[int]):
+        profile = Profile(next(self._ids), name, time.time(), trace_id=tracing.current_trace_id())
+        collector = _Collector(profile, thread_id)
+        start = time.perf_counter()
+        with self._lock:
+            self._ensure_started()
+            self._collectors.append(collector)
+            self._lock.notify()
+        try:
+            yield profile
+        finally:
+            with self._lock:
+                self._collectors.remove(collector)
+            profile.duration_s = time.perf_counter() - start
+
+    def profile(self, seconds: float) -> Profile:
+        """
+        Amostra todas as threads do worker durante seconds (bloqueia a thread que chamou).
+
+        Args:
+            seconds: Duração do perfil
+
+        Returns:
+            Perfil com as pilhas de todas as threads
+        """
+        with self._collect("process", None) as profile:
+            time.sleep(seconds)
+        metrics.PROFILES.labels(kind="process").inc()
+        logger.info(f"Perfil do worker {os.getpid()}: {profile.samples} amostras em {seconds:g}s")
+        return profile
+
+    @contextmanager
+    def profiled(self, name: str):
+        """
+        Perfila o bloco na thread atual se a requisição foi sorteada (fração sample_rate).
+
+        O sorteio é feito uma vez por requisição e herdado pelos contextos copiados a
+        partir dela (o lote do coalescer e o turno do agente), de modo que uma mesma
+        mensagem é perfilada no webhook e no turno.
+
+        Args:
+            name: Etapa perfilada (ex: webhook, turn)
+        """
+        sampled, token = _sampled.get(), None
+        if sampled is None:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+            token = _sampled.set(sampled)
+        try:
+            if not sampled:
+                yield None
+                return
+            with self._collect(name, threading.get_ident()) as profile:
+                yield profile
+            self._offer(profile)
+        finally:
+            if token is not None:
+                _sampled.reset(token)
+
+    def _offer(self, profile: Profile) -> None:
+        metrics.PROFILES.labels(kind=profile.name).inc()
+        with self._lock:
+            entry = (profile.duration_s, profile.profile_id, profile)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            elif profile.duration_s > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self) -> List[Profile]:
+        """
+        Perfis amostrados mais lentos deste worker, do mais lento ao mais rápido.
+        """
+        with self._lock:
+            return [profile for _, _, profile in sorted(self._slowest, reverse=True)]
+
+    def get(self, profile_id: int) -> Optional[Profile]:
+        """
+        Perfil guardado pelo ID ou None se já foi descartado.
+        """
+        with self._lock:
+            return next((profile for _, pid, profile in self._slowest if pid == profile_id), None)
+
+
+# Profiler deste processo
+sampler = SamplingProfiler()
+
+
+def profiled(name: str):
+    """
+    Perfila o bloco se a requisição foi sorteada (ver SamplingProfiler.profiled).
+    """
+    return sampler.profiled(name)
+
+
+def check_token(authorization: Optional[str]) -> bool:
+    """
+    Confere o cabeçalho Authorization ("Bearer <PROFILE_TOKEN>") dos endpoints de perfil.
+
+    Args:
+        authorization: Valor do cabeçalho
+
+    Returns:
+        True se o token confere (sempre False sem PROFILE_TOKEN)
+    """
+    if not PROFILE_TOKEN or not authorization:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), PROFILE_TOKEN.encode())
+
+
+def _profile_to_file(seconds: float) -> None:
+    try:
+        profile = sampler.profile(seconds)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(profile.collapsed())
+        logger.info(f"Perfil gravado em {path}")
+    except Exception as e:
+        metrics.record_error("profiler", e)
+        logger.error(f"Erro ao gravar perfil: {str(e)}")
+
+
+def install_signal_handler(signum: int = signal.SIGUSR2) -> None:
+    """
+    Instala o handler que perfila o processo por PROFILE_SIGNAL_S ao receber signum
+    e grava o resultado em PROFILE_DIR (chamado em cada worker do Gunicorn).
+
+    Args:
+        signum: Sinal que dispara o perfil
+    """
+    def handler(_signum, _frame):
+        # O handler roda na thread principal: o perfil fica numa thread à parte
+        threading.Thread(target=_profile_to_file, args=(PROFILE_SIGNAL_S,), name="profiler-signal",
+                         daemon=True).start()
+
+    signal.signal(signum, handler)
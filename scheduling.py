@@ -0,0 +1,723 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import argparse
+import importlib
+import threading
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from zoneinfo import ZoneInfo
+
+import metrics
+import event_log
+from utils import fold_text
+
+logger = logging.getLogger(__name__)
+
+# Agenda consultada pelo agente: sqlite:///agenda.db ou modulo:Classe de um adaptador de
+# calendário externo (vazio desliga: o fluxo CALENDARIO continua enviando o link da agenda)
+SCHEDULING_STORE = os.environ.get("SCHEDULING_STORE", "")
+# Fuso dos horários de funcionamento e dos horários oferecidos
+SCHEDULING_TZ = os.environ.get("SCHEDULING_TZ", "America/Sao_Paulo")
+# Intervalo entre os inícios possíveis de um atendimento
+SCHEDULING_SLOT_MIN = int(os.environ.get("SCHEDULING_SLOT_MIN", "15"))
+# Dias à frente consultados
+SCHEDULING_HORIZON_DAYS = int(os.environ.get("SCHEDULING_HORIZON_DAYS", "21"))
+# Antecedência mínima de um agendamento
+SCHEDULING_MIN_NOTICE_MIN = int(os.environ.get("SCHEDULING_MIN_NOTICE_MIN", "60"))
+# Intervalo entre as atualizações incrementais da agenda em cache
+SCHEDULING_REFRESH_S = float(os.environ.get("SCHEDULING_REFRESH_S", "5"))
+# Agendamentos futuros por contato
+SCHEDULING_MAX_PER_CONTACT = int(os.environ.get("SCHEDULING_MAX_PER_CONTACT", "2"))
+# Duração usada quando o procedimento não informa duration_min
+DEFAULT_DURATION_MIN = 60
+# Nenhum evento da agenda dura mais que isso (limita a busca de conflitos no SQLite)
+_MAX_EVENT_S = 24 * 3600
+
+_WEEKDAYS = ("seg", "ter", "qua", "qui", "sex", "sab", "dom")
+
+
+class SchedulingError(Exception):
+    """Pedido de agenda inválido (procedimento desconhecido, horário fora do expediente...)."""
+
+
+@dataclass
+class Event:
+    """Intervalo ocupado na agenda: agendamento feito aqui ou bloqueio vindo do calendário externo."""
+
+    event_id: str
+    calendar_id: str
+    start: float
+    end: float
+    # booking (feito pelo agente) ou busy (bloqueio, ex: evento do calendário externo)
+    kind: str = "booking"
+    procedure_id: Optional[str] = None
+    contact: Optional[str] = None
+
+
+@dataclass
+class Changes:
+    """Eventos alterados numa agenda desde uma versão."""
+
+    # Eventos novos ou alterados
+    events: List[Event]
+    # IDs dos eventos cancelados ou removidos
+    removed: List[str]
+    # Versão a informar na próxima consulta
+    version: int
+
+
+class CalendarStore:
+    """
+    Armazenamento das agendas. Cada alteração recebe uma versão crescente, e changes
+    devolve só o que mudou desde a versão informada, o que permite manter a agenda
+    em cache e atualizá-la de forma incremental. Adaptadores de calendários externos
+    implementam os mesmos métodos (book precisa ser atômico: falhar se o horário já
+    estiver ocupado no calendário).
+    """
+
+    name = "base"
+
+    def changes(self, calendar_id: str, since: int) -> Changes:
+        """
+        Eventos alterados desde a versão since.
+
+        Args:
+            calendar_id: Agenda (ID da clínica)
+            since: Última versão já lida (0 para a agenda inteira)
+
+        Returns:
+            Eventos alterados, removidos e a nova versão
+        """
+        raise NotImplementedError
+
+    def book(self, event: Event) -> bool:
+        """
+        Grava o evento se o intervalo estiver livre, de forma atômica entre processos.
+
+        Returns:
+            True se gravado, False se houve conflito
+        """
+        raise NotImplementedError
+
+    def cancel(self, calendar_id: str, event_id: str) -> bool:
+        """
+        Cancela um evento.
+
+        Returns:
+            True se o evento existia
+        """
+        raise NotImplementedError
+
+
+class SQLiteCalendarStore(CalendarStore):
+    """Agendas num SQLite local, compartilhado pelos workers do Gunicorn."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Uma conexão por processo
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn_pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS events (event_id TEXT PRIMARY KEY, calendar_id TEXT, start_ts REAL, "
+                "end_ts REAL, kind TEXT, procedure_id TEXT, contact TEXT, status TEXT, version INTEGER, "
+                "updated_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS events_version ON events (calendar_id, version)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS events_start ON events (calendar_id, start_ts)")
+        return self._conn
+
+    def changes(self, calendar_id, since):
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT event_id, start_ts, end_ts, kind, procedure_id, contact, status, version FROM events "
+                "WHERE calendar_id = ? AND version > ? ORDER BY version", (calendar_id, since)
+            ).fetchall()
+        events, removed, version = [], [], since
+        for event_id, start, end, kind, procedure_id, contact, status, row_version in rows:
+            version = max(version, row_version)
+            if status == "booked":
+                events.append(Event(event_id, calendar_id, start, end, kind, procedure_id, contact))
+            else:
+                removed.append(event_id)
+        return Changes(events, removed, version)
+
+    def _write(self, calendar_id: str, sql: str, params: Callable[[int], Tuple],
+               check: Optional[Event] = None) -> bool:
+        with self._lock:
+            conn = self._connection()
+            # BEGIN IMMEDIATE: a verificação do conflito e a gravação não se intercalam entre processos
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if check is not None and conn.execute(
+                    "SELECT 1 FROM events WHERE calendar_id = ? AND status = 'booked' AND start_ts < ? "
+                    "AND start_ts > ? AND end_ts > ? LIMIT 1",
+                    (calendar_id, check.end, check.start - _MAX_EVENT_S, check.start),
+                ).fetchone():
+                    conn.execute("ROLLBACK")
+                    return False
+                version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM events WHERE calendar_id = ?",
+                                       (calendar_id,)).fetchone()[0]
+                changed = conn.execute(sql, params(version)).rowcount
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return changed > 0
+
+    def book(self, event):
+        return self._write(
+            event.calendar_id,
+            "INSERT INTO events (event_id, calendar_id, start_ts, end_ts, kind, procedure_id, contact, status, "
+            "version, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'booked', ?, ?)",
+            lambda version: (event.event_id, event.calendar_id, event.start, event.end, event.kind,
+                             event.procedure_id, event.contact, version, time.time()),
+            check=event,
+        )
+
+    def cancel(self, calendar_id, event_id):
+        return self._write(
+            calendar_id,
+            "UPDATE events SET status = 'cancelled', version = ?, updated_at = ? "
+            "WHERE calendar_id = ? AND event_id = ? AND status = 'booked'",
+            lambda version: (version, time.time(), calendar_id, event_id),
+        )
+
+
+def create_store(url: str = SCHEDULING_STORE) -> CalendarStore:
+    """
+    Cria o armazenamento das agendas a partir da URL de configuração.
+
+    Args:
+        url: sqlite:///caminho ou modulo:Classe (adaptador de calendário externo, criado sem argumentos)
+
+    Returns:
+        Armazenamento configurado
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        return SQLiteCalendarStore(parsed.path[1:] if parsed.path.startswith("/") else parsed.path)
+    module_name, _, class_name = url.partition(":")
+    if module_name and class_name and "/" not in class_name:
+        return getattr(importlib.import_module(module_name), class_name)()
+    raise ValueError(f"SCHEDULING_STORE desconhecido: {url}")
+
+
+class IntervalIndex:
+    """
+    Intervalos ocupados de uma agenda, agrupados por dia e mesclados em duas listas
+    ordenadas (inícios e fins). Verificar um horário ou achar o próximo livre custa
+    uma busca binária por dia, sem percorrer os agendamentos. Os agendamentos também
+    ficam indexados por contato, e os eventos já encerrados são descartados (prune).
+    """
+
+    def __init__(self, tz: ZoneInfo):
+        self.tz = tz
+        self._events: Dict[str, Event] = {}
+        # Dia (ordinal da data local) -> IDs dos eventos que tocam o dia
+        self._days: Dict[int, set] = {}
+        # Contato -> IDs dos seus agendamentos
+        self._contacts: Dict[str, set] = {}
+        # Dia -> (inícios, fins) dos intervalos mesclados
+        self._merged: Dict[int, Tuple[List[float], List[float]]] = {}
+
+    def _ordinals(self, start: float, end: float) -> range:
+        first = datetime.fromtimestamp(start, self.tz).toordinal()
+        last = datetime.fromtimestamp(max(start, end - 1e-6), self.tz).toordinal()
+        return range(first, last + 1)
+
+    def _rebuild(self, day: int) -> None:
+        intervals = sorted((self._events[event_id].start, self._events[event_id].end)
+                           for event_id in self._days.get(day, ()))
+        starts: List[float] = []
+        ends: List[float] = []
+        for start, end in intervals:
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        if starts:
+            self._merged[day] = (starts, ends)
+        else:
+            self._merged.pop(day, None)
+            self._days.pop(day, None)
+
+    def _discard(self, event_id: str, touched: set) -> None:
+        event = self._events.pop(event_id, None)
+        if event is None:
+            return
+        for day in self._ordinals(event.start, event.end):
+            self._days.get(day, set()).discard(event_id)
+            touched.add(day)
+        if event.contact is not None:
+            mine = self._contacts.get(event.contact, set())
+            mine.discard(event_id)
+            if not mine:
+                self._contacts.pop(event.contact, None)
+
+    def apply(self, events: List[Event], removed: List[str]) -> None:
+        """
+        Aplica eventos novos ou alterados e remoções, remesclando só os dias afetados.
+        """
+        touched = set()
+        for event_id in removed:
+            self._discard(event_id, touched)
+        for event in events:
+            self._discard(event.event_id, touched)
+            self._events[event.event_id] = event
+            for day in self._ordinals(event.start, event.end):
+                self._days.setdefault(day, set()).add(event.event_id)
+                touched.add(day)
+            if event.contact is not None:
+                self._contacts.setdefault(event.contact, set()).add(event.event_id)
+        for day in touched:
+            self._rebuild(day)
+
+    def prune(self, before: float) -> int:
+        """
+        Descarta os eventos encerrados até before. Só os dias anteriores ao de before
+        são percorridos; o índice fica limitado ao horizonte de agendamento.
+
+        Returns:
+            Número de eventos descartados
+        """
+        cutoff = datetime.fromtimestamp(before, self.tz).toordinal()
+        expired = {event_id for day in self._days if day < cutoff for event_id in self._days[day]
+                   if self._events[event_id].end <= before}
+        touched = set()
+        for event_id in expired:
+            self._discard(event_id, touched)
+        for day in touched:
+            self._rebuild(day)
+        return len(expired)
+
+    def for_contact(self, contact: str, after: float) -> List[Event]:
+        """
+        Agendamentos do contato que começam depois de after, em ordem.
+        """
+        events = (self._events[event_id] for event_id in self._contacts.get(contact, ()))
+        return sorted((event for event in events if event.start > after), key=lambda event: event.start)
+
+    def is_free(self, start: float, end: float) -> bool:
+        """
+        Verifica se o intervalo [start, end) não toca nenhum intervalo ocupado.
+        """
+        for day in self._ordinals(start, end):
+            merged = self._merged.get(day)
+            if merged is None:
+                continue
+            starts, ends = merged
+            i = bisect_right(starts, start) - 1
+            if i >= 0 and ends[i] > start:
+                return False
+            j = bisect_left(starts, start)
+            if j < len(starts) and starts[j] < end:
+                return False
+        return True
+
+    def first_fit(self, day: int, window_start: float, window_end: float, after: float,
+                  duration: float, step: float) -> Optional[float]:
+        """
+        Primeiro início livre para duration dentro de uma janela de atendimento do dia.
+
+        Args:
+            day: Ordinal da data local da janela
+            window_start: Início da janela (os inícios ficam alinhados a partir dele)
+            window_end: Fim da janela
+            after: Início mínimo
+            duration: Duração do atendimento em segundos
+            step: Intervalo entre os inícios possíveis em segundos
+
+        Returns:
+            Início (timestamp) ou None se a janela não comporta o atendimento
+        """
+        def align(t: float) -> float:
+            if t <= window_start:
+                return window_start
+            return window_start + -(-(t - window_start) // step) * step
+
+        t = align(after)
+        merged = self._merged.get(day)
+        if merged is None:
+            return t if t + duration <= window_end else None
+        starts, ends = merged
+        while t + duration <= window_end:
+            # Intervalo ocupado que contém t, ou o primeiro que começa antes do fim do atendimento
+            i = bisect_right(starts, t) - 1
+            if i >= 0 and ends[i] > t:
+                t = align(ends[i])
+                continue
+            j = i + 1
+            if j < len(starts) and starts[j] < t + duration:
+                t = align(ends[j])
+                continue
+            return t
+        return None
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+
+class Calendar:
+    """
+    Agenda de uma clínica em cache: índice de intervalos em memória, atualizado de
+    forma incremental (só o que mudou desde a última versão lida) a cada refresh_s.
+    """
+
+    def __init__(self, store: CalendarStore, calendar_id: str, tz: ZoneInfo, refresh_s: float = SCHEDULING_REFRESH_S):
+        self.store = store
+        self.calendar_id = calendar_id
+        self.refresh_s = refresh_s
+        self.index = IntervalIndex(tz)
+        self.version = 0
+        self._refreshed_at = 0.0
+        self._lock = threading.RLock()
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Busca no armazenamento os eventos alterados desde a última versão lida.
+
+        Args:
+            force: Atualiza mesmo dentro do intervalo refresh_s
+        """
+        if not force and time.monotonic() - self._refreshed_at < self.refresh_s:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.refresh_s:
+                return
+            with metrics.timed(metrics.SCHEDULING_LATENCY, op="refresh"):
+                changes = self.store.changes(self.calendar_id, self.version)
+            self.index.apply(changes.events, changes.removed)
+            # Eventos já encerrados não bloqueiam horários nem contam no limite do contato
+            self.index.prune(time.time())
+            self.version = changes.version
+            self._refreshed_at = time.monotonic()
+            if changes.events or changes.removed:
+                logger.info(f"Agenda {self.calendar_id} atualizada: {len(changes.events)} eventos, "
+                            f"{len(changes.removed)} removidos (versão {self.version})")
+
+    def book(self, event: Event) -> bool:
+        """
+        Reserva o intervalo do evento. O índice descarta conflitos sem ir ao
+        armazenamento, que faz a verificação definitiva (entre processos e nós).
+
+        Returns:
+            True se reservado, False se o horário já estava ocupado
+        """
+        with self._lock:
+            self.refresh()
+            if not self.index.is_free(event.start, event.end):
+                return False
+            if self.store.book(event):
+                self.index.apply([event], [])
+                return True
+            # Reservado por outro worker depois da última atualização
+            self.refresh(force=True)
+            return False
+
+
+def _procedure_key(text: str) -> str:
+    # IDs dos procedimentos ("limpeza_de_pele") comparados com o que o modelo escreveu
+    return fold_text(str(text)).replace("_", " ").strip()
+
+
+@lru_cache(maxsize=4096)
+def _day_windows(ranges: Tuple[str, ...], ordinal: int, tz_name: str) -> Tuple[Tuple[float, float], ...]:
+    # Janelas de atendimento ("09:00-12:00") de um dia, em timestamps
+    tz, day = ZoneInfo(tz_name), date.fromordinal(ordinal)
+    windows = []
+    for item in ranges:
+        opening, _, closing = item.partition("-")
+        start = datetime.combine(day, datetime.strptime(opening.strip(), "%H:%M").time(), tz).timestamp()
+        end = datetime.combine(day, datetime.strptime(closing.strip(), "%H:%M").time(), tz).timestamp()
+        if end > start:
+            windows.append((start, end))
+    return tuple(sorted(windows))
+
+
+class Scheduler:
+    """
+    Motor de agendamento: horários livres e reservas por clínica, com a duração de
+    cada procedimento vinda do catálogo (duration_min) e o expediente do conteúdo da
+    clínica (hours).
+    """
+
+    def __init__(self, store: Optional[CalendarStore] = None, tz: str = SCHEDULING_TZ,
+                 slot_min: int = SCHEDULING_SLOT_MIN, horizon_days: int = SCHEDULING_HORIZON_DAYS,
+                 min_notice_min: int = SCHEDULING_MIN_NOTICE_MIN, refresh_s: float = SCHEDULING_REFRESH_S,
+                 max_per_contact: int = SCHEDULING_MAX_PER_CONTACT):
+        """
+        Args:
+            store: Armazenamento das agendas (padrão: criado a partir de SCHEDULING_STORE no primeiro uso)
+            tz: Fuso do expediente
+            slot_min: Intervalo entre os inícios possíveis em minutos
+            horizon_days: Dias à frente consultados
+            min_notice_min: Antecedência mínima em minutos
+            refresh_s: Intervalo entre as atualizações incrementais da agenda em cache
+            max_per_contact: Agendamentos futuros por contato
+        """
+        self._store = store
+        self.tz_name = tz
+        self.tz = ZoneInfo(tz)
+        self.step = slot_min * 60
+        self.horizon_days = horizon_days
+        self.min_notice = min_notice_min * 60
+        self.refresh_s = refresh_s
+        self.max_per_contact = max_per_contact
+        self._calendars: Dict[str, Calendar] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def store(self) -> CalendarStore:
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = create_store()
+                    logger.info(f"Agenda: {self._store.name}")
+        return self._store
+
+    def calendar(self, tenant) -> Calendar:
+        """
+        Agenda da clínica (uma por clínica, mantida em cache).
+        """
+        calendar = self._calendars.get(tenant.tenant_id)
+        if calendar is None:
+            with self._lock:
+                calendar = self._calendars.get(tenant.tenant_id)
+                if calendar is None:
+                    calendar = Calendar(self.store, tenant.tenant_id, self.tz, self.refresh_s)
+                    self._calendars[tenant.tenant_id] = calendar
+        return calendar
+
+    def procedure(self, tenant, procedure: str) -> Dict[str, Any]:
+        """
+        Procedimento do catálogo pelo ID ou pelo nome (sem acentos, parcial).
+
+        Raises:
+            SchedulingError: Procedimento não encontrado
+        """
+        wanted = _procedure_key(procedure)
+        for item in tenant.catalog:
+            if _procedure_key(item["id"]) == wanted:
+                return item
+        for item in tenant.catalog:
+            if wanted and (wanted in _procedure_key(item.get("title", "")) or wanted in _procedure_key(item["id"])):
+                return item
+        raise SchedulingError(f"Procedimento '{procedure}' não encontrado no catálogo")
+
+    def _windows(self, tenant, after: float, until: float) -> Iterator[Tuple[int, float, float]]:
+        first = datetime.fromtimestamp(after, self.tz).toordinal()
+        last = min(datetime.fromtimestamp(until, self.tz).toordinal(), first + self.horizon_days)
+        for ordinal in range(first, last + 1):
+            ranges = tenant.hours.get(_WEEKDAYS[date.fromordinal(ordinal).weekday()], ())
+            for start, end in _day_windows(tuple(ranges), ordinal, self.tz_name):
+                if end > after and start < until:
+                    yield ordinal, start, min(end, until)
+
+    def free_slots(self, tenant, procedure: str, after: Optional[float] = None, until: Optional[float] = None,
+                   count: int = 3) -> Tuple[Dict[str, Any], List[float]]:
+        """
+        Próximos horários livres para um procedimento.
+
+        Args:
+            tenant: Clínica
+            procedure: ID ou nome do procedimento
+            after: Início mínimo (padrão: agora mais a antecedência mínima)
+            until: Fim máximo (padrão: horizon_days depois de after)
+            count: Quantidade de horários (separados pela duração do procedimento)
+
+        Returns:
+            Tupla (procedimento, inícios em timestamp)
+        """
+        item = self.procedure(tenant, procedure)
+        duration = int(item.get("duration_min") or DEFAULT_DURATION_MIN) * 60
+        now = time.time()
+        after = max(after or now, now + self.min_notice)
+        until = until or after + (self.horizon_days + 1) * 86400
+        calendar = self.calendar(tenant)
+        calendar.refresh()
+        slots: List[float] = []
+        with metrics.timed(metrics.SCHEDULING_LATENCY, op="free_slots"):
+            for ordinal, window_start, window_end in self._windows(tenant, after, until):
+                while len(slots) < count:
+                    start = calendar.index.first_fit(ordinal, window_start, window_end,
+                                                     max(after, slots[-1] + duration if slots else after),
+                                                     duration, self.step)
+                    if start is None:
+                        break
+                    slots.append(start)
+                if len(slots) >= count:
+                    break
+        return item, slots
+
+    def book(self, tenant, procedure: str, start: float, contact: str) -> Event:
+        """
+        Reserva um horário para o contato.
+
+        Args:
+            tenant: Clínica
+            procedure: ID ou nome do procedimento
+            start: Início (timestamp)
+            contact: Número normalizado do contato
+
+        Returns:
+            Evento reservado
+
+        Raises:
+            SchedulingError: Horário fora do expediente, já ocupado ou limite do contato atingido
+        """
+        item = self.procedure(tenant, procedure)
+        end = start + int(item.get("duration_min") or DEFAULT_DURATION_MIN) * 60
+        if start < time.time() + self.min_notice:
+            raise SchedulingError("Horário com antecedência menor que a mínima")
+        if not any(window_start <= start and end <= window_end
+                   for _, window_start, window_end in self._windows(tenant, start, end)):
+            raise SchedulingError("Horário fora do expediente da clínica")
+        calendar = self.calendar(tenant)
+        calendar.refresh()
+        now = time.time()
+        mine = calendar.index.for_contact(contact, now)
+        # O mesmo pedido repetido (nova tentativa do modelo ou do hedging) devolve o agendamento já feito
+        for event in mine:
+            if event.start == start and event.procedure_id == item["id"]:
+                return event
+        booked = len(mine)
+        if booked >= self.max_per_contact:
+            metrics.SCHEDULING_BOOKINGS.labels(outcome="limit").inc()
+            raise SchedulingError(f"Contato já tem {booked} agendamentos futuros")
+        event = Event(uuid.uuid4().hex, tenant.tenant_id, start, end, "booking", item["id"], contact)
+        with metrics.timed(metrics.SCHEDULING_LATENCY, op="book"):
+            booked = calendar.book(event)
+        metrics.SCHEDULING_BOOKINGS.labels(outcome="booked" if booked else "conflict").inc()
+        event_log.emit("booking", tenant=tenant.tenant_id, contact=contact, procedure=item["id"],
+                       outcome="booked" if booked else "conflict", start=start)
+        if not booked:
+            raise SchedulingError("Horário já ocupado")
+        logger.info(f"Agendamento {event.event_id}: {item['id']} para {contact} em {self.format(start)}")
+        return event
+
+    def format(self, ts: float) -> str:
+        """
+        Horário legível no fuso da clínica (ex: qua 21/10 14:00).
+        """
+        moment = datetime.fromtimestamp(ts, self.tz)
+        return f"{_WEEKDAYS[moment.weekday()]} {moment:%d/%m %H:%M}"
+
+    def iso(self, ts: float) -> str:
+        """
+        Horário no formato aceito por parse (AAAA-MM-DDTHH:MM, fuso da clínica).
+        """
+        return f"{datetime.fromtimestamp(ts, self.tz):%Y-%m-%dT%H:%M}"
+
+    def parse(self, text: str) -> float:
+        """
+        Converte AAAA-MM-DD ou AAAA-MM-DDTHH:MM (fuso da clínica) em timestamp.
+
+        Raises:
+            SchedulingError: Formato inválido
+        """
+        try:
+            moment = datetime.fromisoformat(text.strip())
+        except ValueError:
+            raise SchedulingError(f"Data inválida: {text} (use AAAA-MM-DDTHH:MM)") from None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=self.tz)
+        return moment.timestamp()
+
+
+# Motor de agendamento do processo
+scheduler = Scheduler()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consulta e benchmark da agenda")
+    parser.add_argument("command", choices=["slots", "book", "cancel", "bench"])
+    parser.add_argument("--store", default=SCHEDULING_STORE or "sqlite:///agenda.db")
+    parser.add_argument("--procedure", default="microagulhamento_facial")
+    parser.add_argument("--after", help="AAAA-MM-DD ou AAAA-MM-DDTHH:MM (padrão: agora)")
+    parser.add_argument("--days", type=float, default=7, help="Janela da consulta em dias")
+    parser.add_argument("--count", type=int, default=5)
+    parser.add_argument("--contact", default="cli")
+    parser.add_argument("--event-id", help="Evento a cancelar")
+    parser.add_argument("--bookings", type=int, default=2000, help="Agendamentos gerados no benchmark")
+    args = parser.parse_args()
+
+    import agent
+    tenant = agent.tenant_registry.default()
+    engine = Scheduler(create_store(args.store))
+    after = engine.parse(args.after) if args.after else time.time()
+
+    if args.command == "slots":
+        item, slots = engine.free_slots(tenant, args.procedure, after, after + args.days * 86400, args.count)
+        print(f"{item['title']} ({item.get('duration_min') or DEFAULT_DURATION_MIN} min):")
+        for start in slots:
+            print(f"  {engine.format(start)}")
+
+    elif args.command == "book":
+        event = engine.book(tenant, args.procedure, after, args.contact)
+        print(f"{event.event_id} {engine.format(event.start)}-{datetime.fromtimestamp(event.end, engine.tz):%H:%M}")
+
+    elif args.command == "cancel":
+        print("Cancelado" if engine.store.cancel(tenant.tenant_id, args.event_id) else "Evento não encontrado")
+
+    else:
+        # Agenda sintética num SQLite temporário: mede consultas ao índice e reservas concorrentes
+        import random
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        path = os.path.join(tempfile.mkdtemp(prefix="agenda-"), "bench.db")
+        engine = Scheduler(SQLiteCalendarStore(path), min_notice_min=0, max_per_contact=10 ** 9,
+                           horizon_days=60)
+        ids = [item["id"] for item in tenant.catalog]
+        calendar = engine.calendar(tenant)
+        start = time.perf_counter()
+        booked = 0
+        for _ in range(args.bookings):
+            # Bloqueios de 15 a 60 minutos espalhados pelos próximos 30 dias, das 8h às 19h
+            day = datetime.fromtimestamp(after + random.randrange(30) * 86400, engine.tz).replace(
+                hour=8, minute=0, second=0, microsecond=0).timestamp()
+            busy_start = day + random.randrange(44) * engine.step
+            busy_end = busy_start + random.choice((15, 30, 45, 60)) * 60
+            booked += calendar.book(Event(uuid.uuid4().hex, tenant.tenant_id, busy_start, busy_end, "busy"))
+        print(f"{booked} de {args.bookings} bloqueios gravados em {time.perf_counter() - start:.1f}s")
+        timings = []
+        for _ in range(2000):
+            t0 = time.perf_counter()
+            engine.free_slots(tenant, random.choice(ids), after + random.random() * 7 * 86400, count=1)
+            timings.append(time.perf_counter() - t0)
+        timings.sort()
+        print(f"Próximo horário livre: p50 {timings[1000] * 1e6:.0f}µs, p99 {timings[1980] * 1e6:.0f}µs")
+
+        _, slots = engine.free_slots(tenant, ids[0], after, count=1)
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(lambda n: _try_book(engine, tenant, ids[0], slots[0], f"x{n}"), range(16)))
+        print(f"16 reservas concorrentes do mesmo horário: {results.count(True)} aceita, "
+              f"{results.count(False)} recusadas")
+
+
+def _try_book(engine: Scheduler, tenant, procedure: str, start: float, contact: str) -> bool:
+    try:
+        engine.book(tenant, procedure, start, contact)
+        return True
+    except SchedulingError:
+        return False
+
+
+if __name__ == "__main__":
+    main()
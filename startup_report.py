@@ -0,0 +1,101 @@
+import re
+import sys
+import json
+import argparse
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+# Módulos do projeto e SDKs cujo tempo de importação acompanhamos
+DEFAULT_MODULES = [
+    "app",
+    "agent",
+    "whatsapp_client",
+    "utils",
+    "metrics",
+    "tracing",
+    "coalescer",
+    "llm_backend",
+    "google.genai.types",
+    "google.adk.agents",
+    "google.adk.runners",
+    "google.generativeai",
+]
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_import(module: str) -> Tuple[Optional[float], Optional[str]]:
+    """
+    Mede o tempo de importação de um módulo num interpretador novo, com -X importtime.
+
+    Args:
+        module: Nome do módulo
+
+    Returns:
+        Tupla (segundos acumulados, erro)
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        last_line = (proc.stderr.strip().splitlines() or ["erro desconhecido"])[-1]
+        return None, last_line
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        # A linha do próprio módulo (sem indentação) traz o tempo acumulado em microssegundos
+        if match and match.group(4) == module and len(match.group(3)) == 1:
+            cumulative = int(match.group(2)) / 1e6
+    return cumulative, None
+
+
+def top_dependencies(module: str, limit: int = 5) -> List[Tuple[str, float]]:
+    """
+    Lista as dependências diretas mais lentas de um módulo.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    )
+    entries: Dict[str, float] = {}
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match and len(match.group(3)) == 3:
+            entries[match.group(4)] = int(match.group(2)) / 1e6
+    return sorted(entries.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relatório de tempo de importação (cold start)")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--json", action="store_true", help="Saída em JSON")
+    parser.add_argument("--fail-above", type=float,
+                        help="Sai com erro se a importação do app passar deste tempo (segundos)")
+    args = parser.parse_args()
+
+    report = {}
+    for module in args.modules:
+        seconds, error = measure_import(module)
+        report[module] = {"seconds": seconds, "error": error}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'módulo':<28} {'tempo (s)':>10}")
+        for module, result in report.items():
+            value = f"{result['seconds']:.3f}" if result["seconds"] is not None else "erro"
+            print(f"{module:<28} {value:>10}  {result['error'] or ''}")
+        if report.get("app", {}).get("seconds") is not None:
+            print("\nDependências diretas mais lentas de 'app':")
+            for name, seconds in top_dependencies("app"):
+                print(f"  {name:<26} {seconds:>10.3f}")
+
+    app_seconds = report.get("app", {}).get("seconds")
+    if args.fail_above is not None and app_seconds is not None and app_seconds > args.fail_above:
+        print(f"\nImportação do app levou {app_seconds:.3f}s (limite: {args.fail_above:.3f}s)", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,665 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence
+from urllib.parse import urlparse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Onde fica o estado compartilhado entre processos e nós:
+#   memory                      memória do processo (padrão; um único processo)
+#   sqlite:///caminho/estado.db arquivo SQLite (vários workers na mesma máquina)
+#   redis://host:porta/db       servidor Redis (vários nós)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+# Prefixo de todas as chaves (permite compartilhar o mesmo Redis entre ambientes)
+STATE_KEY_PREFIX = os.environ.get("STATE_KEY_PREFIX", "gena:")
+# Timeout de conexão e leitura do Redis, em segundos
+STATE_TIMEOUT = float(os.environ.get("STATE_TIMEOUT", "2.0"))
+
+
+class StateBackend:
+    """
+    Armazenamento chave-valor compartilhado. Valores são strings (os chamadores
+    serializam em JSON) e todas as operações aceitam várias chaves de uma vez,
+    para que cada mensagem custe uma única ida e volta ao servidor.
+    """
+
+    name = "base"
+
+    def __init__(self, prefix: str = STATE_KEY_PREFIX):
+        self.prefix = prefix
+
+    def _k(self, key: str) -> str:
+        return self.prefix + key
+
+    def add_new(self, keys: Sequence[str], ttl: float) -> List[bool]:
+        """
+        Registra as chaves que ainda não existem.
+
+        Args:
+            keys: Chaves a registrar
+            ttl: Tempo de vida em segundos
+
+        Returns:
+            Para cada chave, True se ela foi registrada agora (não existia)
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """
+        Lê vários valores.
+
+        Args:
+            keys: Chaves a ler
+
+        Returns:
+            Valores na mesma ordem das chaves (None para ausentes ou expiradas)
+        """
+        raise NotImplementedError
+
+    def set_many(self, items: Dict[str, str], ttl: Optional[float] = None) -> None:
+        """
+        Grava vários valores.
+
+        Args:
+            items: Dicionário {chave: valor}
+            ttl: Tempo de vida em segundos (None para não expirar)
+        """
+        raise NotImplementedError
+
+    def delete(self, keys: Sequence[str]) -> None:
+        """
+        Remove chaves (valores, listas e contadores).
+        """
+        raise NotImplementedError
+
+    def append(self, key: str, values: Sequence[str], max_len: Optional[int] = None,
+               ttl: Optional[float] = None) -> None:
+        """
+        Acrescenta valores ao fim de uma lista.
+
+        Args:
+            key: Chave da lista
+            values: Valores a acrescentar, em ordem
+            max_len: Mantém só os últimos max_len itens
+            ttl: Tempo de vida da lista em segundos, renovado a cada escrita
+        """
+        raise NotImplementedError
+
+    def get_list(self, key: str) -> List[str]:
+        """
+        Lê uma lista inteira (vazia se não existir).
+        """
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """
+        Incrementa um contador. O ttl vale a partir da criação do contador
+        (janela fixa, usada em limites de taxa).
+
+        Returns:
+            Valor após o incremento
+        """
+        raise NotImplementedError
+
+    def acquire(self, key: str, owner: str, ttl: float) -> bool:
+        """
+        Tenta obter uma concessão exclusiva (lease) que expira sozinha.
+
+        Args:
+            key: Chave da concessão
+            owner: Identificador de quem a obtém
+            ttl: Tempo de vida em segundos
+
+        Returns:
+            True se a concessão foi obtida
+        """
+        raise NotImplementedError
+
+    def release(self, key: str, owner: str) -> None:
+        """
+        Libera uma concessão, se ainda pertencer a owner.
+        """
+        raise NotImplementedError
+
+
+class MemoryStateBackend(StateBackend):
+    """Estado na memória do processo (comportamento original, sem compartilhamento)."""
+
+    name = "memory"
+
+    def __init__(self, prefix: str = STATE_KEY_PREFIX):
+        super().__init__(prefix)
+        # {chave: (valor, expira_em)}; listas são guardadas como list
+        self._data: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    def _get(self, key: str, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry[0]
+
+    def _purge(self, now: float) -> None:
+        # Remoção periódica das chaves expiradas que nunca mais foram lidas
+        self._ops += 1
+        if self._ops % 1000:
+            return
+        for key in [k for k, (_, expires) in self._data.items() if expires is not None and expires <= now]:
+            del self._data[key]
+
+    @staticmethod
+    def _expiry(now: float, ttl: Optional[float]) -> Optional[float]:
+        return now + ttl if ttl is not None else None
+
+    def add_new(self, keys, ttl):
+        now = time.monotonic()
+        result = []
+        with self._lock:
+            self._purge(now)
+            for key in keys:
+                key = self._k(key)
+                if self._get(key, now) is not None:
+                    result.append(False)
+                else:
+                    self._data[key] = ("1", now + ttl)
+                    result.append(True)
+        return result
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return [self._get(self._k(key), now) for key in keys]
+
+    def set_many(self, items, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            for key, value in items.items():
+                self._data[self._k(key)] = (value, self._expiry(now, ttl))
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(self._k(key), None)
+
+    def append(self, key, values, max_len=None, ttl=None):
+        now = time.monotonic()
+        key = self._k(key)
+        with self._lock:
+            items = list(self._get(key, now) or [])
+            items.extend(values)
+            if max_len is not None:
+                items = items[-max_len:]
+            self._data[key] = (items, self._expiry(now, ttl))
+
+    def get_list(self, key):
+        with self._lock:
+            return list(self._get(self._k(key), time.monotonic()) or [])
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.monotonic()
+        key = self._k(key)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._get(key, now) is None:
+                entry = ("0", self._expiry(now, ttl))
+            value = int(entry[0]) + amount
+            self._data[key] = (str(value), entry[1])
+            return value
+
+    def acquire(self, key, owner, ttl):
+        now = time.monotonic()
+        key = self._k(key)
+        with self._lock:
+            current = self._get(key, now)
+            if current is not None and current != owner:
+                return False
+            self._data[key] = (owner, now + ttl)
+            return True
+
+    def release(self, key, owner):
+        key = self._k(key)
+        with self._lock:
+            if self._get(key, time.monotonic()) == owner:
+                del self._data[key]
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    Estado num arquivo SQLite, compartilhado entre os workers de uma mesma
+    máquina (ou entre réplicas com o mesmo volume local).
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, prefix: str = STATE_KEY_PREFIX):
+        super().__init__(prefix)
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # Uma conexão por thread e por processo (conexões não sobrevivem ao fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=STATE_TIMEOUT * 5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _tx(self):
+        # BEGIN IMMEDIATE serializa as escritas entre processos sem deadlock de upgrade
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    @staticmethod
+    def _expiry(now: float, ttl: Optional[float]) -> Optional[float]:
+        return now + ttl if ttl is not None else None
+
+    def _read(self, conn, keys: List[str], now: float) -> Dict[str, str]:
+        if not keys:
+            return {}
+        marks = ",".join("?" * len(keys))
+        rows = conn.execute(
+            f"SELECT key, value FROM kv WHERE key IN ({marks}) AND (expires_at IS NULL OR expires_at > ?)",
+            (*keys, now),
+        )
+        return dict(rows.fetchall())
+
+    def add_new(self, keys, ttl):
+        now = time.time()
+        keys = [self._k(key) for key in keys]
+        conn = self._tx()
+        try:
+            existing = self._read(conn, keys, now)
+            new = [key for key in dict.fromkeys(keys) if key not in existing]
+            conn.executemany("INSERT OR REPLACE INTO kv VALUES (?, '1', ?)", [(key, now + ttl) for key in new])
+            # Remoção oportunista das chaves expiradas
+            conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        claimed = set(new)
+        result = []
+        for key in keys:
+            result.append(key in claimed)
+            claimed.discard(key)
+        return result
+
+    def get_many(self, keys):
+        prefixed = [self._k(key) for key in keys]
+        found = self._read(self._conn(), prefixed, time.time())
+        return [found.get(key) for key in prefixed]
+
+    def set_many(self, items, ttl=None):
+        expires = self._expiry(time.time(), ttl)
+        conn = self._tx()
+        try:
+            conn.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                             [(self._k(key), value, expires) for key, value in items.items()])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, keys):
+        self._conn().executemany("DELETE FROM kv WHERE key = ?", [(self._k(key),) for key in keys])
+
+    def append(self, key, values, max_len=None, ttl=None):
+        now = time.time()
+        key = self._k(key)
+        conn = self._tx()
+        try:
+            current = self._read(conn, [key], now).get(key)
+            items = json.loads(current) if current else []
+            items.extend(values)
+            if max_len is not None:
+                items = items[-max_len:]
+            conn.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                         (key, json.dumps(items, ensure_ascii=False), self._expiry(now, ttl)))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_list(self, key):
+        key = self._k(key)
+        current = self._read(self._conn(), [key], time.time()).get(key)
+        return json.loads(current) if current else []
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        key = self._k(key)
+        conn = self._tx()
+        try:
+            row = conn.execute("SELECT value, expires_at FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                               (key, now)).fetchone()
+            value = (int(row[0]) if row else 0) + amount
+            expires = row[1] if row else self._expiry(now, ttl)
+            conn.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, str(value), expires))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+        key = self._k(key)
+        conn = self._tx()
+        try:
+            current = self._read(conn, [key], now).get(key)
+            acquired = current is None or current == owner
+            if acquired:
+                conn.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, owner, now + ttl))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def release(self, key, owner):
+        self._conn().execute("DELETE FROM kv WHERE key = ? AND value = ?", (self._k(key), owner))
+
+
+class RedisError(Exception):
+    """Erro devolvido pelo servidor Redis."""
+
+
+class RedisStateBackend(StateBackend):
+    """
+    Estado num servidor Redis (ou compatível), falando o protocolo RESP
+    diretamente. Os comandos de cada operação seguem em pipeline: uma única
+    escrita no socket e uma única ida e volta.
+    """
+
+    name = "redis"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, timeout: float = STATE_TIMEOUT,
+                 prefix: str = STATE_KEY_PREFIX):
+        super().__init__(prefix)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    # ===== PROTOCOLO =====
+
+    @staticmethod
+    def _encode(args: Iterable) -> bytes:
+        parts = []
+        count = 0
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+            count += 1
+        return b"*%d\r\n" % count + b"".join(parts)
+
+    def _read_reply(self, f):
+        line = f.readline()
+        if not line:
+            raise ConnectionError("Conexão com o Redis encerrada")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            return RedisError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = f.read(size + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            size = int(rest)
+            if size < 0:
+                return None
+            return [self._read_reply(f) for _ in range(size)]
+        raise RedisError(f"Resposta inválida do Redis: {line!r}")
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        f = sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            sock.sendall(b"".join(self._encode(cmd) for cmd in setup))
+            for _ in setup:
+                reply = self._read_reply(f)
+                if isinstance(reply, RedisError):
+                    raise reply
+        return sock, f
+
+    def pipeline(self, commands: Sequence[Sequence]) -> List:
+        """
+        Envia vários comandos de uma vez e lê todas as respostas.
+
+        Args:
+            commands: Lista de comandos, ex: [("SET", "k", "v"), ("GET", "k")]
+
+        Returns:
+            Respostas na mesma ordem
+        """
+        # Uma conexão por thread e por processo; reconecta uma vez em caso de falha
+        for attempt in (1, 2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None or self._local.pid != os.getpid():
+                conn = self._local.conn = self._connect()
+                self._local.pid = os.getpid()
+            sock, f = conn
+            try:
+                sock.sendall(b"".join(self._encode(cmd) for cmd in commands))
+                replies = [self._read_reply(f) for _ in commands]
+                break
+            except (OSError, ConnectionError):
+                self._local.conn = None
+                sock.close()
+                if attempt == 2:
+                    raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    # ===== OPERAÇÕES =====
+
+    def add_new(self, keys, ttl):
+        px = max(1, int(ttl * 1000))
+        replies = self.pipeline([("SET", self._k(key), "1", "NX", "PX", px) for key in keys])
+        return [reply == "OK" for reply in replies]
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return self.pipeline([("MGET", *[self._k(key) for key in keys])])[0]
+
+    def set_many(self, items, ttl=None):
+        if not items:
+            return
+        expiry = ("PX", max(1, int(ttl * 1000))) if ttl is not None else ()
+        self.pipeline([("SET", self._k(key), value, *expiry) for key, value in items.items()])
+
+    def delete(self, keys):
+        if keys:
+            self.pipeline([("DEL", *[self._k(key) for key in keys])])
+
+    def append(self, key, values, max_len=None, ttl=None):
+        key = self._k(key)
+        # RPUSH sem valores é rejeitado pelo Redis; o ttl e o corte continuam valendo
+        commands = [("RPUSH", key, *values)] if values else []
+        if max_len is not None:
+            commands.append(("LTRIM", key, -max_len, -1))
+        if ttl is not None:
+            commands.append(("PEXPIRE", key, max(1, int(ttl * 1000))))
+        if commands:
+            self.pipeline(commands)
+
+    def get_list(self, key):
+        return self.pipeline([("LRANGE", self._k(key), 0, -1)])[0]
+
+    def incr(self, key, amount=1, ttl=None):
+        key = self._k(key)
+        commands = []
+        if ttl is not None:
+            # Cria o contador com o ttl só se ainda não existir; INCRBY preserva o ttl
+            commands.append(("SET", key, "0", "NX", "PX", max(1, int(ttl * 1000))))
+        commands.append(("INCRBY", key, amount))
+        return self.pipeline(commands)[-1]
+
+    def acquire(self, key, owner, ttl):
+        key = self._k(key)
+        px = max(1, int(ttl * 1000))
+        acquired, current = self.pipeline([("SET", key, owner, "NX", "PX", px), ("GET", key)])
+        if acquired == "OK":
+            return True
+        if current == owner:
+            # Renovação pelo próprio dono
+            self.pipeline([("PEXPIRE", key, px)])
+            return True
+        return False
+
+    def release(self, key, owner):
+        # Sem scripts Lua: a janela entre GET e DEL só importa se a concessão
+        # expirar exatamente nesse intervalo
+        key = self._k(key)
+        if self.pipeline([("GET", key)])[0] == owner:
+            self.pipeline([("DEL", key)])
+
+
+class _TimedBackend:
+    """Registra a latência de cada operação do backend no Prometheus."""
+
+    def __init__(self, backend: StateBackend):
+        self._backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, op):
+        target = getattr(self._backend, op)
+        if not callable(target):
+            return target
+
+        def call(*args, **kwargs):
+            with metrics.timed(metrics.STATE_LATENCY, backend=self.name, op=op):
+                return target(*args, **kwargs)
+        return call
+
+
+def create_state(url: str = STATE_BACKEND) -> StateBackend:
+    """
+    Cria o backend de estado a partir da URL de configuração.
+
+    Args:
+        url: memory, sqlite:///caminho ou redis://[:senha@]host:porta/db
+
+    Returns:
+        Backend configurado
+    """
+    if url == "memory":
+        return MemoryStateBackend()
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        # sqlite:///estado.db (relativo) ou sqlite:////var/lib/gena/estado.db (absoluto)
+        return SQLiteStateBackend(parsed.path[1:] if parsed.path.startswith("/") else parsed.path)
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RedisStateBackend(parsed.hostname or "127.0.0.1", parsed.port or 6379, db, parsed.password)
+    raise ValueError(f"STATE_BACKEND desconhecido: {url}")
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state() -> StateBackend:
+    """
+    Retorna o backend de estado do processo (criado a partir das variáveis de ambiente).
+    """
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                _state = _TimedBackend(create_state())
+                logger.info(f"Backend de estado: {_state.name}")
+    return _state
+
+
+def set_state(backend: StateBackend) -> None:
+    """
+    Substitui o backend de estado do processo (útil em benchmarks e testes de carga).
+
+    Args:
+        backend: Novo backend
+    """
+    global _state
+    with _state_lock:
+        _state = _TimedBackend(backend)
+
+
+@contextmanager
+def lease(key: str, ttl: float, wait: float):
+    """
+    Executa um bloco com uma concessão exclusiva entre processos e nós,
+    aguardando até wait segundos caso outro dono a detenha.
+
+    Args:
+        key: Chave da concessão
+        ttl: Tempo de vida da concessão em segundos (libera donos que morreram)
+        wait: Tempo máximo de espera em segundos
+
+    Returns:
+        True dentro do bloco se a concessão foi obtida (o bloco roda mesmo sem ela)
+    """
+    backend = get_state()
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+    delay = 0.02
+    try:
+        acquired = backend.acquire(key, owner, ttl)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            acquired = backend.acquire(key, owner, ttl)
+        if not acquired:
+            logger.warning(f"Concessão '{key}' não obtida em {wait:.0f}s; seguindo sem ela")
+    except Exception as e:
+        # Sem o backend de estado, o turno roda sem a concessão (como a deduplicação e o histórico)
+        metrics.record_error("state", e)
+        logger.error(f"Erro ao obter a concessão '{key}'; seguindo sem ela: {str(e)}")
+        acquired = False
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                backend.release(key, owner)
+            except Exception as e:
+                metrics.record_error("state", e)
+                logger.error(f"Erro ao liberar a concessão '{key}' (expira em {ttl:.0f}s): {str(e)}")
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+import event_log
+from whatsapp_client import WhatsAppClient, create_client_from_env
+
+logger = logging.getLogger(__name__)
+
+# Arquivo JSON com a configuração das clínicas (opcional; sem ele, só a clínica padrão)
+TENANTS_FILE = os.environ.get("TENANTS_FILE")
+# Arquivo JSON com o conteúdo da clínica padrão (prompt, catálogo, mensagens...); sem ele, vale o de agent.py
+CONTENT_FILE = os.environ.get("CONTENT_FILE")
+# Intervalo entre verificações dos arquivos de conteúdo (0 desliga a recarga)
+CONTENT_RELOAD_S = float(os.environ.get("CONTENT_RELOAD_S", "5"))
+# Máximo de agentes mantidos em memória (os menos usados são descartados)
+TENANT_AGENT_CACHE_SIZE = int(os.environ.get("TENANT_AGENT_CACHE_SIZE", "32"))
+
+DEFAULT_TENANT_ID = "default"
+
+
+@dataclass
+class Tenant:
+    """Configuração de uma clínica (número de WhatsApp, prompt e conteúdo)."""
+
+    tenant_id: str
+    phone_number_id: Optional[str]
+    access_token: Optional[str]
+    name: str
+    prompt: str
+    description: str
+    model: str = "gemini-2.0-flash"
+    catalog: List[Dict[str, Any]] = field(default_factory=list)
+    location: Dict[str, Any] = field(default_factory=dict)
+    buttons: List[Dict[str, str]] = field(default_factory=list)
+    messages: Dict[str, str] = field(default_factory=dict)
+    # Expediente por dia da semana ({"seg": ["09:00-12:00", "13:00-18:00"], ...}), usado pela agenda
+    hours: Dict[str, List[str]] = field(default_factory=dict)
+    # Versão do conteúdo (declarada no arquivo e hash do conteúdo); o cache de agentes usa (ID, versão)
+    version: str = ""
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], defaults: Dict[str, Any], base_dir: str = ".") -> "Tenant":
+        """
+        Cria a configuração de uma clínica; campos ausentes usam o conteúdo padrão.
+
+        Args:
+            data: Configuração da clínica
+            defaults: Conteúdo padrão
+            base_dir: Diretório base para caminhos relativos (prompt_file)
+
+        Returns:
+            Configuração da clínica
+        """
+        prompt = data.get("prompt")
+        if prompt is None and data.get("prompt_file"):
+            with open(os.path.join(base_dir, data["prompt_file"]), encoding="utf-8") as f:
+                prompt = f.read()
+        access_token = data.get("access_token")
+        if access_token is None and data.get("access_token_env"):
+            access_token = os.environ.get(data["access_token_env"])
+        messages = dict(defaults.get("messages", {}))
+        messages.update(data.get("messages", {}))
+        tenant = cls(
+            tenant_id=data["id"],
+            phone_number_id=data.get("phone_number_id"),
+            access_token=access_token,
+            name=data.get("name", defaults.get("name", "")),
+            prompt=prompt if prompt is not None else defaults["prompt"],
+            description=data.get("description", defaults.get("description", "")),
+            model=data.get("model", defaults.get("model", "gemini-2.0-flash")),
+            catalog=data.get("catalog", defaults.get("catalog", [])),
+            location=data.get("location", defaults.get("location", {})),
+            buttons=data.get("buttons", defaults.get("buttons", [])),
+            messages=messages,
+            hours=data.get("hours", defaults.get("hours", {})),
+        )
+        content = json.dumps([tenant.name, tenant.prompt, tenant.description, tenant.model, tenant.catalog,
+                              tenant.location, tenant.buttons, tenant.messages, tenant.hours], sort_keys=True)
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+        declared = data.get("version", defaults.get("version"))
+        tenant.version = f"{declared}-{digest}" if declared else digest
+        return tenant
+
+    def list_sections(self) -> List[Dict[str, Any]]:
+        """
+        Monta as seções da mensagem de lista de procedimentos a partir do catálogo.
+        """
+        rows = []
+        for item in self.catalog:
+            description = item.get("description", "")
+            if item.get("price"):
+                description = f"{description} Valor: R$ {item['price']}"
+            rows.append({"id": item["id"], "title": item["title"], "description": description})
+        return [{"title": self.messages.get("procedimentos_secao", "Procedimentos"), "rows": rows}]
+
+    def catalog_images(self) -> List[str]:
+        """
+        URLs das imagens do catálogo (enviadas por upload uma única vez).
+        """
+        return [item["image"] for item in self.catalog if item.get("image")]
+
+
+class _Snapshot:
+    """Versão carregada das clínicas, substituída por inteiro a cada recarga."""
+
+    __slots__ = ("tenants", "by_id", "default", "files")
+
+    def __init__(self, tenants: Dict[str, Tenant], default: Tenant, files: Dict[str, Tuple[int, int]]):
+        self.tenants = tenants
+        self.default = default
+        self.by_id = {tenant.tenant_id: tenant for tenant in tenants.values()}
+        self.by_id[DEFAULT_TENANT_ID] = default
+        # Arquivos lidos, com (mtime, tamanho) no momento da leitura
+        self.files = files
+
+
+def _file_signature(path: str) -> Tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (0, 0)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class TenantRegistry:
+    """
+    Resolve a clínica a partir do phone_number_id do webhook e mantém, por clínica,
+    o cliente WhatsApp e o agente (criado sob demanda e descartado por LRU).
+
+    O conteúdo vem de CONTENT_FILE e TENANTS_FILE (ou do conteúdo padrão). Uma
+    thread por processo verifica os arquivos a cada CONTENT_RELOAD_S e, quando
+    mudam, monta a nova versão inteira antes de substituí-la numa única
+    atribuição: mensagens em andamento terminam com a versão que já tinham, e os
+    agentes da versão antiga saem do cache.
+    """
+
+    def __init__(self, default_content: Dict[str, Any], tenants_file: Optional[str] = TENANTS_FILE,
+                 agent_cache_size: int = TENANT_AGENT_CACHE_SIZE, content_file: Optional[str] = CONTENT_FILE,
+                 reload_s: float = CONTENT_RELOAD_S):
+        """
+        Args:
+            default_content: Conteúdo da clínica padrão (prompt, catálogo, mensagens...)
+            tenants_file: Arquivo JSON com as clínicas
+            agent_cache_size: Máximo de agentes em memória
+            content_file: Arquivo JSON que substitui o conteúdo padrão
+            reload_s: Intervalo entre verificações dos arquivos em segundos (0 desliga)
+        """
+        self.default_content = default_content
+        self.tenants_file = tenants_file
+        self.content_file = content_file
+        self.agent_cache_size = agent_cache_size
+        self.reload_s = reload_s
+        self._snapshot: Optional[_Snapshot] = None
+        self._clients: Dict[str, WhatsAppClient] = {}
+        self._agents: "OrderedDict[Tuple[str, str], Any]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._watcher: Optional[threading.Thread] = None
+        self._watcher_pid: Optional[int] = None
+
+    def _build(self) -> _Snapshot:
+        # Leitura e validação completas, fora do lock: a versão em uso continua atendendo
+        files: Dict[str, Tuple[int, int]] = {}
+
+        def read_json(path: str) -> Dict[str, Any]:
+            files[path] = _file_signature(path)
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+
+        def resolve_prompt(data: Dict[str, Any], base_dir: str) -> Dict[str, Any]:
+            if data.get("prompt") is None and data.get("prompt_file"):
+                path = os.path.join(base_dir, data["prompt_file"])
+                files[path] = _file_signature(path)
+            return data
+
+        defaults = self.default_content
+        if self.content_file:
+            content = read_json(self.content_file)
+            base_dir = os.path.dirname(os.path.abspath(self.content_file))
+            resolve_prompt(content, base_dir)
+            # O conteúdo do arquivo vira o novo padrão (inclusive das clínicas de TENANTS_FILE)
+            base = Tenant.from_dict(dict(content, id=DEFAULT_TENANT_ID), self.default_content, base_dir)
+            defaults = dict(asdict(base), version=content.get("version"))
+
+        default = Tenant.from_dict(
+            {"id": DEFAULT_TENANT_ID, "phone_number_id": os.environ.get("WHATSAPP_PHONE_NUMBER_ID"),
+             "access_token": os.environ.get("WHATSAPP_ACCESS_TOKEN")},
+            defaults,
+        )
+        tenants: Dict[str, Tenant] = {}
+        if self.tenants_file:
+            data = read_json(self.tenants_file)
+            base_dir = os.path.dirname(os.path.abspath(self.tenants_file))
+            for item in data.get("tenants", []):
+                tenant = Tenant.from_dict(resolve_prompt(item, base_dir), defaults, base_dir)
+                if not tenant.phone_number_id:
+                    raise ValueError(f"Clínica '{tenant.tenant_id}' sem phone_number_id")
+                tenants[tenant.phone_number_id] = tenant
+        return _Snapshot(tenants, default, files)
+
+    def _load(self) -> _Snapshot:
+        # Carregado na primeira utilização, nunca na importação
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._build()
+                    if self.tenants_file:
+                        logger.info(f"{len(self._snapshot.tenants)} clínicas carregadas de {self.tenants_file}")
+                snapshot = self._snapshot
+        self._ensure_watching()
+        return snapshot
+
+    def _ensure_watching(self) -> None:
+        # Thread criada sob demanda, também depois de um fork do Gunicorn
+        if self.reload_s <= 0 or (self._watcher is not None and self._watcher_pid == os.getpid()):
+            return
+        with self._lock:
+            if self._watcher is not None and self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+            self._watcher = threading.Thread(target=self._run_watcher, name="content-watcher", daemon=True)
+            self._watcher.start()
+
+    def _run_watcher(self) -> None:
+        while True:
+            time.sleep(self.reload_s)
+            snapshot = self._snapshot
+            if snapshot is not None and any(_file_signature(path) != signature
+                                            for path, signature in snapshot.files.items()):
+                self.reload()
+
+    def reload(self) -> bool:
+        """
+        Recarrega o conteúdo das clínicas. Com erro no arquivo, a versão em uso é mantida.
+
+        Returns:
+            True se a nova versão foi carregada
+        """
+        try:
+            snapshot = self._build()
+        except Exception as e:
+            metrics.record_error("content_reload", e)
+            metrics.CONTENT_RELOADS.labels(outcome="error").inc()
+            logger.error(f"Conteúdo das clínicas não recarregado (versão em uso mantida): {str(e)}")
+            # Não tentar de novo até o arquivo mudar outra vez
+            with self._lock:
+                if self._snapshot is not None:
+                    self._snapshot.files = {path: _file_signature(path) for path in self._snapshot.files}
+            return False
+        with self._lock:
+            previous, self._snapshot = self._snapshot, snapshot
+            versions = {(tenant.tenant_id, tenant.version) for tenant in snapshot.by_id.values()}
+            for key in [key for key in self._agents if key not in versions]:
+                del self._agents[key]
+            for tenant in snapshot.by_id.values():
+                old = previous.by_id.get(tenant.tenant_id) if previous else None
+                if old is not None and (old.phone_number_id, old.access_token) != \
+                        (tenant.phone_number_id, tenant.access_token):
+                    self._clients.pop(tenant.tenant_id, None)
+                client = self._clients.get(tenant.tenant_id)
+                # Imagens novas do catálogo sobem antes de serem pedidas
+                if old is not None and old.version != tenant.version and client is not None \
+                        and client.media_cache is not None:
+                    client.media_cache.set_catalog(tenant.catalog_images())
+        metrics.CONTENT_RELOADS.labels(outcome="ok").inc()
+        changed = [tenant_id for tenant_id, tenant in snapshot.by_id.items()
+                   if previous is None or tenant_id not in previous.by_id
+                   or previous.by_id[tenant_id].version != tenant.version]
+        logger.info(f"Conteúdo das clínicas recarregado: {', '.join(changed) or 'sem mudanças'}")
+        return True
+
+    def default(self) -> Tenant:
+        """
+        Retorna a clínica padrão (configurada pelas variáveis de ambiente).
+        """
+        return self._load().default
+
+    def get(self, tenant_id: str) -> Tenant:
+        """
+        Retorna a clínica pelo ID.
+
+        Args:
+            tenant_id: ID da clínica
+
+        Returns:
+            Clínica
+        """
+        return self._load().by_id[tenant_id]
+
+    def resolve(self, phone_number_id: Optional[str]) -> Optional[Tenant]:
+        """
+        Resolve a clínica dona do número que recebeu a mensagem.
+
+        Args:
+            phone_number_id: metadata.phone_number_id do webhook
+
+        Returns:
+            Clínica ou None se o número não pertence a nenhuma clínica configurada
+        """
+        snapshot = self._load()
+        tenant = snapshot.tenants.get(phone_number_id) if phone_number_id else None
+        if tenant is not None:
+            return tenant
+        # Sem arquivo de clínicas, tudo vai para a clínica padrão
+        if not snapshot.tenants or phone_number_id in (None, snapshot.default.phone_number_id):
+            return snapshot.default
+        return None
+
+    def get_client(self, tenant: Tenant) -> WhatsAppClient:
+        """
+        Retorna o cliente WhatsApp da clínica (um por clínica, reutilizado).
+
+        Args:
+            tenant: Clínica
+
+        Returns:
+            Cliente WhatsApp
+        """
+        client = self._clients.get(tenant.tenant_id)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(tenant.tenant_id)
+                if client is None:
+                    if tenant.tenant_id == DEFAULT_TENANT_ID:
+                        client = create_client_from_env()
+                    else:
+                        if not tenant.access_token:
+                            raise ValueError(f"Clínica '{tenant.tenant_id}' sem token de acesso")
+                        client = WhatsAppClient(tenant.phone_number_id, tenant.access_token)
+                    self._clients[tenant.tenant_id] = client
+                    # Upload antecipado das imagens do catálogo, fora do caminho da resposta
+                    if client.media_cache is not None:
+                        client.media_cache.set_catalog(tenant.catalog_images())
+        return client
+
+    def get_agent(self, tenant: Tenant, builder: Callable[[Tenant], Any]) -> Any:
+        """
+        Retorna o agente da versão da clínica, criando-o com builder se não estiver em cache.
+
+        Args:
+            tenant: Clínica
+            builder: Função que cria o agente para a clínica
+
+        Returns:
+            Agente da clínica
+        """
+        key = (tenant.tenant_id, tenant.version)
+        with self._lock:
+            agent = self._agents.get(key)
+            if agent is not None:
+                self._agents.move_to_end(key)
+        event_log.emit("cache", cache="agent", hit=agent is not None, tenant=tenant.tenant_id)
+        if agent is not None:
+            return agent
+        agent = builder(tenant)
+        with self._lock:
+            # Uma mensagem que começou antes da recarga não devolve a versão antiga ao cache
+            current = self._snapshot.by_id.get(tenant.tenant_id) if self._snapshot else None
+            if current is None or current.version == tenant.version:
+                self._agents[key] = agent
+                self._agents.move_to_end(key)
+            while len(self._agents) > self.agent_cache_size:
+                (evicted, _), _ = self._agents.popitem(last=False)
+                logger.info(f"Agente da clínica '{evicted}' removido do cache")
+        return agent
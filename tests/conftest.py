@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Arquivos gerados pelos módulos (log de eventos, traces, roteador) ficam fora da árvore
+_TMP = tempfile.mkdtemp(prefix="gena-tests-")
+os.environ.setdefault("EVENT_LOG_DIR", os.path.join(_TMP, "events"))
+os.environ.setdefault("TRACE_EXPORT_PATH", os.path.join(_TMP, "traces.jsonl"))
+os.environ.setdefault("STATUS_DB_PATH", os.path.join(_TMP, "delivery_status.db"))
+os.environ.setdefault("INTENT_MODEL_PATH", "")
+os.environ.setdefault("CONTENT_RELOAD_S", "0")
+
+
+class FakeAgent:
+    """Agent do ADK reduzido aos atributos usados pelo agent.py."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@pytest.fixture
+def fake_sdk(monkeypatch):
+    """
+    Substitui o ADK por objetos simples (o google.adk não é necessário nos testes).
+    """
+    import agent
+    sdk = SimpleNamespace(Agent=FakeAgent, Runner=None, InMemorySessionService=None, RunConfig=None,
+                          StreamingMode=None, types=None)
+    monkeypatch.setattr(agent, "_sdk", sdk)
+    return sdk
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    Mensagens enviadas pelo agent.send_message, como (destinatário, tipo, argumentos).
+    """
+    import agent
+    messages = []
+
+    def send_message(to, type, message="", image_url="", tenant=None):
+        messages.append((to, str(type).lower(), message))
+        return "ok"
+
+    monkeypatch.setattr(agent, "send_message", send_message)
+    return messages
+
+
+@pytest.fixture
+def fresh_state():
+    """
+    Estado compartilhado em memória, vazio, para cada teste.
+    """
+    import state
+    state.set_state(state.MemoryStateBackend())
+    yield state.get_state()
+    state.set_state(state.MemoryStateBackend())
+
+
+@pytest.fixture
+def gemini_breaker(monkeypatch):
+    """
+    Disjuntor do Gemini novo (fechado) para cada teste.
+    """
+    import circuit_breaker
+    breaker = circuit_breaker.CircuitBreaker("gemini-test")
+    monkeypatch.setattr(circuit_breaker, "gemini", breaker)
+    return breaker
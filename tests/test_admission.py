@@ -0,0 +1,132 @@
+import time
+
+import pytest
+
+import admission
+import state
+from admission import CONVERSATION, DEFERRED, INTERACTIVE, NEW, AdmissionController
+
+
+class FakeCoalescer:
+    """Só o que a admissão consulta: lotes aguardando por classe e contatos com lote aberto."""
+
+    def __init__(self):
+        self.backlogs = {INTERACTIVE: 0, CONVERSATION: 0, NEW: 0, DEFERRED: 0}
+        self.pending = set()
+        self.collecting = set()
+
+    def backlog(self, priority):
+        return self.backlogs[priority]
+
+    def is_pending(self, contact):
+        return contact in self.pending
+
+    def is_collecting(self, contact):
+        return contact in self.collecting
+
+
+LIMITS = {INTERACTIVE: 2, CONVERSATION: 2, NEW: 1, DEFERRED: 1}
+CONTACT = ("default", "5548999990000")
+
+
+@pytest.fixture
+def coalescer():
+    return FakeCoalescer()
+
+
+@pytest.fixture
+def controller(coalescer, fresh_state):
+    return AdmissionController(coalescer, dict(LIMITS), active_s=60, ack_interval_s=60)
+
+
+def test_classify(controller, coalescer):
+    assert controller.classify(CONTACT, "interactive") == INTERACTIVE
+    assert controller.classify(CONTACT, "text") == NEW
+
+    controller.turn_finished(CONTACT)
+    assert controller.classify(CONTACT, "text") == CONVERSATION
+
+    other = ("default", "5548999990001")
+    coalescer.pending.add(other)
+    assert controller.classify(other, "text") == CONVERSATION
+
+
+def test_conversation_expires(coalescer, fresh_state):
+    controller = AdmissionController(coalescer, dict(LIMITS), active_s=0.05)
+    controller.turn_finished(CONTACT)
+    time.sleep(0.1)
+    assert controller.classify(CONTACT, "text") == NEW
+
+
+def test_admit_defer_shed(controller, coalescer):
+    assert controller.admit(CONTACT, "text").outcome == "admitted"
+
+    coalescer.backlogs[NEW] = LIMITS[NEW]
+    deferred = controller.admit(CONTACT, "text")
+    assert (deferred.outcome, deferred.priority, deferred.priority_class, deferred.ack) == \
+        ("deferred", DEFERRED, "new", "aguarde")
+
+    coalescer.backlogs[DEFERRED] = LIMITS[DEFERRED]
+    shed = controller.admit(("default", "5548999990001"), "text")
+    assert (shed.outcome, shed.priority, shed.ack) == ("shed", NEW, "ocupado")
+
+
+def test_higher_classes_admitted_while_new_is_full(controller, coalescer):
+    coalescer.backlogs[NEW] = LIMITS[NEW]
+    coalescer.backlogs[DEFERRED] = LIMITS[DEFERRED]
+
+    assert controller.admit(CONTACT, "interactive").outcome == "admitted"
+    controller.turn_finished(CONTACT)
+    assert controller.admit(CONTACT, "text").priority_class == "conversation"
+    assert controller.admit(CONTACT, "text").outcome == "admitted"
+
+
+def test_open_batch_is_admitted_when_full(controller, coalescer):
+    coalescer.backlogs = {priority: 10 for priority in coalescer.backlogs}
+    coalescer.collecting.add(CONTACT)
+
+    assert controller.admit(CONTACT, "text").outcome == "admitted"
+
+
+def test_ack_throttled_across_controllers(coalescer, fresh_state):
+    # Dois workers com o mesmo estado compartilhado: um aviso por contato por intervalo
+    first = AdmissionController(coalescer, dict(LIMITS), ack_interval_s=60)
+    second = AdmissionController(coalescer, dict(LIMITS), ack_interval_s=60)
+    coalescer.backlogs[NEW] = LIMITS[NEW]
+
+    assert first.admit(CONTACT, "text").ack == "aguarde"
+    assert second.admit(CONTACT, "text").ack is None
+    assert first.admit(("default", "5548999990001"), "text").ack == "aguarde"
+
+
+class BrokenState(state.MemoryStateBackend):
+    def _broken(self, *args, **kwargs):
+        raise ConnectionError("estado indisponível")
+
+    get_many = set_many = add_new = _broken
+
+
+def test_state_errors_fail_open(coalescer):
+    state.set_state(BrokenState())
+    try:
+        controller = AdmissionController(coalescer, dict(LIMITS))
+        controller.turn_finished(CONTACT)
+        assert controller.classify(CONTACT, "text") == NEW
+        coalescer.backlogs[NEW] = LIMITS[NEW]
+        # Sem o estado, o aviso é enviado (melhor repetir do que deixar sem resposta)
+        assert controller.admit(CONTACT, "text").ack == "aguarde"
+    finally:
+        state.set_state(state.MemoryStateBackend())
+
+
+def test_batch_of_removed_tenant_finishes_turn(monkeypatch):
+    import agent
+    import app
+    finished = []
+    monkeypatch.setattr(app.admission_controller, "turn_finished", finished.append)
+    monkeypatch.setattr(agent, "process_user_input", lambda *args, **kwargs: pytest.fail("turno sem clínica"))
+
+    # Clínica removida por uma recarga enquanto o lote esperava
+    app.run_agent_turn(("removida", "5548999990000"), ["oi"])
+
+    assert finished == [("removida", "5548999990000")]
@@ -0,0 +1,44 @@
+import pytest
+
+import agent
+import llm_backend
+
+
+@pytest.fixture
+def no_sdk(monkeypatch):
+    """
+    ADK indisponível: qualquer tentativa de carregá-lo falha o teste.
+    """
+    def load_sdk():
+        raise AssertionError("ADK carregado com backend offline")
+    monkeypatch.setattr(agent, "_load_sdk", load_sdk)
+
+
+@pytest.mark.parametrize("mode", ["synthetic", "replay"])
+def test_offline_backend_builds_agent_without_sdk(monkeypatch, no_sdk, tmp_path, mode):
+    cassette = tmp_path / "cassette.jsonl"
+    cassette.write_text("")
+    backend = llm_backend.create_backend(mode, str(cassette))
+    monkeypatch.setattr(llm_backend, "_backend", backend)
+
+    buscador = agent._build_agent(agent.tenant_registry.default())
+
+    assert buscador.name == "Secretária Virtual"
+    assert any(tool.__name__ == "send_message" for tool in buscador.tools)
+
+
+def test_synthetic_turn_without_sdk(monkeypatch, no_sdk, gemini_breaker):
+    monkeypatch.setattr(llm_backend, "_backend", llm_backend.create_backend("synthetic"))
+    buscador = agent._build_agent(agent.tenant_registry.default())
+
+    result = agent.call_agent(buscador, "onde fica a clínica?", "5548999990000")
+
+    assert result.function_calls == [{"name": "send_message", "args": {"type": "ENDERECO"}}]
+
+
+def test_live_backend_uses_sdk(monkeypatch, fake_sdk):
+    monkeypatch.setattr(llm_backend, "_backend", llm_backend.LiveBackend())
+
+    buscador = agent._build_agent(agent.tenant_registry.default())
+
+    assert isinstance(buscador, fake_sdk.Agent)
@@ -0,0 +1,115 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import agent
+import hedging
+import usage
+
+
+class FakeEvent:
+    def __init__(self, tokens=0, calls=(), final=False):
+        self.partial = False
+        self.usage_metadata = SimpleNamespace(prompt_token_count=tokens, candidates_token_count=1) if tokens else None
+        self.content = SimpleNamespace(parts=[]) if final else None
+        self._calls = [SimpleNamespace(name=name, args=args) for name, args in calls]
+        self._final = final
+
+    def get_function_calls(self):
+        return self._calls
+
+    def is_final_response(self):
+        return self._final
+
+
+@pytest.fixture
+def streaming_sdk(fake_sdk):
+    """
+    Runner falso: cada sessão (uma por tentativa do hedging) segue o roteiro em fake_sdk.scripts.
+    """
+    scripts = {}
+
+    class Runner:
+        def __init__(self, agent, app_name, session_service):
+            pass
+
+        async def run_async(self, user_id, session_id, new_message, run_config):
+            for step in scripts[session_id]:
+                if isinstance(step, float):
+                    await asyncio.sleep(step)
+                elif isinstance(step, Exception):
+                    raise step
+                else:
+                    yield step
+
+    fake_sdk.Runner = Runner
+    fake_sdk.InMemorySessionService = lambda: SimpleNamespace(create_session=lambda **kwargs: None)
+    fake_sdk.RunConfig = lambda **kwargs: None
+    fake_sdk.StreamingMode = SimpleNamespace(SSE="sse")
+    fake_sdk.types = SimpleNamespace(Part=lambda **kwargs: kwargs, Content=lambda **kwargs: kwargs)
+    fake_sdk.scripts = scripts
+    return fake_sdk
+
+
+@pytest.fixture
+def recorded(monkeypatch):
+    records = []
+    monkeypatch.setattr(usage, "record", lambda u, tenant_id=None, contact=None: records.append((u, contact)))
+    return records
+
+
+def _run(buscador, turn):
+    async def main():
+        token = agent._current_turn.set(turn)
+        try:
+            return await agent._run_agent_streaming(buscador, "oi", "5511999999999")
+        finally:
+            agent._current_turn.reset(token)
+    return asyncio.run(main())
+
+
+def _agent():
+    def send_message(to, type, message="", image_url=""):
+        return "ok"
+    return SimpleNamespace(name="gena", model="gemini-2.0-flash", tools=[send_message])
+
+
+def test_hedged_loser_usage_is_recorded(streaming_sdk, recorded, monkeypatch):
+    monkeypatch.setattr(hedging, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(hedging, "HEDGE_DELAY_S", 0.02)
+    monkeypatch.setattr(hedging, "gemini", hedging.Hedger("gemini-test"))
+    reply = [("send_message", {"type": "text", "message": "Olá!"})]
+    streaming_sdk.scripts.update({
+        "session0": [FakeEvent(tokens=100), 1.0, FakeEvent(tokens=10, calls=reply, final=True)],
+        "session1": [FakeEvent(tokens=200, calls=reply, final=True)],
+    })
+    turn = {"tenant": "t1", "contact": "5511999999999", "intent": None}
+
+    result = _run(_agent(), turn)
+
+    assert result.input_tokens == 200
+    tokens = sorted(u.input_tokens for u, _ in recorded)
+    assert tokens == [100, 200]
+    assert all(contact == "5511999999999" for _, contact in recorded)
+    assert turn["usage_recorded"]
+
+
+def test_failed_attempt_usage_is_recorded(streaming_sdk, recorded, monkeypatch):
+    monkeypatch.setattr(hedging, "HEDGE_ENABLED", False)
+    streaming_sdk.scripts["session0"] = [FakeEvent(tokens=150), RuntimeError("503")]
+
+    with pytest.raises(RuntimeError):
+        _run(_agent(), {"tenant": "t1", "contact": "5511999999999", "intent": "WELCOME"})
+
+    assert [(u.input_tokens, u.flow) for u, _ in recorded] == [(150, "WELCOME")]
+
+
+def test_attempt_without_usage_is_not_recorded(streaming_sdk, recorded, monkeypatch):
+    monkeypatch.setattr(hedging, "HEDGE_ENABLED", False)
+    streaming_sdk.scripts["session0"] = [RuntimeError("503")]
+
+    with pytest.raises(RuntimeError):
+        _run(_agent(), {"tenant": "t1", "contact": "5511999999999", "intent": None})
+
+    assert recorded == []
@@ -0,0 +1,180 @@
+import io
+import math
+import os
+import random
+import time
+import wave
+from array import array
+
+import pytest
+
+import llm_backend
+import whatsapp_client
+
+RATE = 8000
+# Cada frase é um tom com frequência própria; a "transcrição" devolve o nome da frase
+BASE_HZ, STEP_HZ = 300, 50
+
+
+def _phrase_name(index):
+    return f"frase{index:02d}"
+
+
+def _voice_note(seconds=150.0, seed=7):
+    """
+    Nota de voz sintética: frases de 4 a 9 s separadas por pausas de 0,5 a 1 s,
+    com um chiado de fundo bem abaixo do nível de silêncio.
+    """
+    rng = random.Random(seed)
+    samples, phrases, t = array("h"), [], 0.0
+    while t < seconds:
+        index = len(phrases)
+        length = rng.uniform(4.0, 9.0)
+        freq = BASE_HZ + STEP_HZ * index
+        samples.extend(int(16000 * math.sin(2 * math.pi * freq * n / RATE)) for n in range(int(length * RATE)))
+        pause = rng.uniform(0.5, 1.0)
+        samples.extend(rng.randint(-20, 20) for _ in range(int(pause * RATE)))
+        phrases.append(_phrase_name(index))
+        t += length + pause
+    return samples, phrases
+
+
+def _frames_db(samples, frame=RATE // 100):
+    for start in range(0, len(samples), frame):
+        chunk = samples[start:start + frame]
+        rms = math.sqrt(sum(s * s for s in chunk) / len(chunk)) or 1e-9
+        yield start / RATE, 20 * math.log10(rms / 32768)
+
+
+def _silencedetect(samples, noise_db=whatsapp_client.AUDIO_SILENCE_DB, min_s=whatsapp_client.AUDIO_SILENCE_MIN_S):
+    """
+    Saída de erro equivalente à do FFmpeg com -af silencedetect, calculada sobre as amostras.
+    """
+    duration = len(samples) / RATE
+    hours, rest = divmod(duration, 3600)
+    lines = [f"  Duration: {int(hours):02d}:{int(rest // 60):02d}:{rest % 60:05.2f}, bitrate: 128 kb/s"]
+    start = None
+    for ts, db in _frames_db(samples):
+        if db < noise_db and start is None:
+            start = ts
+        elif db >= noise_db and start is not None:
+            if ts - start >= min_s:
+                lines.append(f"[silencedetect @ 0x1] silence_start: {start:.3f}")
+                lines.append(f"[silencedetect @ 0x1] silence_end: {ts:.3f} | silence_duration: {ts - start:.3f}")
+            start = None
+    if start is not None and duration - start >= min_s:
+        lines.append(f"[silencedetect @ 0x1] silence_start: {start:.3f}")
+    return "\n".join(lines)
+
+
+def _wav(samples):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(RATE)
+        f.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def _recognize(audio_data):
+    """
+    "Transcreve" um trecho: acha os tons e identifica cada frase pela frequência.
+    """
+    with wave.open(io.BytesIO(audio_data)) as f:
+        samples = array("h", f.readframes(f.getnframes()))
+    words, run = [], []
+    for ts, db in list(_frames_db(samples)) + [(None, -100.0)]:
+        if db >= whatsapp_client.AUDIO_SILENCE_DB:
+            run.append(ts)
+            continue
+        if len(run) >= 10:
+            chunk = samples[int(run[0] * RATE):int((run[-1] + 0.01) * RATE)]
+            crossings = sum(1 for a, b in zip(chunk, chunk[1:]) if (a < 0) != (b < 0))
+            freq = crossings / 2 / (len(chunk) / RATE)
+            words.append(_phrase_name(round((freq - BASE_HZ) / STEP_HZ)))
+        run = []
+    return " ".join(words)
+
+
+class ToneBackend(llm_backend.LiveBackend):
+    """Transcreve os tons; os primeiros trechos demoram mais, para testar a ordem."""
+
+    mode = "replay"
+    calls_model = False
+
+    def __init__(self):
+        self.delays = []
+
+    def transcribe(self, audio_data, live_call):
+        text = _recognize(audio_data)
+        delay = 0.6 if text.startswith(_phrase_name(0)) else 0.2
+        self.delays.append(delay)
+        time.sleep(delay)
+        return text
+
+
+@pytest.fixture
+def note(tmp_path):
+    samples, phrases = _voice_note()
+    path = tmp_path / "note.ogg"
+    path.write_bytes(_wav(samples))
+    return samples, phrases, str(path)
+
+
+@pytest.fixture
+def client(monkeypatch, note):
+    samples, _, _ = note
+    client = whatsapp_client.WhatsAppClient("123", "token")
+    monkeypatch.setattr(client, "_probe_audio",
+                        lambda path: whatsapp_client.parse_silencedetect(_silencedetect(samples)))
+
+    def split(path, segments, directory):
+        # Mesmo corte do segment muxer do FFmpeg, sobre as amostras
+        for number, (start, end) in enumerate(segments):
+            with open(os.path.join(directory, f"{number:03d}.wav"), "wb") as f:
+                f.write(_wav(samples[int(start * RATE):int(end * RATE)]))
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+
+    monkeypatch.setattr(client, "_split_audio", split)
+    return client
+
+
+def test_segments_cut_inside_silences(note):
+    samples, _, _ = note
+    duration, silences = whatsapp_client.parse_silencedetect(_silencedetect(samples))
+    segments = whatsapp_client.plan_segments(duration, silences)
+
+    assert duration == pytest.approx(len(samples) / RATE, abs=0.01)
+    assert len(segments) >= 5
+    assert segments[0][0] == 0.0 and segments[-1][1] == duration
+    for (_, end), (start, _) in zip(segments, segments[1:]):
+        assert end == start
+        assert any(s <= end <= e for s, e in silences), f"corte em {end:.2f}s fora de um silêncio"
+    for start, end in segments:
+        assert end - start <= whatsapp_client.AUDIO_SEGMENT_MAX_S
+
+
+def test_chunked_transcription_keeps_order(monkeypatch, client, note):
+    samples, phrases, path = note
+    backend = ToneBackend()
+    monkeypatch.setattr(llm_backend, "_backend", backend)
+    start = time.perf_counter()
+    text = client.transcribe_audio_with_gemini(path)
+    elapsed = time.perf_counter() - start
+
+    assert len(samples) / RATE > whatsapp_client.AUDIO_CHUNK_MIN_S
+    assert text.split() == phrases
+    # Trechos em paralelo: menos que a soma das esperas do backend
+    assert elapsed < sum(backend.delays)
+
+
+def test_first_segment_delivered_early(monkeypatch, client, note):
+    _, phrases, path = note
+    monkeypatch.setattr(llm_backend, "_backend", ToneBackend())
+    first = []
+
+    text = client.transcribe_audio_with_gemini(path, on_first_segment=first.append)
+
+    assert len(first) == 1
+    assert (first[0] + " " + text).split() == phrases
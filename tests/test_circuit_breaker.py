@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+import agent
+import circuit_breaker
+import deadline
+import llm_backend
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+def _fail():
+    raise RuntimeError("falha do serviço")
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("t", failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            breaker.call(_fail)
+    assert breaker.state == CLOSED
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "não chamada")
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker("t", failure_threshold=2, reset_timeout=60)
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+    assert breaker.call(lambda: "ok") == "ok"
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_allows_single_probe():
+    breaker = CircuitBreaker("t", failure_threshold=1, reset_timeout=0.05)
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Só uma chamada de teste por vez
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker("t", failure_threshold=5, reset_timeout=0.05)
+    for _ in range(5):
+        breaker.record_failure()
+    time.sleep(0.06)
+    with pytest.raises(RuntimeError):
+        breaker.call(_fail)
+    assert breaker.state == OPEN
+
+
+def _live_turn(monkeypatch, calls, run=None):
+    def run_live(agent_, message_text, phone_number, conversation=None, images=None):
+        calls.append(deadline.remaining())
+        if run is not None:
+            return run()
+        return llm_backend.AgentResult(function_calls=[{"name": "send_message", "args": {"type": "text", "message": "ok"}}])
+
+    monkeypatch.setattr(agent, "AGENT_STREAMING", False)
+    monkeypatch.setattr(agent, "_run_agent_live", run_live)
+    monkeypatch.setattr(llm_backend, "_backend", llm_backend.LiveBackend())
+
+
+def test_exhausted_budget_skips_breaker(monkeypatch, fake_sdk, sent, fresh_state, gemini_breaker):
+    calls = []
+    _live_turn(monkeypatch, calls)
+    # Turnos com o prazo quase esgotado: fallback na hora, sem chamar o Gemini nem abrir o disjuntor
+    for n in range(gemini_breaker.failure_threshold + 1):
+        with deadline.budget(agent.GEMINI_MIN_TIMEOUT_S / 10):
+            agent.process_user_input("qual a diferença entre peeling e limpeza de pele", f"55489999900{n:02d}")
+    assert calls == []
+    assert gemini_breaker.state == CLOSED and gemini_breaker.failures == 0
+    assert [kind for _, kind, _ in sent] == ["fallback"] * (gemini_breaker.failure_threshold + 1)
+
+
+def test_real_timeout_counts_as_failure(monkeypatch, fake_sdk, sent, fresh_state, gemini_breaker):
+    calls = []
+    _live_turn(monkeypatch, calls, run=lambda: time.sleep(0.3))
+    monkeypatch.setattr(agent, "GEMINI_TIMEOUT_S", 0.1)
+    monkeypatch.setattr(agent, "GEMINI_MIN_TIMEOUT_S", 0.05)
+    agent.process_user_input("qual a diferença entre peeling e limpeza de pele", "5548999990100")
+    assert len(calls) == 1
+    assert gemini_breaker.failures == 1
+    assert [kind for _, kind, _ in sent] == ["fallback"]
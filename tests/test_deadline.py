@@ -0,0 +1,25 @@
+import threading
+import time
+
+import pytest
+
+import deadline
+
+
+def test_queued_call_is_cancelled_and_pools_are_separate(monkeypatch):
+    monkeypatch.setattr(deadline, "DEADLINE_WORKERS", 1)
+    release = threading.Event()
+    ran = []
+
+    # Chamada presa ocupa a única thread do conjunto
+    with pytest.raises(deadline.DeadlineExceeded):
+        deadline.call_with_timeout(lambda: release.wait(5), 0.05, pool="test-stuck")
+    with pytest.raises(deadline.DeadlineExceeded, match="na fila"):
+        deadline.call_with_timeout(lambda: ran.append("queued"), 0.05, pool="test-stuck")
+
+    # Outro conjunto não espera atrás da chamada presa
+    assert deadline.call_with_timeout(lambda: "ok", 0.5, pool="test-other") == "ok"
+
+    release.set()
+    time.sleep(0.05)
+    assert ran == []
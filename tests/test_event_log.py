@@ -0,0 +1,52 @@
+import os
+import time
+
+import pytest
+
+import agent
+import event_log
+import llm_backend
+
+
+def _segment(directory, name, size, age_s):
+    path = directory / f"events-{name}.gev"
+    path.write_bytes(b"\0" * size)
+    mtime = time.time() - age_s
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_prune_by_age_and_total_size(tmp_path):
+    log = event_log.EventLog(str(tmp_path), retention_s=86400, max_bytes=2500)
+    expired = _segment(tmp_path, "a", 100, 2 * 86400)
+    oldest = _segment(tmp_path, "b", 1000, 3 * 3600)
+    older = _segment(tmp_path, "c", 1000, 2 * 3600)
+    newest = _segment(tmp_path, "d", 1000, 3600)
+
+    assert log.prune() == 2
+    assert not expired.exists() and not oldest.exists()
+    assert older.exists() and newest.exists()
+
+
+def test_new_segment_applies_retention(tmp_path):
+    log = event_log.EventLog(str(tmp_path), retention_s=60, max_bytes=0)
+    expired = _segment(tmp_path, "20000101T000000-1", 100, 3600)
+
+    log.emit("inbound", tenant="t1")
+    log.flush()
+
+    assert not expired.exists()
+    assert len(event_log.segments(str(tmp_path))) == 1
+
+
+@pytest.mark.parametrize("enabled", [False, True])
+def test_tool_call_args_are_opt_in(monkeypatch, gemini_breaker, sent, enabled):
+    emitted = []
+    monkeypatch.setattr(event_log, "emit", lambda kind, **fields: emitted.append((kind, fields)))
+    monkeypatch.setattr(event_log, "EVENT_LOG_TOOL_ARGS", enabled)
+    monkeypatch.setattr(llm_backend, "_backend", llm_backend.create_backend("synthetic"))
+
+    agent.process_user_input("qual a diferença entre peeling e limpeza de pele", "5548999990000")
+
+    calls = [fields for kind, fields in emitted if kind == "tool_call"]
+    assert calls and all(("args" in fields) == enabled for fields in calls)
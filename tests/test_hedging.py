@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+import hedging
+
+
+def _attempt(delays, started, fail=()):
+    """
+    Tentativa que espera delays[index], se compromete e devolve o índice.
+    """
+    async def attempt(index, commit):
+        started.append(index)
+        await asyncio.sleep(delays[index])
+        if index in fail:
+            raise RuntimeError(f"tentativa {index} falhou")
+        return index if commit() else None
+    return attempt
+
+
+def test_budget_allows_burst_then_max_ratio():
+    hedger = hedging.Hedger("test", max_ratio=0.1)
+
+    assert sum(hedger._withdraw() for _ in range(20)) == hedging.HEDGE_MAX_BURST
+    for _ in range(9):
+        hedger._deposit()
+    assert not hedger._withdraw()
+    hedger._deposit()
+    assert hedger._withdraw()
+
+
+def test_budget_caps_at_burst():
+    hedger = hedging.Hedger("test", max_ratio=0.5)
+    for _ in range(100):
+        hedger._deposit()
+    assert sum(hedger._withdraw() for _ in range(100)) == hedging.HEDGE_MAX_BURST
+
+
+def test_delay_uses_percentile_with_floor(monkeypatch):
+    hedger = hedging.Hedger("test", percentile=90)
+    assert hedger.delay() == hedging.HEDGE_DELAY_S
+
+    for i in range(100):
+        hedger.observe(1.0 + i / 100)
+    assert hedger.delay() == pytest.approx(1.9)
+
+    fast = hedging.Hedger("fast")
+    for _ in range(100):
+        fast.observe(0.01)
+    assert fast.delay() == hedging.HEDGE_MIN_DELAY_S
+
+
+def test_slow_primary_is_hedged_and_loses():
+    hedger = hedging.Hedger("test")
+    started = []
+
+    winner = asyncio.run(hedger.run(_attempt([1.0, 0.01], started), delay=0.02))
+
+    assert winner == 1
+    assert started == [0, 1]
+
+
+def test_fast_primary_is_not_hedged():
+    hedger = hedging.Hedger("test")
+    started = []
+
+    assert asyncio.run(hedger.run(_attempt([0.01, 0.01], started), delay=0.5)) == 0
+    assert started == [0]
+
+
+def test_exhausted_budget_waits_for_primary():
+    hedger = hedging.Hedger("test", max_ratio=0.0)
+    hedger._budget = 0
+    started = []
+
+    assert asyncio.run(hedger.run(_attempt([0.1, 0.01], started), delay=0.01)) == 0
+    assert started == [0]
+
+
+def test_failed_primary_does_not_cancel_hedge():
+    hedger = hedging.Hedger("test")
+    started = []
+
+    winner = asyncio.run(hedger.run(_attempt([0.05, 0.1], started, fail={0}), delay=0.02))
+
+    assert winner == 1
+
+
+def test_all_attempts_failing_raises():
+    hedger = hedging.Hedger("test")
+
+    with pytest.raises(RuntimeError, match="tentativa 0"):
+        asyncio.run(hedger.run(_attempt([0.05, 0.06], [], fail={0, 1}), delay=0.02))
+
+
+def test_extra_requests_bounded_by_ratio():
+    hedger = hedging.Hedger("test", max_ratio=0.1)
+    started = []
+
+    async def calls():
+        for _ in range(50):
+            await hedger.run(_attempt([0.003, 0.0], started), delay=0.0)
+
+    asyncio.run(calls())
+
+    hedges = started.count(1)
+    assert hedges <= hedging.HEDGE_MAX_BURST + 0.1 * 50 + 1e-9
+    assert hedges >= hedging.HEDGE_MAX_BURST
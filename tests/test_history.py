@@ -0,0 +1,78 @@
+import json
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import circuit_breaker
+import history
+import llm_backend
+import usage
+from circuit_breaker import CLOSED
+
+CONTACT = "5511999999999"
+
+
+class LiveSummaries(llm_backend.LiveBackend):
+    """Resumos sempre pela chamada ao modelo, como no modo live."""
+
+    def summarize(self, prompt, live_call):
+        return live_call()
+
+
+@pytest.fixture
+def genai(monkeypatch):
+    """
+    google.generativeai reduzido ao usado pelo resumo; model.outcome define a resposta.
+    """
+    model = SimpleNamespace(outcome="Contato quer botox.")
+
+    def generate_content(prompt):
+        if isinstance(model.outcome, Exception):
+            raise model.outcome
+        return SimpleNamespace(text=model.outcome,
+                               usage_metadata=SimpleNamespace(prompt_token_count=120, candidates_token_count=8))
+
+    model.generate_content = generate_content
+    module = SimpleNamespace(configure=lambda api_key: None, GenerativeModel=lambda name: model)
+    monkeypatch.setitem(sys.modules, "google", SimpleNamespace(generativeai=module))
+    monkeypatch.setitem(sys.modules, "google.generativeai", module)
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    monkeypatch.setattr(llm_backend, "_backend", LiveSummaries())
+    monkeypatch.setattr(circuit_breaker, "summary", circuit_breaker.CircuitBreaker("gemini-summary-test",
+                                                                                   failure_threshold=1))
+    return model
+
+
+@pytest.fixture
+def conversation(fresh_state):
+    tenant = SimpleNamespace(tenant_id="t1", catalog=[])
+    key = history._keys(tenant, CONTACT)["entries"]
+    turns = history.HISTORY_WINDOW_TURNS + history.HISTORY_SUMMARY_BATCH
+    fresh_state.append(key, [json.dumps({"role": "user", "text": f"mensagem {n}", "turn": float(n + 1)})
+                             for n in range(turns)], max_len=50, ttl=60)
+    return tenant
+
+
+def test_summary_usage_is_attributed_to_contact(genai, conversation, monkeypatch):
+    records = []
+    # Contato explícito ou o atribuído ao bloco, como no usage.record
+    monkeypatch.setattr(usage, "record",
+                        lambda u, tenant_id=None, contact=None: records.append((u, contact or usage._contact.get())))
+
+    # Sem contexto do turno, como no executor do histórico
+    assert history.compact(conversation, CONTACT)
+
+    assert history.load_conversation(conversation, CONTACT).summary == "Contato quer botox."
+    assert [(u.call, u.input_tokens, owner) for u, owner in records] == [("summary", 120, ("t1", CONTACT))]
+
+
+def test_summary_failures_do_not_open_gemini_breaker(genai, conversation, gemini_breaker):
+    genai.outcome = RuntimeError("503")
+
+    assert history.compact(conversation, CONTACT)
+
+    # Falha do resumo: resumo local e só o disjuntor dos resumos abre
+    assert history.load_conversation(conversation, CONTACT).summary.startswith("Paciente: mensagem")
+    assert circuit_breaker.summary.state != CLOSED
+    assert gemini_breaker.state == CLOSED
@@ -0,0 +1,83 @@
+import pytest
+
+import event_log
+import intent_router
+
+
+@pytest.fixture
+def router():
+    return intent_router.IntentRouter(model_path="", log=False)
+
+
+@pytest.mark.parametrize("text", [
+    "boa tarde, tudo bem? quero marcar",
+    "boa tarde tudo bem quero marcar",
+    "oi\nquero agendar",
+    "oi quero marcar",
+    "bom dia\nonde fica a clínica?",
+    "obrigada, onde fica?",
+    "quero marcar e saber o endereço",
+])
+def test_mixed_intent_batches_go_to_agent(router, text):
+    decision = router.route(text)
+    assert not decision.local, decision
+
+
+@pytest.mark.parametrize("text,intent", [
+    ("quero agendar", "CALENDARIO"),
+    ("onde fica", "ENDERECO"),
+    ("olá, tudo bem?", "WELCOME"),
+    ("obrigada", "ENCERRAMENTO"),
+])
+def test_single_clear_intent_routes_locally(router, text, intent):
+    decision = router.route(text)
+    assert decision.local, decision
+    assert decision.intent == intent
+
+
+def test_margin_separates_single_and_mixed(router):
+    model = router.model
+    single = model.margin("quero agendar", "CALENDARIO")
+    mixed = model.margin("boa tarde tudo bem quero marcar", model.predict("boa tarde tudo bem quero marcar")[0])
+    assert single > router.min_margin > mixed
+
+
+def test_clauses():
+    assert intent_router.clauses("oi") == 1
+    assert intent_router.clauses("oi, tudo bem?") == 2
+    assert intent_router.clauses("oi\nquero marcar\n") == 2
+    assert intent_router.clauses("?!") == 0
+
+
+def test_log_is_opt_in(monkeypatch, tmp_path):
+    emitted = []
+    monkeypatch.setattr(event_log, "emit", lambda kind, **fields: emitted.append((kind, fields)))
+    monkeypatch.chdir(tmp_path)
+
+    router = intent_router.IntentRouter(model_path="")
+    router.log(router.route("onde fica"))
+    assert emitted == []
+
+    router = intent_router.IntentRouter(model_path="", log=True)
+    router.log(router.route("onde fica"), agent_types=["endereco"], latency_s=0.01)
+    kind, fields = emitted[0]
+    assert kind == "routing"
+    assert "text" not in fields
+    assert fields["intent"] == "ENDERECO" and fields["agent_types"] == ["endereco"]
+    assert list(tmp_path.iterdir()) == []
+
+    router = intent_router.IntentRouter(model_path="", log=True, log_text=True)
+    router.log(router.route("onde fica"))
+    assert emitted[1][1]["text"] == "onde fica"
+
+
+def test_evaluate_uses_logged_measures(monkeypatch, tmp_path):
+    router = intent_router.IntentRouter(model_path="", log=True)
+    writer = event_log.EventLog(str(tmp_path))
+    monkeypatch.setattr(event_log, "emit", lambda kind, **fields: writer.emit(kind, **fields))
+    router.log(router.route("onde fica"), agent_types=["ENDERECO"])
+    router.log(router.route("boa tarde, tudo bem? quero marcar"), agent_types=["TEXT"])
+    writer.flush()
+
+    report = intent_router.evaluate(str(tmp_path), [0.5], router=router)
+    assert report == [{"threshold": 0.5, "local_fraction": 0.5, "agreement": 1.0, "turns": 2}]
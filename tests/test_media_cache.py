@@ -0,0 +1,77 @@
+import pytest
+
+from media_cache import MediaCache
+
+CATALOG = "https://cdn.example.com/botox.jpg"
+
+
+class FakeClient:
+    phone_number_id = "123"
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.fetched = []
+        self.uploads = 0
+
+    def fetch_url(self, url, max_bytes):
+        self.fetched.append(url)
+        if self.fail:
+            raise ConnectionError("CDN indisponível")
+        return b"jpeg", "image/jpeg"
+
+    def upload_media(self, content, mime_type, filename):
+        self.uploads += 1
+        return f"media-{self.uploads}"
+
+
+@pytest.fixture
+def cache(monkeypatch, fresh_state):
+    def make(client):
+        cache = MediaCache(client)
+        # Sem a thread de aquecimento: os uploads acontecem no próprio teste
+        monkeypatch.setattr(cache, "warm_async", lambda urls: None)
+        cache.set_catalog([CATALOG])
+        return cache
+    return make
+
+
+def test_catalog_image_uploaded_once(cache):
+    client = FakeClient()
+    media = cache(client)
+
+    assert media.get_media_id(CATALOG) == "media-1"
+    assert media.get_media_id(CATALOG) == "media-1"
+    assert client.uploads == 1
+
+
+def test_other_urls_are_never_fetched(cache):
+    client = FakeClient()
+    media = cache(client)
+
+    assert media.get_media_id("http://169.254.169.254/latest/meta-data/") is None
+    assert media.get_media_id("https://cdn.example.com/outra.jpg") is None
+    assert client.fetched == []
+    assert set(media._locks) == {CATALOG}
+
+
+def test_failure_is_cached(cache):
+    client = FakeClient(fail=True)
+    media = cache(client)
+
+    assert media.get_media_id(CATALOG) is None
+    assert media.get_media_id(CATALOG) is None
+    assert client.fetched == [CATALOG]
+
+    # Depois do intervalo, tenta de novo
+    client.fail = False
+    media._failures[CATALOG] = 0.0
+    assert media.get_media_id(CATALOG) == "media-1"
+
+
+def test_catalog_replacement_drops_old_urls(cache):
+    client = FakeClient()
+    media = cache(client)
+    media.set_catalog(["https://cdn.example.com/novo.jpg"])
+
+    assert media.get_media_id(CATALOG) is None
+    assert set(media._locks) == {"https://cdn.example.com/novo.jpg"}
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import scheduling
+from scheduling import Event, IntervalIndex, Scheduler, SchedulingError, SQLiteCalendarStore
+
+TZ = ZoneInfo("America/Sao_Paulo")
+HOUR = 3600
+
+
+@pytest.fixture
+def tenant():
+    hours = {day: ["09:00-12:00", "13:00-18:00"] for day in scheduling._WEEKDAYS}
+    catalog = [{"id": "limpeza_de_pele", "title": "Limpeza de pele", "duration_min": 60},
+               {"id": "botox", "title": "Botox", "duration_min": 30}]
+    return SimpleNamespace(tenant_id="t1", catalog=catalog, hours=hours)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteCalendarStore(str(tmp_path / "agenda.db"))
+
+
+@pytest.fixture
+def engine(store):
+    return Scheduler(store, min_notice_min=0, refresh_s=0)
+
+
+def _at(hour, minute=0, days=1):
+    day = datetime.now(TZ).date() + timedelta(days=days)
+    return datetime(day.year, day.month, day.day, hour, minute, tzinfo=TZ).timestamp()
+
+
+def _busy(event_id, start, end, contact=None):
+    return Event(event_id, "t1", start, end, "booking" if contact else "busy", "botox", contact)
+
+
+def test_index_conflicts_and_adjacency():
+    index = IntervalIndex(TZ)
+    index.apply([_busy("a", _at(10), _at(11)), _busy("b", _at(10, 30), _at(11, 30)),
+                 _busy("c", _at(14), _at(15))], [])
+
+    assert not index.is_free(_at(10, 45), _at(11, 15))
+    assert not index.is_free(_at(9, 30), _at(10, 15))
+    assert not index.is_free(_at(9), _at(16))
+    # Intervalos encostados não conflitam
+    assert index.is_free(_at(11, 30), _at(12))
+    assert index.is_free(_at(9), _at(10))
+    assert index.is_free(_at(13), _at(14))
+
+
+def test_index_first_fit_skips_merged_busy():
+    index = IntervalIndex(TZ)
+    day = datetime.fromtimestamp(_at(9), TZ).toordinal()
+    index.apply([_busy("a", _at(9), _at(9, 40)), _busy("b", _at(9, 30), _at(10, 10))], [])
+
+    assert index.first_fit(day, _at(9), _at(12), _at(9), HOUR, 15 * 60) == _at(10, 15)
+    assert index.first_fit(day, _at(9), _at(10, 30), _at(9), HOUR, 15 * 60) is None
+
+    index.apply([], ["b"])
+    assert index.first_fit(day, _at(9), _at(12), _at(9), HOUR, 15 * 60) == _at(9, 45)
+
+
+def test_book_rejects_overlap(engine, tenant):
+    engine.book(tenant, "limpeza de pele", _at(10), "5548999990001")
+
+    with pytest.raises(SchedulingError, match="ocupado"):
+        engine.book(tenant, "botox", _at(10, 30), "5548999990002")
+    # Logo depois do fim está livre
+    assert engine.book(tenant, "botox", _at(11), "5548999990002").start == _at(11)
+
+
+def test_book_outside_hours(engine, tenant):
+    with pytest.raises(SchedulingError, match="expediente"):
+        engine.book(tenant, "limpeza_de_pele", _at(11, 30), "5548999990001")
+
+
+def test_stale_cache_conflict_is_caught_by_store(store, tenant):
+    # Dois workers com a agenda em cache; o segundo não vê a reserva do primeiro
+    first = Scheduler(store, min_notice_min=0, refresh_s=3600)
+    second = Scheduler(store, min_notice_min=0, refresh_s=3600)
+    second.free_slots(tenant, "botox")
+
+    first.book(tenant, "botox", _at(15), "5548999990001")
+    with pytest.raises(SchedulingError, match="ocupado"):
+        second.book(tenant, "botox", _at(15, 15), "5548999990002")
+
+    # A recusa atualiza o cache do segundo worker
+    assert not second.calendar(tenant).index.is_free(_at(15), _at(15, 30))
+
+
+def test_free_slots_skip_bookings(engine, tenant):
+    engine.book(tenant, "limpeza_de_pele", _at(9), "5548999990001")
+
+    _, slots = engine.free_slots(tenant, "limpeza_de_pele", after=_at(9), until=_at(12), count=3)
+
+    assert slots == [_at(10), _at(11)]
+
+
+def test_contact_limit_and_idempotent_retry(store, tenant):
+    engine = Scheduler(store, min_notice_min=0, refresh_s=0, max_per_contact=2)
+    contact = "5548999990001"
+
+    event = engine.book(tenant, "botox", _at(9), contact)
+    # Nova tentativa do mesmo pedido devolve o mesmo agendamento
+    assert engine.book(tenant, "botox", _at(9), contact).event_id == event.event_id
+    engine.book(tenant, "botox", _at(10), contact)
+    with pytest.raises(SchedulingError, match="2 agendamentos"):
+        engine.book(tenant, "botox", _at(11), contact)
+
+    # Depois do cancelamento, o contato volta a ter vaga
+    store.cancel("t1", event.event_id)
+    assert engine.book(tenant, "botox", _at(11), contact).start == _at(11)
+
+
+def test_prune_drops_past_events_and_contact_index():
+    index = IntervalIndex(TZ)
+    contact = "5548999990001"
+    index.apply([_busy("old", _at(9, days=-3), _at(10, days=-3), contact),
+                 _busy("yesterday", _at(9, days=-1), _at(10, days=-1)),
+                 _busy("next", _at(9), _at(10), contact)], [])
+
+    assert index.prune(_at(0, days=0)) == 2
+    assert len(index) == 1
+    assert [event.event_id for event in index.for_contact(contact, 0)] == ["next"]
+    assert index.is_free(_at(9, days=-1), _at(10, days=-1))
+    assert not index.is_free(_at(9), _at(10))
@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+import state
+from mock_redis import MockRedis
+
+
+@pytest.fixture(scope="module")
+def redis_server():
+    server = MockRedis(port=0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    # Prefixo próprio por teste: o Redis simulado é compartilhado pelo módulo
+    prefix = f"t{time.monotonic_ns()}:"
+    if request.param == "memory":
+        return state.MemoryStateBackend(prefix=prefix)
+    if request.param == "sqlite":
+        return state.SQLiteStateBackend(str(tmp_path / "state.db"), prefix=prefix)
+    server = request.getfixturevalue("redis_server")
+    host, port = server.server.server_address[:2]
+    return state.RedisStateBackend(host, port, prefix=prefix)
+
+
+def test_add_new_claims_each_key_once(backend):
+    assert backend.add_new(["a", "b"], ttl=60) == [True, True]
+    assert backend.add_new(["a", "c", "c"], ttl=60) == [False, True, False]
+
+
+def test_add_new_expires(backend):
+    assert backend.add_new(["k"], ttl=0.05) == [True]
+    time.sleep(0.1)
+    assert backend.add_new(["k"], ttl=60) == [True]
+
+
+def test_set_get_many(backend):
+    backend.set_many({"x": "1", "y": "dois"}, ttl=60)
+    assert backend.get_many(["x", "nada", "y"]) == ["1", None, "dois"]
+    backend.delete(["x"])
+    assert backend.get_many(["x"]) == [None]
+
+
+def test_append_keeps_order_and_trims(backend):
+    backend.append("lista", ["a", "b"], ttl=60)
+    backend.append("lista", ["c", "d", "e"], max_len=4, ttl=60)
+    assert backend.get_list("lista") == ["b", "c", "d", "e"]
+    assert backend.get_list("outra") == []
+
+
+def test_append_empty_values(backend):
+    backend.append("vazia", [], max_len=3, ttl=60)
+    assert backend.get_list("vazia") == []
+    backend.append("lista", ["a"], ttl=60)
+    backend.append("lista", [], max_len=3, ttl=60)
+    assert backend.get_list("lista") == ["a"]
+
+
+def test_incr_fixed_window(backend):
+    assert backend.incr("n", 2, ttl=0.1) == 2
+    assert backend.incr("n", 3, ttl=0.1) == 5
+    time.sleep(0.15)
+    # A janela vale a partir da criação: expirada, o contador recomeça
+    assert backend.incr("n", 1, ttl=60) == 1
+
+
+def test_incr_concurrent(backend):
+    def work():
+        for _ in range(50):
+            backend.incr("total", 1, ttl=60)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert backend.incr("total", 0) == 200
+
+
+def test_acquire_release(backend):
+    assert backend.acquire("lease", "dono", ttl=60)
+    assert not backend.acquire("lease", "outro", ttl=60)
+    # Renovação pelo próprio dono
+    assert backend.acquire("lease", "dono", ttl=60)
+    # Só o dono libera
+    backend.release("lease", "outro")
+    assert not backend.acquire("lease", "outro", ttl=60)
+    backend.release("lease", "dono")
+    assert backend.acquire("lease", "outro", ttl=60)
+
+
+def test_acquire_expires(backend):
+    assert backend.acquire("lease", "dono", ttl=0.05)
+    time.sleep(0.1)
+    assert backend.acquire("lease", "outro", ttl=60)
+
+
+def test_lease_is_exclusive(fresh_state):
+    inside = []
+    overlaps = []
+
+    def work():
+        with state.lease("turn:x", ttl=5, wait=5) as acquired:
+            assert acquired
+            inside.append(1)
+            if len(inside) > 1:
+                overlaps.append(1)
+            time.sleep(0.02)
+            inside.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not overlaps
+
+
+class _BrokenBackend(state.MemoryStateBackend):
+    def acquire(self, key, owner, ttl):
+        raise ConnectionError("backend fora do ar")
+
+    def release(self, key, owner):
+        raise ConnectionError("backend fora do ar")
+
+
+def test_lease_fails_open_when_backend_is_down():
+    state.set_state(_BrokenBackend())
+    try:
+        ran = []
+        with state.lease("turn:y", ttl=5, wait=1) as acquired:
+            ran.append(acquired)
+        assert ran == [False]
+    finally:
+        state.set_state(state.MemoryStateBackend())
+
+
+class _BrokenRelease(state.MemoryStateBackend):
+    def release(self, key, owner):
+        raise ConnectionError("backend fora do ar")
+
+
+def test_lease_release_error_is_not_raised():
+    state.set_state(_BrokenRelease())
+    try:
+        with state.lease("turn:z", ttl=5, wait=1) as acquired:
+            assert acquired
+    finally:
+        state.set_state(state.MemoryStateBackend())
+
+
+def test_lease_does_not_swallow_block_errors(fresh_state):
+    with pytest.raises(ValueError):
+        with state.lease("turn:w", ttl=5, wait=1):
+            raise ValueError("erro do turno")
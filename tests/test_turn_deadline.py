@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+
+import agent
+import app
+import deadline
+import llm_backend
+from coalescer import MessageCoalescer
+
+
+def _reply(monkeypatch, seen):
+    # Turno do modelo que responde um texto e anota o orçamento com que foi chamado
+    async def run_live(agent_, message_text, phone_number, conversation=None, images=None):
+        seen.append(deadline.remaining())
+        return llm_backend.AgentResult(
+            function_calls=[{"name": "send_message", "args": {"type": "text", "message": "Resposta do agente"}}]
+        )
+
+    monkeypatch.setattr(agent, "AGENT_STREAMING", False)
+    monkeypatch.setattr(agent, "_run_agent_live", run_live)
+    monkeypatch.setattr(llm_backend, "_backend", llm_backend.LiveBackend())
+
+
+def test_deferred_batch_gets_fresh_budget(monkeypatch, fake_sdk, sent, fresh_state, gemini_breaker):
+    seen = []
+    _reply(monkeypatch, seen)
+    release = threading.Event()
+
+    def handler(key, texts):
+        # Outro contato ocupa a única thread até o lote adiado ter perdido o prazo do webhook
+        if key[1] == "busy":
+            release.wait(5)
+            return
+        app.run_agent_turn(key, texts)
+
+    coalescer = MessageCoalescer(handler, window_ms=10, max_delay_ms=20, workers=1)
+    coalescer.add(("default", "busy"), "ocupado")
+    time.sleep(0.1)
+    # Prazo do webhook bem menor que a espera na fila
+    with deadline.budget(0.05):
+        coalescer.add(("default", "5548999990000"), "quanto tempo dura o efeito do botox na testa?", 3)
+    time.sleep(0.3)
+    release.set()
+    coalescer.drain(timeout=5)
+
+    assert seen and seen[0] > deadline.MESSAGE_DEADLINE_S - 5
+    assert ("5548999990000", "text", "Resposta do agente") in sent
+    assert not any(kind == "fallback" for _, kind, _ in sent)
+
+
+def test_timed_out_turn_sends_nothing_after_fallback(monkeypatch, fake_sdk, sent, fresh_state, gemini_breaker):
+    tenant = agent.tenant_registry.default()
+    send_tool = agent._make_send_message_tool(tenant)
+    finished = []
+
+    async def run_live(agent_, message_text, phone_number, conversation=None, images=None):
+        # Gemini travado: a resposta chegaria depois do timeout
+        await asyncio.sleep(0.4)
+        send_tool(to=phone_number, type="text", message="Resposta atrasada")
+        finished.append(True)
+        return llm_backend.AgentResult(tools_executed=True)
+
+    monkeypatch.setattr(agent, "AGENT_STREAMING", False)
+    monkeypatch.setattr(agent, "GEMINI_TIMEOUT_S", 0.1)
+    monkeypatch.setattr(agent, "GEMINI_MIN_TIMEOUT_S", 0.0)
+    monkeypatch.setattr(agent, "_run_agent_live", run_live)
+    monkeypatch.setattr(llm_backend, "_backend", llm_backend.LiveBackend())
+
+    agent.process_user_input("quanto tempo dura o efeito do botox na testa?", "5548999990000", tenant)
+    time.sleep(0.5)
+
+    assert [kind for _, kind, _ in sent] == ["fallback"]
+    assert not finished
+
+
+def test_tools_refuse_after_fallback(monkeypatch, sent):
+    tenant = agent.tenant_registry.default()
+    send_tool = agent._make_send_message_tool(tenant)
+    _, book_tool = agent._make_scheduling_tools(tenant)
+    token = agent._current_turn.set({"start": time.perf_counter(), "replied": True, "abandoned": True})
+    try:
+        assert send_tool(to="5548999990000", type="text", message="oi").startswith("Erro")
+        assert book_tool("botox", "2030-01-10T10:00").startswith("Erro")
+    finally:
+        agent._current_turn.reset(token)
+    assert sent == []
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Fração das mensagens que terão spans gravados (0 desliga, 1 grava todas)
+TRACE_SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", "0"))
+# Arquivo JSON lines de saída (exportador padrão)
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "traces.jsonl")
+# Endpoint OTLP/HTTP (JSON) de um coletor local, ex: http://localhost:4318/v1/traces
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT")
+SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "gena-ai-bot")
+
+_EXPORT_BATCH_SIZE = 256
+_EXPORT_INTERVAL = 2.0
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("gena_current_span", default=None)
+
+
+class Span:
+    """Um trecho cronometrado de um trace."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns",
+                 "attributes", "sampled")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str,
+                 sampled: bool, attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex() if sampled else ""
+        self.parent_id = parent_id
+        self.name = name
+        self.sampled = sampled
+        self.attributes = dict(attributes) if (sampled and attributes) else {}
+        self.start_ns = time.time_ns() if sampled else 0
+        self.end_ns = 0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """
+        Define um atributo do span (ignorado quando o trace não foi amostrado).
+
+        Args:
+            key: Nome do atributo
+            value: Valor do atributo
+        """
+        if self.sampled:
+            self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+        }
+
+
+class _Exporter:
+    """Envia spans finalizados em lote, numa thread em segundo plano."""
+
+    def __init__(self):
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=10000)
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def submit(self, span: Span) -> None:
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # Nunca bloquear o processamento de mensagens por causa de tracing
+            pass
+
+    def _ensure_started(self) -> None:
+        # A thread é criada sob demanda (e recriada após um fork do Gunicorn)
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=10000)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch: List[Span] = []
+            try:
+                batch.append(self._queue.get(timeout=_EXPORT_INTERVAL))
+                while len(batch) < _EXPORT_BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    self._export(batch)
+                except Exception as e:
+                    logger.error(f"Erro ao exportar spans: {str(e)}")
+
+    def _export(self, batch: List[Span]) -> None:
+        if TRACE_OTLP_ENDPOINT:
+            requests.post(TRACE_OTLP_ENDPOINT, json=_to_otlp(batch), timeout=5)
+        else:
+            with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+                for span in batch:
+                    f.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _to_otlp(batch: List[Span]) -> Dict[str, Any]:
+    """
+    Converte spans para o formato JSON do OTLP/HTTP.
+    """
+    spans = []
+    for span in batch:
+        spans.append({
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_id or "",
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+            "status": {"code": 2 if "error" in span.attributes else 1},
+        })
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "gena.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+_exporter = _Exporter()
+
+
+def current_trace_id() -> Optional[str]:
+    """
+    Retorna o ID do trace ativo no contexto atual, se houver.
+    """
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+@contextmanager
+def _activate(span: Span):
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_attribute("error", type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        if span.sampled:
+            span.end_ns = time.time_ns()
+            _exporter.submit(span)
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """
+    Inicia um novo trace (span raiz), decidindo a amostragem.
+
+    O ID do trace é sempre gerado, para poder ser citado nos logs, mas os spans
+    só são gravados quando o trace é amostrado.
+
+    Args:
+        name: Nome do span raiz
+        **attributes: Atributos do span raiz
+    """
+    sampled = TRACE_SAMPLE_RATIO > 0 and random.random() < TRACE_SAMPLE_RATIO
+    with _activate(Span(os.urandom(16).hex(), None, name, sampled, attributes)) as span:
+        yield span
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Abre um span filho do span ativo. Sem trace ativo (ou sem amostragem),
+    não grava nada.
+
+    Args:
+        name: Nome do span
+        **attributes: Atributos do span
+    """
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        yield parent if parent is not None else _NOOP_SPAN
+        return
+    with _activate(Span(parent.trace_id, parent.span_id, name, True, attributes)) as child:
+        yield child
+
+
+_NOOP_SPAN = Span("", None, "noop", False)
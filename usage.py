@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import metrics
+import state
+import event_log
+
+logger = logging.getLogger(__name__)
+
+# Preço em USD por milhão de tokens (entrada, saída), por modelo. USAGE_PRICES (JSON
+# {"modelo": [entrada, saída]}) acrescenta ou substitui modelos
+_DEFAULT_PRICES: Dict[str, Tuple[float, float]] = {
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+}
+USAGE_PRICES: Dict[str, Tuple[float, float]] = dict(
+    _DEFAULT_PRICES,
+    **{model: tuple(prices) for model, prices in json.loads(os.environ.get("USAGE_PRICES", "{}")).items()},
+)
+# Tokens por contato por dia; acima disso o contato recebe o fallback em vez do agente (0 desliga)
+USAGE_CONTACT_DAILY_TOKENS = int(os.environ.get("USAGE_CONTACT_DAILY_TOKENS", "200000"))
+# Os contadores diários ficam no estado compartilhado um pouco além do dia
+_COUNTER_TTL_S = 2 * 24 * 3600
+
+# Fluxos com label própria nas métricas (os demais contam como "other"); transcrições e
+# resumos usam o nome da chamada
+_FLOWS = ("welcome", "calendario", "procedimento", "endereco", "encerramento", "fallback", "text", "image",
+          "transcription", "summary")
+
+# Contato a quem atribuir as chamadas feitas fora do turno (transcrições, resumos)
+_contact: contextvars.ContextVar = contextvars.ContextVar("gena_usage_contact", default=None)
+
+
+@dataclass
+class Usage:
+    """Consumo de uma chamada ao modelo."""
+
+    # agent, transcription ou summary
+    call: str
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    seconds: float = 0.0
+    # Chamadas de ferramenta emitidas pelo modelo
+    tool_calls: int = 0
+    # Fluxo detectado no turno (tipo da mensagem enviada ou intenção do roteador)
+    flow: Optional[str] = None
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    @property
+    def cost_usd(self) -> float:
+        input_price, output_price = USAGE_PRICES.get(self.model, (0.0, 0.0))
+        return (self.input_tokens * input_price + self.output_tokens * output_price) / 1_000_000
+
+
+def flow_label(flow: Optional[str]) -> str:
+    """
+    Normaliza o fluxo para a label das métricas (tipos livres do modelo viram "other").
+    """
+    flow = (flow or "").lower()
+    return flow if flow in _FLOWS else "other"
+
+
+def _day(ts: Optional[float] = None) -> str:
+    return time.strftime("%Y%m%d", time.localtime(ts))
+
+
+def _key(tenant_id: str, contact: str, day: str) -> str:
+    return f"usage:{tenant_id}:{contact}:{day}"
+
+
+@contextmanager
+def attributed(tenant_id: str, contact: str):
+    """
+    Atribui ao contato as chamadas ao modelo feitas dentro do bloco sem contato explícito.
+
+    Args:
+        tenant_id: ID da clínica
+        contact: Número normalizado do contato
+    """
+    token = _contact.set((tenant_id, contact))
+    try:
+        yield
+    finally:
+        _contact.reset(token)
+
+
+def record(usage: Usage, tenant_id: Optional[str] = None, contact: Optional[str] = None) -> None:
+    """
+    Registra o consumo de uma chamada: métricas, evento "usage" e contador diário do contato.
+
+    Args:
+        usage: Consumo da chamada
+        tenant_id: ID da clínica (padrão: contato atribuído no contexto)
+        contact: Número normalizado do contato (padrão: contato atribuído no contexto)
+    """
+    if contact is None and _contact.get() is not None:
+        tenant_id, contact = _contact.get()
+    flow = flow_label(usage.flow or usage.call)
+    metrics.LLM_TOKENS.labels(call=usage.call, model=usage.model, direction="input").inc(usage.input_tokens)
+    metrics.LLM_TOKENS.labels(call=usage.call, model=usage.model, direction="output").inc(usage.output_tokens)
+    metrics.LLM_COST.labels(call=usage.call, flow=flow).inc(usage.cost_usd)
+    if usage.call == "agent":
+        metrics.AGENT_TOOL_CALLS.observe(usage.tool_calls)
+    event_log.emit("usage", tenant=tenant_id, contact=contact, call=usage.call, model=usage.model, flow=flow,
+                   input_tokens=usage.input_tokens, output_tokens=usage.output_tokens,
+                   cost=round(usage.cost_usd, 8), seconds=round(usage.seconds, 4), tool_calls=usage.tool_calls)
+    if contact is None or not usage.total_tokens:
+        return
+    try:
+        state.get_state().incr(_key(tenant_id, contact, _day()), usage.total_tokens, ttl=_COUNTER_TTL_S)
+    except Exception as e:
+        metrics.record_error("usage", e)
+        logger.warning(f"Consumo de {contact} não registrado no estado: {str(e)}")
+
+
+def tokens_today(tenant_id: str, contact: str) -> int:
+    """
+    Tokens consumidos pelo contato hoje (em todos os nós).
+    """
+    value = state.get_state().get_many([_key(tenant_id, contact, _day())])[0]
+    return int(value) if value else 0
+
+
+def within_budget(tenant_id: str, contact: str, budget: int = USAGE_CONTACT_DAILY_TOKENS) -> bool:
+    """
+    Verifica se o contato ainda está dentro do orçamento diário de tokens.
+
+    Com o estado compartilhado indisponível, o contato é atendido normalmente.
+
+    Args:
+        tenant_id: ID da clínica
+        contact: Número normalizado do contato
+        budget: Tokens por dia (0 desliga o limite)
+
+    Returns:
+        False se o contato já consumiu o orçamento do dia
+    """
+    if budget <= 0:
+        return True
+    try:
+        used = tokens_today(tenant_id, contact)
+    except Exception as e:
+        metrics.record_error("usage", e)
+        logger.warning(f"Orçamento de {contact} não verificado: {str(e)}")
+        return True
+    if used >= budget:
+        logger.warning(f"Contato {contact} acima do orçamento diário ({used} de {budget} tokens)")
+        return False
+    return True
@@ -1,5 +1,27 @@
+import os
 import re
-from typing import Optional
+import csv
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, TextIO
+
+_NON_DIGITS = re.compile(r'\D')
+
+# Números normalizados mantidos em cache no caminho do webhook
+PHONE_CACHE_SIZE = int(os.environ.get("PHONE_CACHE_SIZE", "65536"))
+
+# DDDs válidos no Brasil
+BRAZILIAN_AREA_CODES = frozenset(
+    "11 12 13 14 15 16 17 18 19 21 22 24 27 28 31 32 33 34 35 37 38 41 42 43 44 45 46 47 48 49 "
+    "51 53 54 55 61 62 63 64 65 66 67 68 69 71 73 74 75 77 79 81 82 83 84 85 86 87 88 89 "
+    "91 92 93 94 95 96 97 98 99".split()
+)
+
+def _digits(phone_number: str) -> str:
+    # A maioria dos números (ex: wa_id do webhook) já vem só com dígitos; \d equivale a isdecimal()
+    if phone_number.isdecimal():
+        return phone_number
+    return _NON_DIGITS.sub('', phone_number)
 
 def normalize_brazilian_phone(phone_number: str) -> str:
     """
@@ -20,8 +42,9 @@ def normalize_brazilian_phone(phone_number: str) -> str:
         return phone_number
     
     # Remover caracteres não numéricos
-    clean_number = re.sub(r'\D', '', phone_number)
-    
+    return _normalize_digits(_digits(phone_number))
+
+def _normalize_digits(clean_number: str) -> str:
     # Se o número já está no formato internacional completo (13 dígitos para BR)
     if clean_number.startswith('55') and len(clean_number) == 13:
         return clean_number
@@ -67,8 +90,9 @@ def is_brazilian_number(phone_number: str) -> bool:
     Returns:
         True se for um número brasileiro, False caso contrário
     """
-    clean_number = re.sub(r'\D', '', phone_number)
-    
+    return _is_brazilian_digits(_digits(phone_number))
+
+def _is_brazilian_digits(clean_number: str) -> bool:
     # Números brasileiros começam com 55 ou têm 10/11 dígitos
     return (clean_number.startswith('55') or 
             len(clean_number) == 10 or 
@@ -84,11 +108,106 @@ def extract_area_code(phone_number: str) -> Optional[str]:
     Returns:
         Código de área ou None se não for possível extrair
     """
-    clean_number = re.sub(r'\D', '', phone_number)
-    
+    return _area_code_digits(_digits(phone_number))
+
+def _area_code_digits(clean_number: str) -> Optional[str]:
     if clean_number.startswith('55'):
         return clean_number[2:4]
     elif len(clean_number) >= 10:
         return clean_number[:2]
     
-    return None
\ No newline at end of file
+    return None
+
+def fold_text(text: str) -> str:
+    """
+    Minúsculas sem acentos, para comparar textos digitados pelo paciente
+    ("Endereço" e "endereco" viram o mesmo texto).
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def normalize_brazilian_phone_cached(phone_number: str) -> str:
+    """
+    Igual a normalize_brazilian_phone, com cache dos números mais frequentes
+    (usado no webhook, onde os mesmos contatos mandam várias mensagens).
+    """
+    return normalize_brazilian_phone(phone_number)
+
+class PhoneInfo(NamedTuple):
+    """Resultado da normalização de um número."""
+
+    raw: str
+    normalized: str
+    # Celular brasileiro completo: 55 + DDD válido + 9 + 8 dígitos
+    valid: bool
+    area_code: Optional[str]
+    is_brazilian: bool
+
+def _phone_info(raw: str) -> PhoneInfo:
+    clean_number = _digits(raw) if raw else ""
+    normalized = _normalize_digits(clean_number) if clean_number else raw
+    valid = (
+        len(normalized) == 13
+        and normalized.startswith('55')
+        and normalized[2:4] in BRAZILIAN_AREA_CODES
+        and normalized[4] == '9'
+    )
+    return PhoneInfo(raw, normalized, valid, _area_code_digits(clean_number), _is_brazilian_digits(clean_number))
+
+def _lookup(memo: Dict[str, PhoneInfo], raw: str, memo_size: int) -> PhoneInfo:
+    raw = raw.strip() if raw else ""
+    info = memo.get(raw)
+    if info is None:
+        info = _phone_info(raw)
+        if len(memo) >= memo_size:
+            memo.clear()
+        memo[raw] = info
+    return info
+
+def normalize_many(phone_numbers: Iterable[str], memo_size: int = 1_000_000) -> Iterator[PhoneInfo]:
+    """
+    Normaliza números em lote, sob demanda (a entrada pode ser um gerador de
+    qualquer tamanho). Cada número é limpo uma única vez e números repetidos
+    na lista reaproveitam o resultado anterior.
+    
+    Args:
+        phone_numbers: Números em qualquer formato
+        memo_size: Máximo de números distintos memorizados (a memória é esvaziada ao atingir o limite)
+        
+    Returns:
+        Iterador de PhoneInfo, na mesma ordem da entrada
+    """
+    memo: Dict[str, PhoneInfo] = {}
+    for raw in phone_numbers:
+        yield _lookup(memo, raw, memo_size)
+
+def normalize_csv(input_file: TextIO, output_file: TextIO, column: str = "phone",
+                  memo_size: int = 1_000_000) -> Dict[str, int]:
+    """
+    Normaliza a coluna de telefone de um CSV linha a linha (sem carregar o
+    arquivo em memória), acrescentando as colunas normalized_phone, valid e area_code.
+    
+    Args:
+        input_file: CSV de entrada (com cabeçalho)
+        output_file: CSV de saída
+        column: Nome da coluna com o telefone
+        memo_size: Máximo de números distintos memorizados
+        
+    Returns:
+        Contagem {"rows": ..., "valid": ..., "invalid": ...}
+    """
+    reader = csv.DictReader(input_file)
+    if column not in (reader.fieldnames or []):
+        raise ValueError(f"Coluna '{column}' não encontrada no CSV")
+    writer = csv.DictWriter(output_file, fieldnames=[*reader.fieldnames, "normalized_phone", "valid", "area_code"])
+    writer.writeheader()
+    counts = {"rows": 0, "valid": 0, "invalid": 0}
+    memo: Dict[str, PhoneInfo] = {}
+    for row in reader:
+        info = _lookup(memo, row[column], memo_size)
+        row.update(normalized_phone=info.normalized, valid=int(info.valid), area_code=info.area_code or "")
+        writer.writerow(row)
+        counts["rows"] += 1
+        counts["valid" if info.valid else "invalid"] += 1
+    return counts
@@ -1,10 +1,28 @@
 import requests
 import json
 import os
+import re
+import io
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional, Union
+import threading
+from typing import Callable, List, Dict, Any, Optional, Tuple, Union
 import tempfile
 import subprocess
+import shutil
+import time
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import metrics
+import event_log
+import tracing
+import llm_backend
+import deadline
+import circuit_breaker
+import usage
+from media_cache import MEDIA_CACHE_ENABLED, MediaCache
 
 # Configurar logging
 logging.basicConfig(
@@ -13,10 +31,164 @@ logging.basicConfig(
 )
 logger = logging.getLogger("whatsapp_client")
 
+# URL base da Graph API (pode apontar para um servidor local em testes de carga)
+GRAPH_API_URL = os.environ.get("WHATSAPP_GRAPH_URL", "https://graph.facebook.com").rstrip("/")
+# Conexões HTTP mantidas abertas por cliente (deve acompanhar o número de threads que enviam)
+GRAPH_POOL_SIZE = int(os.environ.get("GRAPH_POOL_SIZE", "16"))
+# Limites de cada etapa (o prazo da mensagem, se menor, prevalece)
+GRAPH_TIMEOUT_S = float(os.environ.get("GRAPH_TIMEOUT_S", "10"))
+FFMPEG_TIMEOUT_S = float(os.environ.get("FFMPEG_TIMEOUT_S", "30"))
+TRANSCRIPTION_TIMEOUT_S = float(os.environ.get("TRANSCRIPTION_TIMEOUT_S", "30"))
+# Com menos prazo que isso, a transcrição nem é tentada (e não conta no disjuntor do Gemini)
+TRANSCRIPTION_MIN_TIMEOUT_S = float(os.environ.get("TRANSCRIPTION_MIN_TIMEOUT_S", "3"))
+# Tempo mínimo para um envio, mesmo com o prazo esgotado (ex: mensagem de fallback)
+GRAPH_MIN_SEND_TIMEOUT_S = 3.0
+# Áudios mais longos que isso são divididos em trechos transcritos em paralelo (0 desativa)
+AUDIO_CHUNK_MIN_S = float(os.environ.get("AUDIO_CHUNK_MIN_S", "45"))
+# Duração máxima de cada trecho; o corte é feito no último silêncio antes do limite
+AUDIO_SEGMENT_MAX_S = float(os.environ.get("AUDIO_SEGMENT_MAX_S", "30"))
+# Silêncio considerado ponto de corte: duração mínima e nível
+AUDIO_SILENCE_MIN_S = float(os.environ.get("AUDIO_SILENCE_MIN_S", "0.4"))
+AUDIO_SILENCE_DB = float(os.environ.get("AUDIO_SILENCE_DB", "-35"))
+# Trechos transcritos ao mesmo tempo
+AUDIO_SEGMENT_WORKERS = int(os.environ.get("AUDIO_SEGMENT_WORKERS", "4"))
+# Arquivos menores que isso por segundo do limite nem são analisados (nenhuma nota de voz
+# tem taxa abaixo de 8 kbps), o que evita uma passada do FFmpeg nos áudios curtos
+_AUDIO_MIN_BYTES_PER_S = 1000
+
+# Imagens recebidas: maior lado e tamanho máximos da versão reduzida enviada ao modelo
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "1024"))
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(200 * 1024)))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "80"))
+# Imagens já reduzidas mantidas por cliente, pelo hash do original (imagens reenviadas)
+IMAGE_CACHE_SIZE = int(os.environ.get("IMAGE_CACHE_SIZE", "32"))
+# Maior imagem aceita no download (limite do WhatsApp: 5 MB)
+IMAGE_DOWNLOAD_MAX_BYTES = 5 * 1024 * 1024
+_IMAGE_MIN_QUALITY = 40
+
+_DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_SILENCE_START = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+_SILENCE_END = re.compile(r"silence_end: (\d+(?:\.\d+)?)")
+
+_segment_executor: Optional[ThreadPoolExecutor] = None
+
+
+@dataclass
+class InboundImage:
+    """Imagem recebida, já reduzida, para ser enviada ao agente junto com o texto."""
+
+    data: bytes
+    mime_type: str
+    # Hash da versão reduzida (referência no texto do turno, nas gravações e no histórico)
+    sha256: str
+    caption: Optional[str] = None
+
+    def as_text(self) -> str:
+        """
+        Linha que representa a imagem no texto do turno.
+        """
+        text = f"[Imagem enviada pelo paciente #{self.sha256[:12]}]"
+        return f"{text} {self.caption}" if self.caption else text
+
+
+def downscale_image(data: bytes, max_side: int = IMAGE_MAX_SIDE, max_bytes: int = IMAGE_MAX_BYTES,
+                    quality: int = IMAGE_JPEG_QUALITY) -> Tuple[bytes, Tuple[int, int]]:
+    """
+    Reduz uma imagem para no máximo max_side pixels no maior lado e max_bytes,
+    regravando em JPEG (sem metadados EXIF, como a localização da foto).
+
+    Args:
+        data: Conteúdo original (JPEG, PNG, WebP...)
+        max_side: Maior lado em pixels
+        max_bytes: Tamanho máximo do resultado
+        quality: Qualidade JPEG inicial (reduzida até _IMAGE_MIN_QUALITY antes de diminuir a imagem)
+
+    Returns:
+        Tupla (JPEG, (largura, altura))
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    # JPEG: a decodificação já sai reduzida (escala do DCT), sem decodificar a foto inteira
+    image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel("A"))
+    image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+    while True:
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+        if output.tell() <= max_bytes or max(image.size) <= 64:
+            return output.getvalue(), image.size
+        if quality > _IMAGE_MIN_QUALITY:
+            quality = max(_IMAGE_MIN_QUALITY, quality - 15)
+        else:
+            image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+
+
+def parse_silencedetect(output: str) -> Tuple[Optional[float], List[Tuple[float, float]]]:
+    """
+    Lê a duração e os silêncios da saída do FFmpeg com o filtro silencedetect.
+
+    Args:
+        output: Saída de erro do FFmpeg
+
+    Returns:
+        Tupla (duração em segundos ou None, [(início, fim) de cada silêncio])
+    """
+    duration = None
+    match = _DURATION.search(output)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    silences, start = [], None
+    for line in output.splitlines():
+        match = _SILENCE_START.search(line)
+        if match:
+            start = max(0.0, float(match.group(1)))
+            continue
+        match = _SILENCE_END.search(line)
+        if match and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    # Silêncio até o fim do arquivo
+    if start is not None and duration is not None:
+        silences.append((start, duration))
+    return duration, silences
+
+
+def plan_segments(duration: float, silences: List[Tuple[float, float]], max_len: float = AUDIO_SEGMENT_MAX_S,
+                  min_len: Optional[float] = None) -> List[Tuple[float, float]]:
+    """
+    Divide um áudio em trechos de até max_len segundos, cortando no meio do
+    último silêncio entre min_len e max_len de cada trecho (ou no limite, se não houver).
+
+    Args:
+        duration: Duração do áudio em segundos
+        silences: Silêncios detectados [(início, fim)]
+        max_len: Duração máxima de um trecho
+        min_len: Duração mínima de um trecho cortado em silêncio (padrão: metade de max_len)
+
+    Returns:
+        Lista de (início, fim) de cada trecho, em ordem
+    """
+    min_len = max_len / 2 if min_len is None else min_len
+    points = sorted((start + end) / 2 for start, end in silences)
+    bounds = [0.0]
+    while duration - bounds[-1] > max_len:
+        start = bounds[-1]
+        candidates = [point for point in points if start + min_len <= point <= start + max_len]
+        bounds.append(candidates[-1] if candidates else start + max_len)
+    bounds.append(duration)
+    return list(zip(bounds, bounds[1:]))
+
 class WhatsAppClient:
     """Cliente para integração com a API do WhatsApp Business."""
     
-    def __init__(self, phone_number_id: str, access_token: str, version: str = "v22.0"):
+    def __init__(self, phone_number_id: str, access_token: str, version: str = "v22.0",
+                 graph_url: Optional[str] = None, pool_size: int = GRAPH_POOL_SIZE):
         """
         Inicializa o cliente WhatsApp.
         
@@ -24,16 +196,29 @@ class WhatsAppClient:
             phone_number_id: ID do número de telefone do WhatsApp Business
             access_token: Token de acesso à API do WhatsApp
             version: Versão da API do WhatsApp (padrão: 22.0)
+            graph_url: URL base da Graph API (padrão: WHATSAPP_GRAPH_URL ou graph.facebook.com)
+            pool_size: Conexões HTTP reutilizadas entre requisições
         """
         self.phone_number_id = phone_number_id
         self.access_token = access_token
         self.version = version
-        self.base_url = f"https://graph.facebook.com/{version}/{phone_number_id}"
-        self.api_url = f"https://graph.facebook.com/{version}/{phone_number_id}/messages"
+        self.graph_url = (graph_url or GRAPH_API_URL).rstrip("/")
+        self.base_url = f"{self.graph_url}/{version}/{phone_number_id}"
+        self.api_url = f"{self.graph_url}/{version}/{phone_number_id}/messages"
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {access_token}"
         }
+        # Sessão com pool de conexões: evita um handshake TLS por mensagem
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # IDs de mídia das imagens já enviadas por upload
+        self.media_cache = MediaCache(self) if MEDIA_CACHE_ENABLED else None
+        # Imagens recebidas já reduzidas, pelo hash do original informado no webhook
+        self._images: "OrderedDict[str, InboundImage]" = OrderedDict()
+        self._images_lock = threading.Lock()
     
     def _send_request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -45,14 +230,23 @@ class WhatsAppClient:
         Returns:
             Resposta da API em formato de dicionário
         """
-        # Verificar informações da conta        
-        self._check_account_info()
+        with tracing.span("graph.send", type=payload.get("type")):
+            return self._post_message(payload)
+
+    def _post_message(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Faz o POST no endpoint /messages, registrando latência e erros.
+        """
+        start = time.perf_counter()
+        status = "error"
         try:
-            response = requests.post(
+            response = self.session.post(
                 self.api_url,
                 headers=self.headers,
-                data=json.dumps(payload)
+                data=json.dumps(payload),
+                timeout=deadline.timeout(GRAPH_TIMEOUT_S, minimum=GRAPH_MIN_SEND_TIMEOUT_S)
             )
+            status = str(response.status_code)
 
             print(f"Status code: {response.status_code}")
             print(f"Resposta: {response.text}")
@@ -60,10 +254,15 @@ class WhatsAppClient:
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
+            metrics.record_error("graph_api", e)
             logger.error(f"Erro ao enviar mensagem: {str(e)}")
             if hasattr(e, 'response') and e.response:
                 logger.error(f"Resposta de erro: {e.response.text}")
             raise
+        finally:
+            metrics.GRAPH_API_LATENCY.labels(operation="messages", status=status).observe(
+                time.perf_counter() - start
+            )
     
     def _check_account_info(self) -> Dict[str, Any]:
         """
@@ -72,17 +271,26 @@ class WhatsAppClient:
         Returns:
             Resposta da API
         """        
+        start = time.perf_counter()
+        status = "error"
         try:
-            response = requests.get(
+            response = self.session.get(
                 self.base_url,
-                headers=self.headers
+                headers=self.headers,
+                timeout=deadline.timeout(GRAPH_TIMEOUT_S)
             )
+            status = str(response.status_code)
             
             print(f"Status code: {response.status_code}")
             print(f"Resposta: {response.text}")
         
         except Exception as e:
+            metrics.record_error("graph_api", e)
             print(f"Erro: {str(e)}")
+        finally:
+            metrics.GRAPH_API_LATENCY.labels(operation="account_info", status=status).observe(
+                time.perf_counter() - start
+            )
             
     def send_text_message(self, to: str, message: str) -> Dict[str, Any]:
         """
@@ -330,7 +538,9 @@ class WhatsAppClient:
     
     def send_image(self, to: str, image_url: str, caption: Optional[str] = None) -> Dict[str, Any]:
         """
-        Envia uma imagem.
+        Envia uma imagem. Com o cache de mídia ativo, as imagens do catálogo vão pelo
+        ID de mídia (upload feito uma única vez); as demais URLs, e as do catálogo cujo
+        upload falhou, vão pelo link (baixadas pela Meta, não por este servidor).
         
         Args:
             to: Número de telefone do destinatário
@@ -340,28 +550,91 @@ class WhatsAppClient:
         Returns:
             Resposta da API
         """
-        image_data = {
-            "link": image_url
-        }
+        media_id = self.media_cache.get_media_id(image_url) if self.media_cache else None
+        if media_id:
+            try:
+                logger.info(f"Enviando imagem {media_id} para {to}")
+                return self._send_request(self._image_payload(to, {"id": media_id}, caption))
+            except requests.exceptions.HTTPError as e:
+                # ID rejeitado (ex: expirado antes do previsto): descartar e enviar pelo link
+                if e.response is None or e.response.status_code != 400:
+                    raise
+                self.media_cache.invalidate(image_url)
         
+        logger.info(f"Enviando imagem para {to}")
+        return self._send_request(self._image_payload(to, {"link": image_url}, caption))
+
+    def _image_payload(self, to: str, image_data: Dict[str, Any], caption: Optional[str]) -> Dict[str, Any]:
         if caption:
             image_data["caption"] = caption
         
-        payload = {
+        return {
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
             "to": to,
             "type": "image",
             "image": image_data
         }
-        
-        logger.info(f"Enviando imagem para {to}")
-        return self._send_request(payload)
     
     # ... outros métodos de envio de mensagens ...
     
     # ===== MÉTODOS PARA LIDAR COM MÍDIA =====
     
+    def fetch_url(self, url: str, max_bytes: int) -> tuple:
+        """
+        Baixa um arquivo público (ex: imagem do catálogo num CDN).
+        
+        Args:
+            url: URL do arquivo
+            max_bytes: Tamanho máximo aceito
+            
+        Returns:
+            Tupla (conteúdo, mime type)
+        """
+        with metrics.timed(metrics.MEDIA_DOWNLOAD_LATENCY):
+            response = self.session.get(url, timeout=deadline.timeout(30), stream=True)
+            response.raise_for_status()
+            content = b""
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > max_bytes:
+                    raise ValueError(f"Arquivo maior que {max_bytes} bytes: {url}")
+        mime_type = response.headers.get("Content-Type", "image/jpeg").split(";")[0].strip()
+        return content, mime_type
+    
+    def upload_media(self, content: bytes, mime_type: str, filename: str = "arquivo") -> str:
+        """
+        Faz o upload de uma mídia para o número (válida por 30 dias).
+        
+        Args:
+            content: Conteúdo do arquivo
+            mime_type: Tipo do arquivo (ex: image/jpeg)
+            filename: Nome do arquivo
+            
+        Returns:
+            ID da mídia
+        """
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.post(
+                f"{self.base_url}/media",
+                headers={"Authorization": f"Bearer {self.access_token}"},
+                data={"messaging_product": "whatsapp", "type": mime_type},
+                files={"file": (filename, content, mime_type)},
+                timeout=deadline.timeout(60)
+            )
+            status = str(response.status_code)
+            response.raise_for_status()
+            return response.json()["id"]
+        except requests.exceptions.RequestException as e:
+            metrics.record_error("graph_api", e)
+            raise
+        finally:
+            metrics.GRAPH_API_LATENCY.labels(operation="media_upload", status=status).observe(
+                time.perf_counter() - start
+            )
+    
     def get_media_url(self, media_id: str) -> Optional[str]:
         """
         Obtém a URL de download de uma mídia do WhatsApp.
@@ -373,13 +646,13 @@ class WhatsAppClient:
             URL da mídia ou None em caso de erro
         """
         try:
-            url = f"https://graph.facebook.com/{self.version}/{media_id}"
+            url = f"{self.graph_url}/{self.version}/{media_id}"
             headers = {
                 "Authorization": f"Bearer {self.access_token}"
             }
             
             logger.info(f"Obtendo URL da mídia: {media_id}")
-            response = requests.get(url, headers=headers)
+            response = self.session.get(url, headers=headers, timeout=deadline.timeout(GRAPH_TIMEOUT_S))
             response.raise_for_status()
             
             media_data = response.json()
@@ -393,6 +666,7 @@ class WhatsAppClient:
             return media_url
             
         except Exception as e:
+            metrics.record_error("media_url", e)
             logger.error(f"Erro ao obter URL da mídia: {str(e)}")
             return None
     
@@ -407,6 +681,13 @@ class WhatsAppClient:
         Returns:
             Caminho do arquivo baixado ou None em caso de erro
         """
+        with metrics.timed(metrics.MEDIA_DOWNLOAD_LATENCY), tracing.span("media.download"):
+            return self._download_media(media_id, output_path)
+
+    def _download_media(self, media_id: str, output_path: Optional[str] = None) -> Optional[str]:
+        """
+        Implementação de download_media, separada para medir a latência total.
+        """
         try:
             # Obter a URL da mídia
             media_url = self.get_media_url(media_id)
@@ -419,9 +700,10 @@ class WhatsAppClient:
                 extension = ".bin"  # Padrão
                 
                 # Fazer uma requisição HEAD para obter o tipo MIME
-                head_response = requests.head(
+                head_response = self.session.head(
                     media_url, 
-                    headers={"Authorization": f"Bearer {self.access_token}"}
+                    headers={"Authorization": f"Bearer {self.access_token}"},
+                    timeout=deadline.timeout(GRAPH_TIMEOUT_S)
                 )
                 
                 content_type = head_response.headers.get("Content-Type", "")
@@ -441,9 +723,10 @@ class WhatsAppClient:
             
             # Fazer download da mídia
             logger.info(f"Baixando mídia para: {output_path}")
-            download_response = requests.get(
+            download_response = self.session.get(
                 media_url,
-                headers={"Authorization": f"Bearer {self.access_token}"}
+                headers={"Authorization": f"Bearer {self.access_token}"},
+                timeout=deadline.timeout(GRAPH_TIMEOUT_S)
             )
             download_response.raise_for_status()
             
@@ -458,9 +741,94 @@ class WhatsAppClient:
             return output_path
             
         except Exception as e:
+            metrics.record_error("media_download", e)
             logger.error(f"Erro ao baixar mídia: {str(e)}")
             return None
     
+    def download_media_bytes(self, media_id: str, max_bytes: int) -> Optional[Tuple[bytes, str]]:
+        """
+        Baixa uma mídia do WhatsApp para a memória, em partes, interrompendo o
+        download se passar de max_bytes.
+
+        Args:
+            media_id: ID da mídia
+            max_bytes: Tamanho máximo aceito
+
+        Returns:
+            Tupla (conteúdo, tipo MIME) ou None em caso de erro
+        """
+        with metrics.timed(metrics.MEDIA_DOWNLOAD_LATENCY), tracing.span("media.download"):
+            try:
+                media_url = self.get_media_url(media_id)
+                if not media_url:
+                    return None
+                with self.session.get(media_url, headers={"Authorization": f"Bearer {self.access_token}"},
+                                      timeout=deadline.timeout(GRAPH_TIMEOUT_S), stream=True) as response:
+                    response.raise_for_status()
+                    mime_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+                    chunks, size = [], 0
+                    for chunk in response.iter_content(64 * 1024):
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise ValueError(f"Mídia {media_id} maior que {max_bytes} bytes")
+                        chunks.append(chunk)
+                return b"".join(chunks), mime_type
+            except Exception as e:
+                metrics.record_error("media_download", e)
+                logger.error(f"Erro ao baixar mídia: {str(e)}")
+                return None
+
+    # ===== MÉTODOS DE IMAGEM =====
+
+    def process_image_message(self, message: Dict[str, Any]) -> Optional[InboundImage]:
+        """
+        Baixa e reduz a imagem de uma mensagem recebida para enviá-la ao agente.
+
+        Args:
+            message: Dados da mensagem recebida
+
+        Returns:
+            Imagem reduzida ou None em caso de erro
+        """
+        image = message.get("image", {})
+        media_id, original_hash = image.get("id"), image.get("sha256")
+        if not media_id:
+            logger.error("ID da imagem não encontrado na mensagem")
+            return None
+        if original_hash:
+            with self._images_lock:
+                cached = self._images.get(original_hash)
+            if cached is not None:
+                logger.info(f"Imagem já reduzida reutilizada: {original_hash}")
+                return InboundImage(cached.data, cached.mime_type, cached.sha256, image.get("caption"))
+
+        downloaded = self.download_media_bytes(media_id, IMAGE_DOWNLOAD_MAX_BYTES)
+        if downloaded is None:
+            return None
+        data, mime_type = downloaded
+        try:
+            with metrics.timed(metrics.IMAGE_DOWNSCALE_LATENCY), tracing.span("image.downscale"), \
+                    event_log.timed("image.downscale"):
+                reduced, (width, height) = downscale_image(data)
+        except Exception as e:
+            metrics.record_error("image_downscale", e)
+            logger.error(f"Erro ao reduzir imagem {media_id} ({mime_type}): {str(e)}")
+            return None
+
+        result = InboundImage(reduced, "image/jpeg", hashlib.sha256(reduced).hexdigest(), image.get("caption"))
+        metrics.IMAGE_BYTES.labels(kind="original").inc(len(data))
+        metrics.IMAGE_BYTES.labels(kind="sent").inc(len(reduced))
+        metrics.IMAGE_BYTES_SAVED.observe(max(0, len(data) - len(reduced)))
+        event_log.emit("image", original_bytes=len(data), sent_bytes=len(reduced), width=width, height=height,
+                       sha256=result.sha256)
+        logger.info(f"Imagem reduzida: {len(data)} -> {len(reduced)} bytes ({width}x{height})")
+        if original_hash:
+            with self._images_lock:
+                self._images[original_hash] = result
+                while len(self._images) > IMAGE_CACHE_SIZE:
+                    self._images.popitem(last=False)
+        return result
+
     # ===== MÉTODOS DE TRANSCRIÇÃO DE ÁUDIO =====e
     
     def _convert_audio_format(self, input_path: str, target_format: str = "flac") -> Optional[str]:
@@ -505,73 +873,217 @@ class WhatsAppClient:
             cmd.append(output_path)
             
             # Executar o comando
-            subprocess.run(cmd, check=True)
+            with metrics.timed(metrics.AUDIO_CONVERSION_LATENCY, format=target_format), \
+                    tracing.span("audio.convert", format=target_format):
+                subprocess.run(cmd, check=True, timeout=deadline.timeout(FFMPEG_TIMEOUT_S))
             
             logger.info(f"Conversão concluída: {output_path}")
             return output_path
             
         except Exception as e:
+            metrics.record_error("audio_conversion", e)
             logger.error(f"Erro ao converter áudio: {str(e)}")
             return None
     
-    def transcribe_audio_with_gemini(self, audio_path: str) -> Optional[str]:
+    def transcribe_audio_with_gemini(self, audio_path: str,
+                                     on_first_segment: Optional[Callable[[str], None]] = None) -> Optional[str]:
         """
-        Transcreve um arquivo de áudio usando o Gemini.
+        Transcreve um arquivo de áudio usando o Gemini. Áudios longos são divididos
+        em trechos (nos silêncios) transcritos em paralelo.
         
         Args:
             audio_path: Caminho para o arquivo de áudio
+            on_first_segment: Recebe o texto do primeiro trecho assim que ele fica pronto
+                (só em áudios divididos)
             
         Returns:
-            Texto transcrito ou None em caso de erro
+            Texto transcrito (sem o primeiro trecho, se ele foi entregue a on_first_segment)
+            ou None em caso de erro
+        """
+        with metrics.timed(metrics.TRANSCRIPTION_LATENCY), event_log.timed("transcription"), \
+                tracing.span("audio.transcribe"):
+            return self._transcribe_audio_with_gemini(audio_path, on_first_segment)
+
+    def _probe_audio(self, audio_path: str) -> Tuple[Optional[float], List[Tuple[float, float]]]:
+        """
+        Mede a duração do áudio e encontra os silêncios, numa única passada do FFmpeg.
+        """
+        cmd = [
+            "ffmpeg", "-hide_banner", "-nostats",
+            "-i", audio_path,
+            "-af", f"silencedetect=noise={AUDIO_SILENCE_DB}dB:d={AUDIO_SILENCE_MIN_S}",
+            "-f", "null", "-"
+        ]
+        with tracing.span("audio.probe"):
+            result = subprocess.run(cmd, capture_output=True, text=True,
+                                    timeout=deadline.timeout(FFMPEG_TIMEOUT_S))
+        return parse_silencedetect(result.stderr)
+
+    def _split_audio(self, audio_path: str, segments: List[Tuple[float, float]], directory: str) -> List[str]:
+        """
+        Corta o áudio nos limites dos trechos e converte cada um para MP3, numa única passada.
+
+        Returns:
+            Caminhos dos trechos, em ordem
+        """
+        cmd = [
+            "ffmpeg", "-i", audio_path, "-y", "-loglevel", "error",
+            "-f", "segment",
+            "-segment_times", ",".join(f"{end:.3f}" for _, end in segments[:-1]),
+            "-reset_timestamps", "1",
+            "-acodec", "libmp3lame", "-q:a", "2",
+            os.path.join(directory, "%03d.mp3")
+        ]
+        with metrics.timed(metrics.AUDIO_CONVERSION_LATENCY, format="mp3"), \
+                tracing.span("audio.split", segments=len(segments)):
+            subprocess.run(cmd, check=True, timeout=deadline.timeout(FFMPEG_TIMEOUT_S))
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+
+    def _transcribe_segment(self, path: str) -> Optional[str]:
+        with open(path, "rb") as f:
+            audio_data = f.read()
+        return llm_backend.get_backend().transcribe(audio_data, lambda: self._transcribe_live(audio_data))
+
+    def _transcribe_chunked(self, audio_path: str, segments: List[Tuple[float, float]],
+                            on_first_segment: Optional[Callable[[str], None]]) -> Optional[str]:
         """
+        Transcreve os trechos em paralelo e junta os textos na ordem original.
+        """
+        global _segment_executor
+        if _segment_executor is None:
+            _segment_executor = ThreadPoolExecutor(max_workers=AUDIO_SEGMENT_WORKERS, thread_name_prefix="audio-segment")
+        start = time.perf_counter()
+        directory = tempfile.mkdtemp(prefix="audio-")
         try:
-            # Importar a biblioteca do Gemini
-            try:
-                import google.generativeai as genai
-            except ImportError:
-                logger.error("Biblioteca google.generativeai não instalada. Instale com: pip install google-generativeai")
+            paths = self._split_audio(audio_path, segments, directory)
+            metrics.TRANSCRIPTION_SEGMENTS.observe(len(paths))
+            logger.info(f"Áudio de {segments[-1][1]:.0f}s dividido em {len(paths)} trechos")
+            # Enviados em ordem: o primeiro trecho começa primeiro
+            futures = [_segment_executor.submit(contextvars.copy_context().run, self._transcribe_segment, path)
+                       for path in paths]
+            texts, delivered = [], False
+            for index, future in enumerate(futures):
+                try:
+                    text = future.result()
+                except Exception as e:
+                    metrics.record_error("transcription", e)
+                    logger.error(f"Erro ao transcrever o trecho {index + 1} de {len(paths)}: {str(e)}")
+                    text = None
+                if index == 0:
+                    metrics.TRANSCRIPTION_FIRST_SEGMENT_LATENCY.observe(time.perf_counter() - start)
+                    # O agente pode começar pelo primeiro trecho enquanto os outros são transcritos
+                    if text and on_first_segment is not None and len(futures) > 1:
+                        on_first_segment(text.strip())
+                        delivered = True
+                        continue
+                if text:
+                    texts.append(text.strip())
+            if not texts and not delivered:
                 return None
-            
-            # Configurar a API do Gemini
-            api_key = os.environ.get("GEMINI_API_KEY")
-            if not api_key:
-                logger.error("GEMINI_API_KEY não configurada")
-                return None
-                
-            genai.configure(api_key=api_key)
-            
+            transcription = " ".join(texts)
+            logger.info(f"Transcrição concluída com Gemini ({len(paths)} trechos): {transcription}")
+            return transcription
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _transcribe_audio_with_gemini(self, audio_path: str,
+                                      on_first_segment: Optional[Callable[[str], None]] = None) -> Optional[str]:
+        """
+        Implementação de transcribe_audio_with_gemini, separada para medir a latência total.
+        """
+        try:
+            if AUDIO_CHUNK_MIN_S > 0 and os.path.getsize(audio_path) >= AUDIO_CHUNK_MIN_S * _AUDIO_MIN_BYTES_PER_S:
+                try:
+                    duration, silences = self._probe_audio(audio_path)
+                except Exception as e:
+                    metrics.record_error("audio_probe", e)
+                    logger.warning(f"Não foi possível analisar o áudio, transcrevendo inteiro: {str(e)}")
+                    duration, silences = None, []
+                if duration is not None and duration > AUDIO_CHUNK_MIN_S:
+                    return self._transcribe_chunked(audio_path, plan_segments(duration, silences), on_first_segment)
+
             # Converter para MP3 (formato mais compatível)
             converted_path = self._convert_audio_format(audio_path, "mp3")
             if not converted_path:
                 logger.error("Falha ao converter o áudio para MP3")
                 return None
             
-            # Carregar o modelo Gemini Pro Vision (que pode processar áudio)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            
             # Ler o arquivo de áudio
             with open(converted_path, "rb") as f:
                 audio_data = f.read()
             
-            # Criar a solicitação para o Gemini
-            logger.info(f"Enviando áudio para transcrição com Gemini")
-            response = model.generate_content([
-                "Por favor, transcreva o seguinte áudio em texto. O áudio está em português do Brasil.",
-                {"mime_type": "audio/mpeg", "data": audio_data}
-            ])
-            
             # Limpar arquivos temporários
             if converted_path != audio_path and os.path.exists(converted_path):
                 os.unlink(converted_path)
             
-            logger.info(f"Transcrição concluída com Gemini: {response.text}")
-            return response.text
+            # O backend decide entre o Gemini real, respostas gravadas ou sintéticas
+            transcription = llm_backend.get_backend().transcribe(
+                audio_data, lambda: self._transcribe_live(audio_data)
+            )
+            if transcription is not None:
+                logger.info(f"Transcrição concluída com Gemini: {transcription}")
+            return transcription
             
         except Exception as e:
+            metrics.record_error("transcription", e)
             logger.error(f"Erro ao transcrever com Gemini: {str(e)}")
             return None
     
-    def transcribe_audio(self, audio_id: str, service: str = "gemini", language_code: str = "pt-BR") -> Optional[str]:
+    def _transcribe_live(self, audio_data: bytes) -> Optional[str]:
+        """
+        Chama o Gemini com timeout (limitado pelo prazo da mensagem) e protegido pelo disjuntor.
+        """
+        seconds = deadline.timeout(TRANSCRIPTION_TIMEOUT_S, required=TRANSCRIPTION_MIN_TIMEOUT_S)
+        return circuit_breaker.gemini.call(
+            deadline.call_with_timeout, lambda: self._generate_transcription(audio_data), seconds, "transcription"
+        )
+    
+    def _generate_transcription(self, audio_data: bytes) -> Optional[str]:
+        """
+        Envia o áudio (MP3) ao Gemini e retorna o texto transcrito.
+        
+        Args:
+            audio_data: Conteúdo do áudio em MP3
+            
+        Returns:
+            Texto transcrito ou None em caso de erro
+        """
+        # Importar a biblioteca do Gemini
+        try:
+            import google.generativeai as genai
+        except ImportError:
+            logger.error("Biblioteca google.generativeai não instalada. Instale com: pip install google-generativeai")
+            return None
+        
+        # Configurar a API do Gemini
+        api_key = os.environ.get("GEMINI_API_KEY")
+        if not api_key:
+            logger.error("GEMINI_API_KEY não configurada")
+            return None
+            
+        genai.configure(api_key=api_key)
+        
+        # Carregar o modelo Gemini Pro Vision (que pode processar áudio)
+        model_name = 'gemini-1.5-flash'
+        model = genai.GenerativeModel(model_name)
+        
+        # Criar a solicitação para o Gemini
+        logger.info(f"Enviando áudio para transcrição com Gemini")
+        start = time.perf_counter()
+        response = model.generate_content([
+            "Por favor, transcreva o seguinte áudio em texto. O áudio está em português do Brasil.",
+            {"mime_type": "audio/mpeg", "data": audio_data}
+        ])
+        # Tokens atribuídos ao contato do áudio (usage.attributed em app.py)
+        metadata = getattr(response, "usage_metadata", None)
+        usage.record(usage.Usage("transcription", model_name,
+                                 getattr(metadata, "prompt_token_count", 0) or 0,
+                                 getattr(metadata, "candidates_token_count", 0) or 0,
+                                 time.perf_counter() - start))
+        return response.text
+    
+    def transcribe_audio(self, audio_id: str, service: str = "gemini", language_code: str = "pt-BR",
+                         on_first_segment: Optional[Callable[[str], None]] = None) -> Optional[str]:
         """
         Baixa e transcreve um áudio do WhatsApp.
         
@@ -579,6 +1091,7 @@ class WhatsAppClient:
             audio_id: ID do áudio no WhatsApp
             service: Serviço de transcrição a ser usado ('google' ou 'gemini')
             language_code: Código do idioma (usado apenas com Google Speech-to-Text)
+            on_first_segment: Recebe o primeiro trecho de áudios longos assim que ele fica pronto
             
         Returns:
             Texto transcrito ou None em caso de erro
@@ -594,7 +1107,7 @@ class WhatsAppClient:
             #if service.lower() == "google":
             #    transcription = self.transcribe_audio_with_google(audio_path, language_code)
             if service.lower() == "gemini":
-                transcription = self.transcribe_audio_with_gemini(audio_path)
+                transcription = self.transcribe_audio_with_gemini(audio_path, on_first_segment)
             else:
                 logger.error(f"Serviço de transcrição não suportado: {service}")
                 return None
@@ -609,7 +1122,8 @@ class WhatsAppClient:
             logger.error(f"Erro ao transcrever áudio: {str(e)}")
             return None
     
-    def process_audio_message(self, message: Dict[str, Any], wa_id: str, service: str = "gemini") -> None:
+    def process_audio_message(self, message: Dict[str, Any], wa_id: str, service: str = "gemini",
+                              on_first_segment: Optional[Callable[[str], None]] = None) -> None:
         """
         Processa uma mensagem de áudio, transcreve e envia a transcrição de volta.
         
@@ -617,6 +1131,7 @@ class WhatsAppClient:
             message: Dados da mensagem recebida
             wa_id: ID do WhatsApp do remetente
             service: Serviço de transcrição a ser usado ('google' ou 'gemini')
+            on_first_segment: Recebe o primeiro trecho de áudios longos assim que ele fica pronto
         """
         try:
             # Obter o ID do áudio
@@ -630,7 +1145,7 @@ class WhatsAppClient:
                 return
             
             # Transcrever o áudio
-            transcription = self.transcribe_audio(audio_id, service)
+            transcription = self.transcribe_audio(audio_id, service, on_first_segment=on_first_segment)
             return transcription
                 
         except Exception as e:
@@ -660,6 +1175,4 @@ def create_client_from_env() -> WhatsAppClient:
             "As variáveis de ambiente WHATSAPP_PHONE_NUMBER_ID e WHATSAPP_ACCESS_TOKEN são obrigatórias"
         )
     
-    return WhatsAppClient(phone_number_id, access_token)
-
-print("Módulo de integração com WhatsApp Business API criado com sucesso!")
\ No newline at end of file
+    return WhatsAppClient(phone_number_id, access_token)
\ No newline at end of file